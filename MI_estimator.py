@@ -1,10 +1,80 @@
+import os
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from MINE import calculate_MI_MINE
 from simple_bin import bin_calc_information2
-from pytorch_kde import kde_multivariate_gauss_entropy, entropy_estimator_kl_simple, entropy_estimator_bd
+from pytorch_kde import kde_multivariate_gauss_entropy, kde_distance_plan, kde_tiled_plan
+
+class activation_arena(object):
+    """
+    预先分配好的缓冲区, 代替 Forward_Repeat 循环中反复的 torch.cat (每一次 cat 都会重新分配并复制之前所有的数据).
+    每一个 slot (例如被 hook 的第 i 层) 在第一次写入时根据 batch 的形状分配一块 capacity * D 的缓冲区,
+    之后的 batch 直接原地写入. reset 之后缓冲区会被保留, 下一个 epoch 形状不变时直接复用.
+    """
+
+    def __init__(self, capacity, device=None, pin_memory=False, dtype=None, share_memory=False):
+        self.capacity = capacity
+        # device/dtype 为 None 时与第一次写入的 tensor 保持一致
+        self.device = device
+        self.pin_memory = pin_memory
+        # share_memory 为 True 时缓冲区分配在共享内存中, 可以不经复制地传给 MI 计算的子进程
+        self.share_memory = share_memory
+        self.dtype = dtype
+        self.buffers = []
+        self.offsets = []
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def reset(self, capacity=None):
+        if capacity is not None and capacity > self.capacity:
+            self.buffers = []
+        if capacity is not None:
+            self.capacity = capacity
+        self.offsets = [0 for _ in self.buffers]
+
+    def allocate(self, tensor):
+        device = tensor.device if self.device is None else torch.device(self.device)
+        dtype = tensor.dtype if self.dtype is None else self.dtype
+        pin_memory = self.pin_memory and device.type == 'cpu' and torch.cuda.is_available()
+        buffer = torch.empty((self.capacity,) + tuple(tensor.shape[1:]), dtype=dtype, device=device,
+                             pin_memory=pin_memory)
+        if self.share_memory and device.type == 'cpu':
+            buffer.share_memory_()
+        return buffer
+
+    def append(self, slot, tensor, non_blocking=False):
+        if slot == len(self.buffers):
+            self.buffers.append(self.allocate(tensor))
+            self.offsets.append(0)
+        elif self.buffers[slot].shape[1:] != tensor.shape[1:]:
+            # 同一个 slot 的形状发生了变化 (例如换了模型), 重新分配
+            if self.offsets[slot] != 0:
+                raise RuntimeError('activation arena slot %d changed shape while being filled' % slot)
+            self.buffers[slot] = self.allocate(tensor)
+        start = self.offsets[slot]
+        end = start + tensor.size(0)
+        if end > self.buffers[slot].size(0):
+            raise RuntimeError('activation arena overflow: %d > capacity %d' % (end, self.buffers[slot].size(0)))
+        self.buffers[slot][start:end].copy_(tensor, non_blocking=non_blocking)
+        self.offsets[slot] = end
+
+    def get(self, slot):
+        return self.buffers[slot][:self.offsets[slot]]
+
+    def get_all(self):
+        return [self.get(slot) for slot in range(len(self.buffers))]
+
+
+# mutual_info_estimator 中单个 epoch 的临时结果
+EPOCH_I_MI_NAMES = ['epoch_i_MI_hM_X_lower', 'epoch_i_MI_hM_Y_lower', 'epoch_i_MI_hM_Y_lower_detail',
+                    'epoch_i_MI_hM_X_upper', 'epoch_i_MI_hM_Y_upper',
+                    'epoch_i_MI_hM_X_bin', 'epoch_i_MI_hM_Y_bin',
+                    'epoch_i_MI_hM_X_upper_sweep', 'epoch_i_MI_hM_Y_upper_sweep',
+                    'epoch_i_MI_hM_X_lower_sweep', 'epoch_i_MI_hM_Y_lower_sweep']
 
 """
 此处注意，
@@ -18,7 +88,17 @@ class mutual_info_estimator(object):
     def __init__(self, modules_to_hook,
                  By_Layer_Name=False,
                  Label_Num=10,
-                 Enable_Detail=False):
+                 Enable_Detail=False,
+                 KDE_Tile_Size=None,
+                 KDE_Memory_Budget=None,
+                 Noise_Variance=0.1,
+                 Noise_Variance_L=None,
+                 Bin_Engine='sort',
+                 Bin_Single_Pass=False,
+                 Capture_Mode='clone',
+                 MI_Workers=0,
+                 MI_Executor='process',
+                 Capture_Dtype=None):
         # 根据modules_to_hook中元素的类型是不是字符串对象来判断
         self.Label_Num = Label_Num
         self.By_Layer_Name = isinstance(modules_to_hook[0], str)
@@ -27,11 +107,44 @@ class mutual_info_estimator(object):
         self.DO_UPPER = True
         self.DO_BIN = True
         self.Enable_Detail = Enable_Detail
+        # 给定 KDE_Tile_Size (行块大小) 或 KDE_Memory_Budget (字节) 时, KDE 使用分块的 logsumexp, 不再构造 N*N 距离矩阵
+        self.KDE_Tile_Size = KDE_Tile_Size
+        self.KDE_Memory_Budget = KDE_Memory_Budget
+        # Noise_Variance 是 KDE 默认使用的噪声方差,
+        # Noise_Variance_L 不为 None 时, 额外记录一组噪声方差下的上下界, 所有方差共享同一个距离矩阵
+        self.Noise_Variance = Noise_Variance
+        self.Noise_Variance_L = Noise_Variance_L
+        # binning 中统计不同行的方式, 'sort' 为 np.unique 按行排序, 'hash' 为 64 位行哈希
+        self.Bin_Engine = Bin_Engine
+        # 整层只离散化/统计一次, 用 (标签, 行编号) 的联合计数得到所有 H(T|Y=y), 结果与逐标签计算逐位相同
+        self.Bin_Single_Pass = Bin_Single_Pass
+        # hook 中保存激活值的方式:
+        # 'clone': output.clone().detach().cpu(), 每一层都在 forward 中间做一次同步的 device->host 拷贝
+        # 'async': GPU 上的激活值在 side stream 上 non_blocking 地拷贝到 pinned 内存, 直到真正需要数据时才同步一次;
+        #          CPU 上的激活值与 clone 模式一样复制一份 (精度转换本身产生新 tensor 时不再额外 clone),
+        #          因为之后的 inplace 层 (例如 VGG_s 中的 ReLU(inplace=True)) 会改写被 hook 的层的输出
+        self.Capture_Mode = Capture_Mode
+        # 激活值保存的精度, None 时与层的输出相同; torch.float16/bfloat16 可以把保存激活值的内存减半,
+        # 互信息计算时只有 KDE 的距离计算会转回 float32 (见 pytorch_kde.to_compute_dtype)
+        self.Capture_Dtype = Capture_Dtype
+        self.capture_stream = None
+        self.capture_pending = False
+        # begin_capture 之后, hook 直接把激活值写入预先分配好的 activation_arena, 第 i 次 hook 调用写入第 i 个 slot
+        self.activation_arena = None
+        self.arena_active = False
+        self.hook_call_idx = 0
+        # MI_Workers > 0 时, caculate_MI 把每一层的 binning 和 KDE 分别提交到 MI_Workers 个 worker 上并行计算
+        # MI_Executor = 'process': spawn 出来的进程池, 激活值放在共享内存中; 'thread': 线程池
+        self.MI_Workers = MI_Workers
+        self.MI_Executor = MI_Executor
+        self.executor = None
 
         # self.DO_MINE = False
 
         self.modules_to_hook = modules_to_hook
         self.layer_names = []
+        # layer_names 每次 forward 之后都会被清空, 这里保留最近一次 hook 的层名, 保存结果时使用
+        self.hooked_layer_names = []
         self.layer_activations = []
         self.handle_list = []
 
@@ -45,6 +158,12 @@ class mutual_info_estimator(object):
         self.epoch_MI_hM_X_bin = []
         self.epoch_MI_hM_Y_bin = []
 
+        # shape = (epoch, layer, len(Noise_Variance_L))
+        self.epoch_MI_hM_X_upper_sweep = []
+        self.epoch_MI_hM_Y_upper_sweep = []
+        self.epoch_MI_hM_X_lower_sweep = []
+        self.epoch_MI_hM_Y_lower_sweep = []
+
         # self.epoch_MI_hM_X_mine = []
         # self.epoch_MI_hM_Y_mine = []
 
@@ -59,6 +178,11 @@ class mutual_info_estimator(object):
         self.epoch_i_MI_hM_X_bin = []
         self.epoch_i_MI_hM_Y_bin = []
 
+        self.epoch_i_MI_hM_X_upper_sweep = []
+        self.epoch_i_MI_hM_Y_upper_sweep = []
+        self.epoch_i_MI_hM_X_lower_sweep = []
+        self.epoch_i_MI_hM_Y_lower_sweep = []
+
         # def hook(self, layer, input, output):
         """
         hook 函数钩住的对象一旦不是模型上有关系的对象，就会出很多问题
@@ -71,6 +195,7 @@ class mutual_info_estimator(object):
     def clear_all(self):
         self.cancel_hook()
         self.clear_activations()
+        self.shutdown_executor()
 
         self.epoch_MI_hM_X_lower.clear()
         self.epoch_MI_hM_Y_lower.clear()
@@ -82,6 +207,11 @@ class mutual_info_estimator(object):
         self.epoch_MI_hM_X_bin.clear()
         self.epoch_MI_hM_Y_bin.clear()
 
+        self.epoch_MI_hM_X_upper_sweep.clear()
+        self.epoch_MI_hM_Y_upper_sweep.clear()
+        self.epoch_MI_hM_X_lower_sweep.clear()
+        self.epoch_MI_hM_Y_lower_sweep.clear()
+
         # temp variable
         self.epoch_i_MI_hM_X_lower.clear()
         self.epoch_i_MI_hM_Y_lower.clear()
@@ -93,6 +223,11 @@ class mutual_info_estimator(object):
         self.epoch_i_MI_hM_X_bin.clear()
         self.epoch_i_MI_hM_Y_bin.clear()
 
+        self.epoch_i_MI_hM_X_upper_sweep.clear()
+        self.epoch_i_MI_hM_Y_upper_sweep.clear()
+        self.epoch_i_MI_hM_X_lower_sweep.clear()
+        self.epoch_i_MI_hM_Y_lower_sweep.clear()
+
     def cancel_hook(self):
         # print("handle list len", len(handle_list))
         # 执行完remove()操作后 清除handle_list列表
@@ -104,16 +239,139 @@ class mutual_info_estimator(object):
     def clear_activations(self):
         self.layer_activations.clear()
         self.layer_names.clear()
-
-    def do_forward_hook(self, model):
+        self.hook_call_idx = 0
+
+    def begin_capture(self, capacity):
+        # 之后每一次 forward 的激活值都原地写入 arena, 直到 end_capture
+        if self.activation_arena is None:
+            if self.MI_Workers > 0 and self.MI_Executor == 'process':
+                # 进程池模式下直接写入共享内存, caculate_MI 时不需要再复制一次
+                self.activation_arena = activation_arena(capacity, device='cpu', share_memory=True,
+                                                         dtype=self.Capture_Dtype)
+            else:
+                self.activation_arena = activation_arena(capacity, device='cpu', pin_memory=True,
+                                                         dtype=self.Capture_Dtype)
+        self.activation_arena.reset(capacity)
+        self.arena_active = True
+        self.hook_call_idx = 0
+
+    def end_capture(self):
+        self.synchronize()
+        self.arena_active = False
+        self.layer_activations = self.activation_arena.get_all()
+
+    def __getstate__(self):
+        # cuda stream 不能被 pickle, 保存估计器时丢掉
+        state = self.__dict__.copy()
+        state['capture_stream'] = None
+        state['capture_pending'] = False
+        # arena 中的激活值数据量太大, 不保存
+        state['activation_arena'] = None
+        state['arena_active'] = False
+        # 进程池/线程池不能被 pickle
+        state['executor'] = None
+        return state
+
+    def to_capture_dtype(self, output):
+        if self.Capture_Dtype is None or output.dtype == self.Capture_Dtype:
+            return output
+        return output.to(self.Capture_Dtype)
+
+    def capture(self, output):
+        if self.arena_active:
+            self.capture_to_arena(output)
+        elif self.Capture_Mode == 'clone':
+            output = self.to_capture_dtype(output.detach())
+            self.layer_activations.append(output.clone().cpu().view(output.size(0), -1))
+        elif self.Capture_Mode == 'async':
+            output = output.detach()
+            if output.is_cuda:
+                self.layer_activations.append(self.copy_to_host_async(output))
+            else:
+                # 没有拷贝到单独的 pinned 缓冲区, 与 clone 模式一样必须复制一份,
+                # 否则之后的 inplace 层 (例如 VGG_s 中的 ReLU(inplace=True)) 会改写已经保存的激活值
+                captured = self.to_capture_dtype(output)
+                if captured is output:
+                    captured = captured.clone()
+                self.layer_activations.append(captured.reshape(output.size(0), -1))
+        else:
+            raise RuntimeError('Unknown Capture_Mode: %s' % self.Capture_Mode)
+
+    def copy_to_host_async(self, output):
+        # pinned 内存由 pytorch 的 caching host allocator 管理, 第一个 epoch 之后的分配都是复用已有的 pinned 块
+        if self.capture_stream is None:
+            self.capture_stream = torch.cuda.Stream(device=output.device)
+        dtype = output.dtype if self.Capture_Dtype is None else self.Capture_Dtype
+        host_buffer = torch.empty((output.size(0), output[0].numel()), dtype=dtype, pin_memory=True)
+        # side stream 要等 forward 中产生 output 的计算完成之后才能开始拷贝
+        self.capture_stream.wait_stream(torch.cuda.current_stream(output.device))
+        with torch.cuda.stream(self.capture_stream):
+            # 精度转换也在 side stream 上完成, 只拷贝转换之后的数据 (转换得到的临时 tensor 本身就分配在 side stream 上)
+            host_buffer.copy_(self.to_capture_dtype(output.reshape(output.size(0), -1)), non_blocking=True)
+        # 拷贝完成之前 output 的显存不能被 caching allocator 复用
+        output.record_stream(self.capture_stream)
+        self.capture_pending = True
+        return host_buffer
+
+    def capture_to_arena(self, output):
+        slot = self.hook_call_idx
+        self.hook_call_idx += 1
+        output = output.detach()
+        if self.Capture_Mode == 'async' and output.is_cuda:
+            if self.capture_stream is None:
+                self.capture_stream = torch.cuda.Stream(device=output.device)
+            self.capture_stream.wait_stream(torch.cuda.current_stream(output.device))
+            with torch.cuda.stream(self.capture_stream):
+                self.activation_arena.append(slot, self.to_capture_dtype(output.reshape(output.size(0), -1)),
+                                             non_blocking=True)
+            output.record_stream(self.capture_stream)
+            self.capture_pending = True
+        else:
+            # copy_ 本身就是一次拷贝, 不需要再 clone
+            self.activation_arena.append(slot, output.reshape(output.size(0), -1))
+
+    def synchronize(self):
+        # 读取 layer_activations 之前调用, 等待所有 non_blocking 的拷贝完成, 没有未完成的拷贝时什么都不做
+        if self.capture_pending:
+            self.capture_stream.synchronize()
+            self.capture_pending = False
+
+    def capture_levels(self, output, level_estimators):
+        # output 沿 batch 维度按顺序堆叠了 len(level_estimators) 段大小相同的输出, 每一段交给对应的估计器保存
+        for level_estimator, level_output in zip(level_estimators, output.chunk(len(level_estimators), dim=0)):
+            level_estimator.capture(level_output)
+
+    def forward_and_capture(self, model, images, level_estimators=None):
+        '''
+        hook 版本和编译版本 (compiled_model) 共用的入口, 返回模型的输出.
+        编译版本的被记录层的输出由计算图直接返回, 按调用顺序依次交给 capture, 与 hook 被触发的顺序相同;
+        否则注册 forward hook 之后再 forward, 调用者之后仍然需要 cancel_hook.
+        '''
+        if not hasattr(model, 'forward_with_activations'):
+            self.do_forward_hook(model, level_estimators)
+            return model(images)
+        outputs, activations = model.forward_with_activations(images)
+        for output in activations:
+            if level_estimators is None:
+                self.capture(output)
+            else:
+                self.capture_levels(output, level_estimators)
+        self.layer_names = list(model.layer_names)
+        self.hooked_layer_names = list(model.layer_names)
+        return outputs
+
+    def do_forward_hook(self, model, level_estimators=None):
+        # level_estimators 不为 None 时, 被 hook 的层的输出按 level 切开, 写入各个 level 的估计器
+        if level_estimators is None:
+            capture_hook = lambda layer, input, output: self.capture(output)
+        else:
+            capture_hook = lambda layer, input, output: self.capture_levels(output, level_estimators)
         if self.By_Layer_Name:
             for layer_name, layer in model.named_modules():
                 if layer_name in self.modules_to_hook:
                     self.layer_names.append(layer_name)
                     # print('layer name: ', layer_name)
-                    handle = layer.register_forward_hook(
-                        lambda layer, input, output:
-                        self.layer_activations.append(output.clone().detach().cpu().view(output.size(0), -1)))
+                    handle = layer.register_forward_hook(capture_hook)
                     # self.layer_activations.append(output.clone().detach().view(output.size(0), -1)))
                     self.handle_list.append(handle)
 
@@ -122,12 +380,12 @@ class mutual_info_estimator(object):
                 if isinstance(layer, self.modules_to_hook):
                     self.layer_names.append(layer_name)
                     # print('layer name: ', layer_name)
-                    handle = layer.register_forward_hook(
-                        lambda layer, input, output:
-                        self.layer_activations.append(output.clone().detach().cpu().view(output.size(0), -1)))
+                    handle = layer.register_forward_hook(capture_hook)
                     # self.layer_activations.append(output.clone().detach().view(output.size(0), -1)))
                     self.handle_list.append(handle)
 
+        self.hooked_layer_names = list(self.layer_names)
+
         """
         named_children， hook的bug之源
         """
@@ -140,145 +398,85 @@ class mutual_info_estimator(object):
         #                 # 保存handle对象， 方便随时取消hook
         #                 handle_list.append(handle)
 
+    def get_MI_config(self):
+        # calculate_layer_MI 需要的全部设置, 只包含可以 pickle 的简单对象, 方便发送到进程池
+        return {'Label_Num': self.Label_Num,
+                'DO_LOWER': self.DO_LOWER,
+                'DO_UPPER': self.DO_UPPER,
+                'DO_BIN': self.DO_BIN,
+                'Enable_Detail': self.Enable_Detail,
+                'KDE_Tile_Size': self.KDE_Tile_Size,
+                'KDE_Memory_Budget': self.KDE_Memory_Budget,
+                'Noise_Variance': self.Noise_Variance,
+                'Noise_Variance_L': self.Noise_Variance_L,
+                'Bin_Engine': self.Bin_Engine,
+                'Bin_Single_Pass': self.Bin_Single_Pass,
+                }
+
+    def get_executor(self):
+        if self.executor is None:
+            if self.MI_Executor == 'process':
+                import torch.multiprocessing as mp
+                # 每个进程分到的 intra-op 线程数, 避免 MI_Workers 个进程各自占满所有核
+                num_threads = max(1, (os.cpu_count() or 1) // self.MI_Workers)
+                self.executor = ProcessPoolExecutor(max_workers=self.MI_Workers,
+                                                    mp_context=mp.get_context('spawn'),
+                                                    initializer=init_MI_worker,
+                                                    initargs=(num_threads,))
+            elif self.MI_Executor == 'thread':
+                self.executor = ThreadPoolExecutor(max_workers=self.MI_Workers)
+            else:
+                raise RuntimeError('Unknown MI_Executor: %s' % self.MI_Executor)
+        return self.executor
+
+    def shutdown_executor(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
     def caculate_MI(self, X, Y):
+        self.synchronize()
         layer_activations = self.layer_activations
         print("---> caculate_MI, layer activations size[%d],sample num[%d] <---" % (len(layer_activations),
                                                                                     layer_activations[0].size(0)))
-
-        MI_hM_X_lower = []
-        MI_hM_Y_lower = []
-        """
-        如果不做细致的分析，MI_hM_Y_upper 列表中每一个元素都是每一层神经网络的互信息值
-        """
-        MI_hM_Y_lower_detail = []
-
-        MI_hM_X_upper = []
-        MI_hM_Y_upper = []
-
-        MI_hM_X_bin = []
-        MI_hM_Y_bin = []
-
-        # MI_hM_X_mine = []
-        # MI_hM_Y_mine = []
-
-        label_num = self.Label_Num
-        noise_variance = 0.1
-        nats2bits = 1.0 / np.log(2)
-        # print("layer_activations len", len(layer_activations))
-
-        """
-        获取标签Y中label_i的经验概率
-        """
-        Y_one_hot = F.one_hot(Y, num_classes=label_num).float().to(Y.device)
-        Y_probs = torch.mean(Y_one_hot, dim=0)
-
-        """
-        获取标签Y中等于label_i的下标集合, pytorch中的tensor可以使用布尔索引,布尔索引中的元素要为布尔值
-        """
-        Y_i_idx = []
-        for i in range(label_num):
-            Y_equal_label_i_index = torch.flatten(Y == i)
-            Y_i_idx.append(Y_equal_label_i_index)
-
-        saved_label_idx = {}
-        for idx, value in enumerate(Y_i_idx):
-            saved_label_idx[idx] = value.clone().detach().cpu().numpy()
-
-        for layer_idx, layer_i_activations in enumerate(layer_activations):
-            layer_i_lower_detail = []
-            # -------- I(T;X), I(T;Y)  MINE --------
-            """
-            实践证明， MINE的效果非常不理想，超参数， 神经网络的设置是一个让人很头疼的问题
-            """
-            # if self.DO_MINE:
-            #     MI_hM_X_mine_i = calculate_MI_MINE(layer_i_activations, X)
-            #     MI_hM_Y_mine_i = calculate_MI_MINE(layer_i_activations, Y)
-            #     MI_hM_X_mine.append(nats2bits * MI_hM_X_mine_i)
-            #     MI_hM_Y_mine.append(nats2bits * MI_hM_Y_mine_i)
-
-            """
-            -------- I(T;X), I(T;Y)  binning --------
-            """
-            if self.DO_BIN:
-                """
-                为什么实验结果绘制出的各层的信息变化曲线是平行线且几乎重合在一起呢， 是因为
-                几乎每一层的 H_LAYER =ln(batch_size) , ln(100) = 4.605..8809,即每一个批次中所有结果是等概率出现的， 概率为 1/batch_size
-                另外 H_LAYER_GIVEN_OUTPUT 约等于 ln(batch_size/category_of_label) ,当 batch_size =100, category_of_label =10 时
-                H_LAYER_GIVEN_OUTPUT = ln(10)=2.302...
-                """
-                MI_hM_X_bin_layer_i, MI_hM_Y_bin_layer_i = bin_calc_information2(saved_label_idx,
-                                                                                 layer_i_activations.cpu().numpy(),
-                                                                                 0.5)
-                # MI_hM_X_bin.append(MI_hM_X_bin_layer_i)
-                # MI_hM_Y_bin.append(MI_hM_Y_bin_layer_i)
-                MI_hM_X_bin.append(nats2bits * MI_hM_X_bin_layer_i)
-                MI_hM_Y_bin.append(nats2bits * MI_hM_Y_bin_layer_i)
-
-            """
-            -------- I(T;X), I(T;Y) lower  --------
-            """
-            # 最后一层输出 \hat{y} 也可以直接使用KDE来计算互信息, 因为 \hat{y} 仅仅只是预测值,不是真实的标签 y, 自然也可以当成隐藏层来计算互信息
-
-            hM_given_X = kde_multivariate_gauss_entropy(layer_i_activations, noise_variance)
-
-            if self.DO_LOWER:
-                # -------- I(T;X) lower --------
-                hM_lower = entropy_estimator_bd(layer_i_activations, noise_variance)
-                MI_hM_X_lower.append(nats2bits * (hM_lower - hM_given_X))
-
-                # -------- I(T;Y) lower --------
-                hM_given_Y_lower = 0.
-                for y_i in range(label_num):
-                    """
-                    依次选择激活层i中有关于标签j的激活值， 并计算这部分激活值的的互信息
-                    """
-                    # 获取第i层激活值关于标签i的部分， 使用bool索引
-
-                    activation_i_for_Y_i = layer_i_activations[Y_i_idx[y_i], :]
-                    hM_given_Y_i_lower = entropy_estimator_bd(activation_i_for_Y_i, noise_variance)
-                    hM_given_Y_lower += Y_probs[y_i].item() * hM_given_Y_i_lower
-
-                    # 存储 H(T|y) 的信息 以及 p(y) 的概率
-                    # 这里感觉没必要把各个类别出现的经验概率值记录下来
-                    # layer_i_lower_detail.append(Y_probs[y_i].item())
-                    if self.Enable_Detail:
-                        layer_i_lower_detail.append(nats2bits * hM_given_Y_i_lower)
-                if self.Enable_Detail:
-                    layer_i_lower_detail.append(nats2bits * hM_lower)
-                MI_hM_Y_lower.append(nats2bits * (hM_lower - hM_given_Y_lower))
-                if self.Enable_Detail:
-                    MI_hM_Y_lower_detail.append(layer_i_lower_detail)
-
-            # -------- I(T;X), I(T;Y)  upper  --------
-            if self.DO_UPPER:
-                # -------- I(T;X) upper --------
-                hM_upper = entropy_estimator_kl_simple(layer_i_activations, noise_variance)
-                MI_hM_X_upper.append(nats2bits * (hM_upper - hM_given_X))
-
-                # -------- I(T;Y) upper --------
-                hM_given_Y_upper = 0.
-                for y_i in range(label_num):
-                    """
-                    依次选择激活层i中有关于标签j的激活值， 并计算这部分激活值的的互信息
-                    """
-                    # 获取第i层激活值关于标签i的部分， 使用bool索引
-                    activation_i_for_Y_i = layer_i_activations[Y_i_idx[y_i], :]
-                    hM_given_Y_i_upper = entropy_estimator_kl_simple(activation_i_for_Y_i, noise_variance)
-                    hM_given_Y_upper += Y_probs[y_i].item() * hM_given_Y_i_upper
-
-                MI_hM_Y_upper.append(nats2bits * (hM_upper - hM_given_Y_upper))
-        # 在计算完所有层的互信息之后，临时存储所有结果
-        if self.DO_BIN:
-            self.epoch_i_MI_hM_X_bin = MI_hM_X_bin
-            self.epoch_i_MI_hM_Y_bin = MI_hM_Y_bin
-        if self.DO_UPPER:
-            self.epoch_i_MI_hM_X_upper = MI_hM_X_upper
-            self.epoch_i_MI_hM_Y_upper = MI_hM_Y_upper
-        if self.DO_LOWER:
-            self.epoch_i_MI_hM_X_lower = MI_hM_X_lower
-            self.epoch_i_MI_hM_Y_lower = MI_hM_Y_lower
-
-            self.epoch_i_MI_hM_Y_lower_detail = MI_hM_Y_lower_detail
+        config = self.get_MI_config()
+        if self.MI_Workers > 0:
+            executor = self.get_executor()
+            Y = Y.cpu()
+            if self.MI_Executor == 'process':
+                # 激活值通过共享内存传给子进程, 只 pickle 共享内存的句柄, 不复制数据;
+                # arena 在 begin_capture 时已经分配在共享内存中, 这里对它们什么都不做
+                Y.share_memory_()
+                layer_activations = [item.share_memory_() for item in layer_activations]
+            # 每一层的 binning 和 KDE (上下界共享一个距离矩阵) 分别作为一个任务, 结果按层的顺序收集
+            futures = [[executor.submit(calculate_layer_MI, layer_i_activations, Y, config, part)
+                        for part in ('bin', 'kde')]
+                       for layer_i_activations in layer_activations]
+            layer_results = []
+            for layer_futures in futures:
+                layer_result = {}
+                for future in layer_futures:
+                    layer_result.update(future.result())
+                layer_results.append(layer_result)
+        else:
+            layer_results = [calculate_layer_MI(layer_i_activations, Y, config)
+                             for layer_i_activations in layer_activations]
+
+        # 在计算完所有层的互信息之后，临时存储所有结果, 没有开启的项目保持为空列表
+        def collect(key):
+            return [r[key] for r in layer_results if key in r]
+
+        self.epoch_i_MI_hM_X_bin = collect('MI_hM_X_bin')
+        self.epoch_i_MI_hM_Y_bin = collect('MI_hM_Y_bin')
+        self.epoch_i_MI_hM_X_upper = collect('MI_hM_X_upper')
+        self.epoch_i_MI_hM_Y_upper = collect('MI_hM_Y_upper')
+        self.epoch_i_MI_hM_X_lower = collect('MI_hM_X_lower')
+        self.epoch_i_MI_hM_Y_lower = collect('MI_hM_Y_lower')
+        self.epoch_i_MI_hM_Y_lower_detail = collect('MI_hM_Y_lower_detail')
+        self.epoch_i_MI_hM_X_upper_sweep = collect('MI_hM_X_upper_sweep')
+        self.epoch_i_MI_hM_Y_upper_sweep = collect('MI_hM_Y_upper_sweep')
+        self.epoch_i_MI_hM_X_lower_sweep = collect('MI_hM_X_lower_sweep')
+        self.epoch_i_MI_hM_Y_lower_sweep = collect('MI_hM_Y_lower_sweep')
         # if self.DO_MINE:
         #     self.epoch_i_MI_hM_X_mine = MI_hM_X_mine
         #     self.epoch_i_MI_hM_Y_mine = MI_hM_Y_mine
@@ -294,3 +492,168 @@ class mutual_info_estimator(object):
             self.epoch_MI_hM_X_lower.append(self.epoch_i_MI_hM_X_lower)
             self.epoch_MI_hM_Y_lower.append(self.epoch_i_MI_hM_Y_lower)
             self.epoch_MI_hM_Y_lower_detail.append(self.epoch_i_MI_hM_Y_lower_detail)
+        if self.Noise_Variance_L is not None:
+            self.epoch_MI_hM_X_upper_sweep.append(self.epoch_i_MI_hM_X_upper_sweep)
+            self.epoch_MI_hM_Y_upper_sweep.append(self.epoch_i_MI_hM_Y_upper_sweep)
+            self.epoch_MI_hM_X_lower_sweep.append(self.epoch_i_MI_hM_X_lower_sweep)
+            self.epoch_MI_hM_Y_lower_sweep.append(self.epoch_i_MI_hM_Y_lower_sweep)
+
+    def get_epoch_i_MI(self):
+        # 当前 epoch 的全部互信息结果 (只含 list, 可以 pickle), 用于在进程之间传递
+        return {name: getattr(self, name) for name in EPOCH_I_MI_NAMES}
+
+    def set_epoch_i_MI(self, epoch_i_MI):
+        # 与 get_epoch_i_MI 对应, 设置之后再调用 store_MI 即可把结果加入 epoch 列表
+        for name in EPOCH_I_MI_NAMES:
+            setattr(self, name, epoch_i_MI[name])
+
+
+def init_MI_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def get_kde_plan(layer_i_activations, config):
+    if config['KDE_Tile_Size'] is not None or config['KDE_Memory_Budget'] is not None:
+        return kde_tiled_plan(layer_i_activations, config['KDE_Tile_Size'], config['KDE_Memory_Budget'])
+    return kde_distance_plan(layer_i_activations)
+
+
+def calculate_layer_MI(layer_i_activations, Y, config, part='all'):
+    """
+    计算某一层的 binning/KDE 互信息, 返回一个字典, 键为 mutual_info_estimator 中 epoch_i_* 列表对应的名字.
+    part = 'bin' 只做 binning, part = 'kde' 只做 KDE 上下界, part = 'all' 两者都做.
+    这是一个模块级别的函数, 只依赖参数, 可以直接提交给进程池或线程池.
+    """
+    result = {}
+    label_num = config['Label_Num']
+    noise_variance = config['Noise_Variance']
+    noise_variance_L = config['Noise_Variance_L']
+    nats2bits = 1.0 / np.log(2)
+
+    """
+    获取标签Y中label_i的经验概率
+    """
+    Y_one_hot = F.one_hot(Y, num_classes=label_num).float().to(Y.device)
+    Y_probs = torch.mean(Y_one_hot, dim=0)
+
+    """
+    获取标签Y中等于label_i的下标集合, pytorch中的tensor可以使用布尔索引,布尔索引中的元素要为布尔值
+    """
+    Y_i_idx = []
+    for i in range(label_num):
+        Y_equal_label_i_index = torch.flatten(Y == i)
+        Y_i_idx.append(Y_equal_label_i_index)
+
+    # -------- I(T;X), I(T;Y)  MINE --------
+    """
+    实践证明， MINE的效果非常不理想，超参数， 神经网络的设置是一个让人很头疼的问题
+    """
+    # if self.DO_MINE:
+    #     MI_hM_X_mine_i = calculate_MI_MINE(layer_i_activations, X)
+    #     MI_hM_Y_mine_i = calculate_MI_MINE(layer_i_activations, Y)
+    #     MI_hM_X_mine.append(nats2bits * MI_hM_X_mine_i)
+    #     MI_hM_Y_mine.append(nats2bits * MI_hM_Y_mine_i)
+
+    """
+    -------- I(T;X), I(T;Y)  binning --------
+    """
+    if config['DO_BIN'] and part in ('all', 'bin'):
+        """
+        为什么实验结果绘制出的各层的信息变化曲线是平行线且几乎重合在一起呢， 是因为
+        几乎每一层的 H_LAYER =ln(batch_size) , ln(100) = 4.605..8809,即每一个批次中所有结果是等概率出现的， 概率为 1/batch_size
+        另外 H_LAYER_GIVEN_OUTPUT 约等于 ln(batch_size/category_of_label) ,当 batch_size =100, category_of_label =10 时
+        H_LAYER_GIVEN_OUTPUT = ln(10)=2.302...
+        """
+        saved_label_idx = {}
+        for idx, value in enumerate(Y_i_idx):
+            saved_label_idx[idx] = value.clone().detach().cpu().numpy()
+
+        # numpy 没有 bfloat16, 只有这种情况需要转成 float32; float16 的 floor(x / 0.5) 是精确的, 不需要转换
+        layer_i_data = layer_i_activations.cpu()
+        if layer_i_data.dtype == torch.bfloat16:
+            layer_i_data = layer_i_data.float()
+        MI_hM_X_bin_layer_i, MI_hM_Y_bin_layer_i = bin_calc_information2(saved_label_idx,
+                                                                         layer_i_data.numpy(),
+                                                                         0.5,
+                                                                         engine=config['Bin_Engine'],
+                                                                         single_pass=config['Bin_Single_Pass'])
+        result['MI_hM_X_bin'] = nats2bits * MI_hM_X_bin_layer_i
+        result['MI_hM_Y_bin'] = nats2bits * MI_hM_Y_bin_layer_i
+
+    if part not in ('all', 'kde'):
+        return result
+
+    """
+    -------- I(T;X), I(T;Y) lower  --------
+    """
+    # 最后一层输出 \hat{y} 也可以直接使用KDE来计算互信息, 因为 \hat{y} 仅仅只是预测值,不是真实的标签 y, 自然也可以当成隐藏层来计算互信息
+
+    hM_given_X = kde_multivariate_gauss_entropy(layer_i_activations, noise_variance)
+
+    # 每一层只计算一次 N*N 距离矩阵, 上下界以及各个类别的条件熵都从这个矩阵中切片/缩放得到
+    if config['DO_LOWER'] or config['DO_UPPER'] or noise_variance_L is not None:
+        plan = get_kde_plan(layer_i_activations, config)
+
+    if config['DO_LOWER']:
+        layer_i_lower_detail = []
+        # -------- I(T;X) lower --------
+        hM_lower = plan.entropy_bd(noise_variance)
+        result['MI_hM_X_lower'] = nats2bits * (hM_lower - hM_given_X)
+
+        # -------- I(T;Y) lower --------
+        hM_given_Y_lower = 0.
+        for y_i in range(label_num):
+            """
+            依次选择激活层i中有关于标签j的激活值， 并计算这部分激活值的的互信息
+            """
+            # 获取第i层激活值关于标签i的部分， 使用bool索引在距离矩阵上切片
+
+            hM_given_Y_i_lower = plan.entropy_bd(noise_variance, idx=Y_i_idx[y_i])
+            hM_given_Y_lower += Y_probs[y_i].item() * hM_given_Y_i_lower
+
+            # 存储 H(T|y) 的信息 以及 p(y) 的概率
+            # 这里感觉没必要把各个类别出现的经验概率值记录下来
+            # layer_i_lower_detail.append(Y_probs[y_i].item())
+            if config['Enable_Detail']:
+                layer_i_lower_detail.append(nats2bits * hM_given_Y_i_lower)
+        if config['Enable_Detail']:
+            layer_i_lower_detail.append(nats2bits * hM_lower)
+        result['MI_hM_Y_lower'] = nats2bits * (hM_lower - hM_given_Y_lower)
+        if config['Enable_Detail']:
+            result['MI_hM_Y_lower_detail'] = layer_i_lower_detail
+
+    # -------- I(T;X), I(T;Y)  upper  --------
+    if config['DO_UPPER']:
+        # -------- I(T;X) upper --------
+        hM_upper = plan.entropy_kl(noise_variance)
+        result['MI_hM_X_upper'] = nats2bits * (hM_upper - hM_given_X)
+
+        # -------- I(T;Y) upper --------
+        hM_given_Y_upper = 0.
+        for y_i in range(label_num):
+            """
+            依次选择激活层i中有关于标签j的激活值， 并计算这部分激活值的的互信息
+            """
+            # 获取第i层激活值关于标签i的部分， 使用bool索引在距离矩阵上切片
+            hM_given_Y_i_upper = plan.entropy_kl(noise_variance, idx=Y_i_idx[y_i])
+            hM_given_Y_upper += Y_probs[y_i].item() * hM_given_Y_i_upper
+
+        result['MI_hM_Y_upper'] = nats2bits * (hM_upper - hM_given_Y_upper)
+
+    # -------- I(T;X), I(T;Y) upper/lower, 一组噪声方差 --------
+    if noise_variance_L is not None:
+        hM_given_X_sweep = kde_multivariate_gauss_entropy(layer_i_activations,
+                                                          np.asarray(noise_variance_L, dtype=np.float64))
+        hM_upper_sweep, hM_lower_sweep = plan.entropy_sweep(noise_variance_L)
+        hM_given_Y_upper_sweep = 0.
+        hM_given_Y_lower_sweep = 0.
+        for y_i in range(label_num):
+            hM_given_Y_i_upper_sweep, hM_given_Y_i_lower_sweep = plan.entropy_sweep(noise_variance_L,
+                                                                                     idx=Y_i_idx[y_i])
+            hM_given_Y_upper_sweep += Y_probs[y_i].item() * hM_given_Y_i_upper_sweep
+            hM_given_Y_lower_sweep += Y_probs[y_i].item() * hM_given_Y_i_lower_sweep
+        result['MI_hM_X_upper_sweep'] = (nats2bits * (hM_upper_sweep - hM_given_X_sweep)).tolist()
+        result['MI_hM_Y_upper_sweep'] = (nats2bits * (hM_upper_sweep - hM_given_Y_upper_sweep)).tolist()
+        result['MI_hM_X_lower_sweep'] = (nats2bits * (hM_lower_sweep - hM_given_X_sweep)).tolist()
+        result['MI_hM_Y_lower_sweep'] = (nats2bits * (hM_lower_sweep - hM_given_Y_lower_sweep)).tolist()
+    return result
@@ -21,6 +21,7 @@ import datetime
 from MI_estimator import mutual_info_estimator
 from utils import *
 from torchattacks import PGD
+from attack_manager import attack_manager, stage_timer
 import pickle
 import torch.nn.functional as F
 
@@ -185,7 +186,7 @@ class DeepVIB(nn.Module):
 
 class Train_VIB(object):
     # Device Config
-    def __init__(self, ):
+    def __init__(self, AMP='none'):
         self.Device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         self.beta = 1e-3
@@ -199,17 +200,27 @@ class Train_VIB(object):
         self.Model_Name = 'VIB'
         self.Forward_Size = 1000
         self.Forward_Repeat = 5
+        # 混合精度: 'none' / 'fp16' (cuda) / 'bf16', 由 --AMP 指定
+        self.AMP = AMP
 
         self.Model = DeepVIB(1 * 28 * 28, self.n_classes, self.z_dim)
 
         self.Train_loader, self.Test_Loader = self.get_train_test_data()
+        # PGD_VIB 按 (模型, 参数) 缓存, 不再每个 batch 重新构造; Timer 记录每个 epoch 各阶段的耗时
+        self.Timer = stage_timer()
+        self.Attacks = attack_manager(self.Timer, Autocast=self.amp_context)
+
+    def amp_context(self):
+        return get_autocast(self.Device, self.AMP)
 
     def train_attack(self, Model, Random_Start=False):
-        atk = PGD_VIB(Model, eps=45 / 255, alpha=9 / 255, steps=7, vib_beta=1e-3, random_start=Random_Start)
+        atk = self.Attacks.get_attack(Model, PGD_VIB, eps=45 / 255, alpha=9 / 255, steps=7, vib_beta=1e-3,
+                                      random_start=Random_Start)
         return atk
 
     def test_attack(self, Model, Random_Start=False):
-        atk = PGD_VIB(Model, eps=45 / 255, alpha=9 / 255, steps=7, vib_beta=1e-3, random_start=Random_Start)
+        atk = self.Attacks.get_attack(Model, PGD_VIB, eps=45 / 255, alpha=9 / 255, steps=7, vib_beta=1e-3,
+                                      random_start=Random_Start)
         return atk
 
     @torch.no_grad()
@@ -224,7 +235,7 @@ class Train_VIB(object):
 
         else:
             with torch.enable_grad():
-                adv_images = atk(batch_images, batch_labels)
+                adv_images = self.Attacks.perturb('test', atk, batch_images, batch_labels)
                 return adv_images, batch_labels
 
     def get_train_test_data(self):
@@ -276,8 +287,10 @@ class Train_VIB(object):
 
         for i in range(self.Forward_Repeat):
             images, labels = self.get_clean_or_adv_image(Model, Keep_Clean)
-            # 模型输出 logits, mu, std
-            outputs, mu, std = Model(images)
+            # 模型输出 logits, mu, std; 互信息的上下界在 float32 下计算
+            with self.amp_context():
+                outputs, mu, std = Model(images)
+            outputs, mu, std = outputs.float(), mu.float(), std.float()
             # 使用模型的三个输出来计算互信息的上下界, 还有loss
             izy_lower_bound_i, izx_upper_bound_i, loss_i = vib_loss_function(outputs, labels, mu, std, self.beta)
 
@@ -313,6 +326,7 @@ class Train_VIB(object):
         # Optimizer
         optimizer = torch.optim.Adam(vib.parameters(), lr=self.learning_rate)
         scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer=optimizer, gamma=self.decay_rate)
+        scaler = get_grad_scaler(self.Device, self.AMP)
 
         # Training
         from collections import defaultdict
@@ -322,6 +336,7 @@ class Train_VIB(object):
         for epoch in range(self.epochs):
             # TODO: 对抗训练和普通训练
             # TODO 在对抗样本和正常样本上的互信息.
+            eval_start = self.Timer.now()
             mi_loss_acc_i_std = self.calculate_acc_and_mutual_info(vib, Keep_Clean=True)
             measures['izy_test_std'].append(mi_loss_acc_i_std['izy'])
             measures['izx_test_std'].append(mi_loss_acc_i_std['izx'])
@@ -333,6 +348,8 @@ class Train_VIB(object):
             measures['izx_test_adv'].append(mi_loss_acc_i_adv['izx'])
             measures['loss_test_adv'].append(mi_loss_acc_i_adv['loss'])
             measures['acc_test_adv'].append(mi_loss_acc_i_adv['acc'])
+            # eval 的耗时包含其中 attack_test 的耗时
+            self.Timer.add('eval', self.Timer.now() - eval_start)
             epoch_start_time = time.time()
 
             # exponential decay of learning rate every 2 epochs
@@ -343,25 +360,32 @@ class Train_VIB(object):
             acc_N = 0
             sample_N = 0
             izy_lower_bound_total, izx_upper_bound_total = 0., 0.
+            batch_start = self.Timer.now()
             for _, (X, y) in enumerate(self.Train_loader):
                 X = X.to(self.Device)
                 y = y.to(self.Device)
+                self.Timer.add('data', self.Timer.now() - batch_start)
 
                 if Enable_Adv_Training:
                     atk = self.train_attack(Model=vib, Random_Start=True)
-                    X = atk(X, y)
+                    X = self.Attacks.perturb('train', atk, X, y)
 
+                step_start = self.Timer.now()
                 # forward pass through Deep VIB
-                y_pred, mu, std = vib(X)
+                with self.amp_context():
+                    y_pred, mu, std = vib(X)
 
                 # Calculate loss
-                izy_lower_bound, izx_upper_bound, loss = vib_loss_function(y_pred, y, mu, std, self.beta)
+                izy_lower_bound, izx_upper_bound, loss = vib_loss_function(y_pred.float(), y, mu.float(), std.float(),
+                                                                           self.beta)
                 # Backpropagation: calculating gradients
-                loss.backward()
+                scaler.scale(loss).backward()
                 # Update parameters of generator
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 # Zero accumulated gradients
                 vib.zero_grad()
+                self.Timer.add('train_step', self.Timer.now() - step_start)
 
                 # save mutual info per batch
                 izy_lower_bound_total += izy_lower_bound.item()
@@ -372,6 +396,7 @@ class Train_VIB(object):
                 y_pred = torch.argmax(y_pred, dim=1)
                 acc_N += y_pred.eq(y.data).cpu().sum().item()
                 sample_N += y.size(0)
+                batch_start = self.Timer.now()
             # 在验证集上检验acc, loss,MI
 
             # Save average mutual info per epoch
@@ -388,6 +413,9 @@ class Train_VIB(object):
                   "Ave Loss: [%.2f] " % (measures['loss_train'][-1]),
                   "Accuracy: [%.2f%%] " % (measures['acc_train'][-1]),
                   "Time Taken: [%.2f] seconds " % (time.time() - epoch_start_time))
+            print("Epoch: [%d] timing: %s" % (epoch + 1, self.Timer.summary(self.Attacks.get_step_time())))
+            self.Timer.reset()
+            self.Attacks.reset_steps()
 
         print("Total Time Taken: [%.2f] seconds" % (time.time() - start_time))
 
@@ -511,7 +539,13 @@ class Train_VIB(object):
 
 
 if __name__ == '__main__':
-    train_0 = Train_VIB()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='VIB')
+    parser.add_argument('--AMP', default='none', type=str, choices=['none', 'fp16', 'bf16'],
+                        help='混合精度训练/评估/PGD, fp16 只能在 cuda 上使用 (带 loss scaling), cpu 上使用 bf16')
+    args = parser.parse_args()
+    train_0 = Train_VIB(AMP=args.AMP)
     # train_0.train_vib(Enable_Adv_Training=False)
     # train_0.train_vib(Enable_Adv_Training=True)
     train_0.plot_data(Enable_Adv_Training=False)
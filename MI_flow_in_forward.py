@@ -8,11 +8,16 @@ from torchvision import datasets, transforms
 import ModelSet
 from pylab import mpl
 import datetime
-from MI_estimator import mutual_info_estimator
+from MI_estimator import mutual_info_estimator, activation_arena
 from utils import *
 from torchattacks import PGD
 import pickle
 import torch.nn.functional as F
+from adv_cache import adv_example_cache
+from attack_manager import attack_manager, stage_timer
+from batch_transforms import Saturation_Transform, Patch_Transform
+from transfer_matrix import transfer_matrix_accumulator
+from mi_results import save_mi_results, has_mi_results, load_mi_results
 
 
 # mpl.rcParams['savefig.dpi'] = 400  # 保存图片分辨率
@@ -38,11 +43,38 @@ class Forward():
         self.Device = torch.device("cuda:%d" % (args.GPU) if torch.cuda.is_available() else "cpu")
         # 在 forward之前设定一下测试集的装载
         self.Test_Loader = None  # self.get_test_loader(Data_Set)
-        self.std_estimator = mutual_info_estimator(self.Origin_Model.modules_to_hook, By_Layer_Name=False)
-        self.adv_estimator = mutual_info_estimator(self.Origin_Model.modules_to_hook, By_Layer_Name=False)
+        self.std_estimator = mutual_info_estimator(self.Origin_Model.modules_to_hook, By_Layer_Name=False,
+                                                   KDE_Tile_Size=args.KDE_Tile_Size,
+                                                   KDE_Memory_Budget=args.KDE_Memory_Budget,
+                                                   Noise_Variance_L=args.Noise_Variance_L,
+                                                   Bin_Engine=args.Bin_Engine,
+                                                   Bin_Single_Pass=args.Bin_Single_Pass,
+                                                   Capture_Mode=args.Capture_Mode,
+                                                   MI_Workers=args.MI_Workers,
+                                                   MI_Executor=args.MI_Executor,
+                                                   Capture_Dtype=getattr(torch, args.Capture_Dtype))
+        self.adv_estimator = mutual_info_estimator(self.Origin_Model.modules_to_hook, By_Layer_Name=False,
+                                                   KDE_Tile_Size=args.KDE_Tile_Size,
+                                                   KDE_Memory_Budget=args.KDE_Memory_Budget,
+                                                   Noise_Variance_L=args.Noise_Variance_L,
+                                                   Bin_Engine=args.Bin_Engine,
+                                                   Bin_Single_Pass=args.Bin_Single_Pass,
+                                                   Capture_Mode=args.Capture_Mode,
+                                                   MI_Workers=args.MI_Workers,
+                                                   MI_Executor=args.MI_Executor,
+                                                   Capture_Dtype=getattr(torch, args.Capture_Dtype))
+        # 评估时图片 (slot 0) 和标签 (slot 1) 的缓冲区, 与激活值一样只分配一次
+        self.data_arena = activation_arena(self.Forward_Size * self.Forward_Repeat)
         self.Patch_Split_L = [0, 2, 4, 8]  # 0
         self.Saturation_L = [2, 8, 16, 64, 1024]  # 2
         self.Loss_Acc = None
+        # 对抗样本磁盘缓存, 开启后使用固定的测试子集, 第一次使用时创建
+        self.Eval_Set = None
+        self.Adv_Cache = None if args.Adv_Cache == 'none' else adv_example_cache(Storage=args.Adv_Cache)
+        self.Adv_Images = None
+        # 攻击对象按 (模型, 参数) 缓存, 每个 level 不再重新构造
+        self.Timer = stage_timer(Synchronize=args.Sync_Timing)
+        self.Attacks = attack_manager(self.Timer, Autocast=self.amp_context)
 
     def get_test_loader(self):
         # 全局取消证书验证
@@ -154,15 +186,21 @@ class Forward():
         Test_Loader = DataLoader(dataset=test_dataset, batch_size=self.Forward_Size, shuffle=True)
         return Test_Loader
 
+    def amp_context(self):
+        # --AMP 不为 none 时 forward 在 autocast 中进行, 包括 PGD 中的每一步
+        return get_autocast(self.Device, self.Args.AMP)
+
     def train_attack(self, Model, Random_Start=False):
         # atk = PGD(Model, eps=args.Eps, alpha=args.Eps * 1.2 / 7, steps=7, random_start=Random_Start)
-        atk = PGD(Model, eps=self.Args.Eps, alpha=self.Args.Alpha, steps=self.Args.Step, random_start=Random_Start)
+        atk = self.Attacks.get_attack(Model, PGD, eps=self.Args.Eps, alpha=self.Args.Alpha, steps=self.Args.Step,
+                                      random_start=Random_Start)
         # atk = PGD(Model, eps=30 / 255, alpha=5 / 255, steps=7, random_start=Random_Start)
         return atk
 
     def test_attack(self, Model, Random_Start=False):
         # atk = PGD(Model, eps=args.Eps, alpha=args.Eps * 1.2 / 7, steps=7, random_start=Random_Start)
-        atk = PGD(Model, eps=self.Args.Eps, alpha=self.Args.Alpha, steps=self.Args.Step, random_start=Random_Start)
+        atk = self.Attacks.get_attack(Model, PGD, eps=self.Args.Eps, alpha=self.Args.Alpha, steps=self.Args.Step,
+                                      random_start=Random_Start)
         # atk = PGD(Model, eps=12 / 255, alpha=3 / 255, steps=7, random_start=Random_Start)
         # atk = PGD(Model, eps=16 / 255, alpha=4 / 255, steps=7, random_start=Random_Start)
         # atk = PGD(Model, eps=30 / 255, alpha=5 / 255, steps=7, random_start=Random_Start)
@@ -185,11 +223,67 @@ class Forward():
                        'loss_acc': self.Loss_Acc
                        }
 
+        if self.Args.Results_Format == 'columnar':
+            # 估计器的结果保存为稠密的 .npy 数组 (level, layer, ...), 其余的小数据放在 header.json 中
+            header = {key: value for key, value in mi_loss_acc.items() if key not in ('std_estimator', 'adv_estimator')}
+            save_mi_results('./Checkpoint/%s/%s/mi_results_%s' % (Model_Name, Transform_Type, Is_Adv_Training),
+                            {'std': self.std_estimator, 'adv': self.adv_estimator}, header)
+            return
         with open('./Checkpoint/%s/%s/mi_loss_acc_%s.pkl' % (Model_Name, Transform_Type, Is_Adv_Training), 'wb') as f:
             pickle.dump(mi_loss_acc, f)
 
+    def load_mutual_info_data(self, Transform_Type, Is_Adv_Training):
+        # 返回与 save_mutual_info_data 中 mi_loss_acc 相同结构的字典, 优先读取列式存储, 旧数据读取 pickle
+        result_dir = './Checkpoint/%s/%s/mi_results_%s' % (self.Model_Name, Transform_Type, Is_Adv_Training)
+        if has_mi_results(result_dir):
+            header, views = load_mi_results(result_dir)
+            mi_loss_acc = dict(header)
+            mi_loss_acc['std_estimator'], mi_loss_acc['adv_estimator'] = views['std'], views['adv']
+            return mi_loss_acc
+        with open('./Checkpoint/%s/%s/mi_loss_acc_%s.pkl' % (self.Model_Name, Transform_Type, Is_Adv_Training),
+                  'rb') as f:
+            return pickle.load(f)
+
+    def get_eval_set(self):
+        # 对抗样本缓存需要一个固定的测试子集 (dataset 下标固定), 只抽取/解码一次
+        if self.Eval_Set is None:
+            self.Eval_Set = eval_set_cache(self.get_test_loader().dataset, self.Forward_Size * self.Forward_Repeat,
+                                           self.Device, Seed=self.Args.Eval_Seed)
+        return self.Eval_Set
+
+    def get_attack_config(self):
+        # 对抗样本缓存的 key 中包含的攻击参数, 以及攻击时使用的精度 (--AMP 得到的对抗样本与 fp32 的不同)
+        return {'attack': 'PGD', 'eps': self.Args.Eps, 'alpha': self.Args.Alpha, 'steps': self.Args.Step,
+                'random_start': False, 'amp': self.Args.AMP, 'amp_dtype': str(get_amp_dtype(self.Args.AMP))}
+
+    def prepare_adv_set(self, Model):
+        # 模型权重固定时使用: 整个评估子集的对抗样本只生成一次, 或者直接从磁盘缓存中读取
+        if self.Adv_Cache is None:
+            return
+        Model.eval()
+        eval_set = self.get_eval_set()
+        self.Adv_Images = self.Adv_Cache.get_adv_images(Model,
+                                                        eval_set.images.to(self.Device),
+                                                        eval_set.labels.to(self.Device),
+                                                        eval_set.indices,
+                                                        self.test_attack(Model, Random_Start=False),
+                                                        self.get_attack_config(),
+                                                        self.Forward_Size,
+                                                        Attacks=self.Attacks)
+
+    def release_adv_set(self):
+        self.Adv_Images = None
+
     @torch.no_grad()
-    def get_clean_or_adv_image(self, Model, Keep_Clean):
+    def get_clean_or_adv_image(self, Model, Keep_Clean, Repeat_i=0):
+        if self.Adv_Images is not None:
+            # 返回的是缓存的切片, batch_transforms 中的变换都不会原地修改输入
+            batch_images, batch_labels = self.get_eval_set().get_batch(Repeat_i, self.Forward_Size, self.Device)
+            if not Keep_Clean:
+                start = Repeat_i * self.Forward_Size
+                batch_images = self.Adv_Images[start:start + self.Forward_Size]
+            return batch_images, batch_labels
+
         atk = self.test_attack(Model, Random_Start=False)
 
         batch_images, batch_labels = next(iter(self.Test_Loader))
@@ -200,12 +294,11 @@ class Forward():
 
         else:
             with torch.enable_grad():
-                adv_images = atk(batch_images, batch_labels)
+                adv_images = self.Attacks.perturb('test', atk, batch_images, batch_labels)
                 return adv_images, batch_labels
 
     @torch.no_grad()
     def calculate_acc_and_mutual_info(self, Model, Transform_Type, Level, Keep_Clean):
-        import random
         # 这里的epoch_i没必要指定，因为epochi就是列表当中的最后一个元素
         # a = list[-1]就是最后一个元素
         Model.eval()
@@ -214,77 +307,12 @@ class Forward():
         total_N = 0
         loss = 0.
 
-        image_chunk = None
-        label_chunk = None
-        layer_activation_chunk = None
-
-        def Saturation_Transform(batch_images, level=2):
-            '''
-            for each pixel v: v' = sign(2v - 1) * |2v - 1|^{2/p}  * 0.5 + 0.5
-            then clip -> (0, 1)
-            '''
-            p = level * 1.0
-            ones = torch.ones_like(batch_images)
-            # print(img.size(), torch.max(img), torch.min(img))
-            ret_img = torch.sign(2 * batch_images - ones) * torch.pow(torch.abs(2 * batch_images - ones), 2.0 / p)
-
-            ret_img = ret_img * 0.5 + ones * 0.5
-
-            ret_img = torch.clamp(ret_img, 0, 1)
-
-            return ret_img
-
-        def Patch_Transform(batch_images, level=2):
-            '''
-            X: torch.Tensor of shape(c, h, w)   h % self.k == 0
-            :param images:
-            :return:
-            '''
-            # K==0则不分割数据
-            k = level
-            if k == 0:
-                return batch_images
-
-            b, c, h, w = batch_images.size()
-
-            for idx in range(b):
-                patches = []
-                images = batch_images[idx]
-
-                dh = h // k
-                dw = w // k
-
-                # print(dh, dw)
-                sh = 0
-                for i in range(h // dh):
-                    eh = sh + dh
-                    eh = min(eh, h)
-                    sw = 0
-                    for j in range(w // dw):
-                        ew = sw + dw
-                        ew = min(ew, w)
-                        patches.append(images[:, sh:eh, sw:ew])
-
-                        # print(sh, eh, sw, ew)
-                        sw = ew
-                    sh = eh
-
-                random.shuffle(patches)
-
-                start = 0
-                imgs = []
-                for i in range(k):
-                    end = start + k
-                    imgs.append(torch.cat(patches[start:end], dim=1))
-                    start = end
-                img = torch.cat(imgs, dim=2)
-                batch_images[idx] = img
-            return batch_images
-
+        # 整个 batch 一次完成变换, 见 batch_transforms.py
+        # Patch 的随机排列使用固定的 Transform_Seed, 干净样本和对抗样本中同一张图片的块以相同的方式打乱
         if Transform_Type == 'Saturation':
-            Extra_Transform = Saturation_Transform
+            Extra_Transform = Saturation_Transform(saturation_level=Level)
         elif Transform_Type == 'Patch':
-            Extra_Transform = Patch_Transform
+            Extra_Transform = Patch_Transform(k=Level, Seed=self.Args.Transform_Seed)
         else:
             raise RuntimeError('Unknown Transformation')
 
@@ -293,13 +321,18 @@ class Forward():
         else:
             estimator = self.adv_estimator
 
+        # 图片/标签 (slot 0/1) 以及每一层的激活值都原地写入预先分配好的缓冲区, 不再在每一次 repeat 中 torch.cat
+        capacity = self.Forward_Size * self.Forward_Repeat
+        self.data_arena.reset(capacity)
+        estimator.begin_capture(capacity)
+
         for i in range(self.Forward_Repeat):
 
-            batch_images, labels = self.get_clean_or_adv_image(Model, Keep_Clean)
+            batch_images, labels = self.get_clean_or_adv_image(Model, Keep_Clean, Repeat_i=i)
             '''
             对正常样本和对抗样本进行变换
             '''
-            images = Extra_Transform(batch_images, Level)
+            images = Extra_Transform(batch_images)
 
             # labels = labels.to(Device)
             # # print('std_test_size', images.size(0))
@@ -314,8 +347,9 @@ class Forward():
             """
             计算模型的准确率
             """
-            outputs = Model(images)
-            loss_i = F.cross_entropy(outputs, labels)
+            with self.amp_context():
+                outputs = Model(images)
+            loss_i = F.cross_entropy(outputs.float(), labels)
             # predicted_prob, predicted, labels 都可以看成是一个列表或者是一个向量，列表中元素的个数为 batch_size 个
             # 先对神经网络的输出结果做一个 softmax 获取概率值
             # predicted_prob, predicted = torch.max(F.softmax(outputs, dim=1), dim=1)
@@ -328,24 +362,9 @@ class Forward():
             发现并修改了一个重大bug, 这里每forward一次,caculate_MI 函数计算出的互信息值都直接挂在列表的后面，那么 Forward_Repeat 会成倍放大列表的长度
             且会混乱每一个 epoch 中的互信息变化情况，Forward_Repeat 一旦超过 epoch_num ，那么每一个 epoch 的曲线就会
             """
-            # 给定初始值
-            if i == 0:
-                # print("---> layer activations size {} <---".format(layer_activations_size))
-                image_chunk = images.clone().detach()
-                label_chunk = labels.clone().detach()
-                '''
-                注意， 这里如果简单赋值就会出现传递引用的现象，需要手动调用copy,复制列表
-                '''
-                layer_activation_chunk = estimator.layer_activations.copy()
-            # 计算所有循环的和
-            else:
-                image_chunk = torch.cat((image_chunk, images.clone().detach()), dim=0)
-                label_chunk = torch.cat((label_chunk, labels.clone().detach()), dim=0)
-                """
-                这里 layer_activations 是一个 list, list 里的每一个元素时 tesnor (gpu:0)
-                """
-                for idx, item in enumerate(estimator.layer_activations):
-                    layer_activation_chunk[idx] = torch.cat((layer_activation_chunk[idx], item.clone().detach()), dim=0)
+            # 激活值已经由 hook 写入 estimator 的 arena, 这里只需要写入图片和标签
+            self.data_arena.append(0, images)
+            self.data_arena.append(1, labels)
             """
             forward 之后例行收尾工作
             """
@@ -353,13 +372,94 @@ class Forward():
             estimator.clear_activations()
         # 计算存储互信息
         # calculate mutual info
-        estimator.layer_activations = layer_activation_chunk
-        estimator.caculate_MI(image_chunk.cpu(), label_chunk.cpu())
+        estimator.end_capture()
+        estimator.caculate_MI(self.data_arena.get(0).cpu(), self.data_arena.get(1).cpu())
         estimator.store_MI()
 
         acc = correct_N * 100. / total_N
         return acc, loss / self.Forward_Repeat
 
+    def get_sweep_source(self, Model):
+        # 固定的测试子集以及它的对抗样本, 开启 Adv_Cache 时使用调用者已经 prepare_adv_set 得到的对抗样本, 否则在这里生成一次
+        eval_set = self.get_eval_set()
+        clean_images, labels = eval_set.images.to(self.Device), eval_set.labels.to(self.Device)
+        if self.Adv_Images is not None:
+            return clean_images, labels, self.Adv_Images
+        atk = self.test_attack(Model, Random_Start=False)
+        adv_images = torch.empty_like(clean_images)
+        for start in range(0, clean_images.size(0), self.Forward_Size):
+            end = start + self.Forward_Size
+            with torch.enable_grad():
+                adv_images[start:end] = self.Attacks.perturb('test', atk, clean_images[start:end], labels[start:end])
+        return clean_images, labels, adv_images
+
+    @torch.no_grad()
+    def calculate_acc_and_mutual_info_sweep(self, Model, Transform_Type, Level_L, Keep_Clean, source_images, labels):
+        """
+        一遍 forward 同时计算 Level_L 中所有 level 的准确率, loss 和互信息.
+        每一次 forward 把同一块样本的所有 level 的变换结果沿 batch 维度堆叠成 (levels * chunk) 的 batch,
+        hook 再把每一层的输出按 level 切开, 写入该 level 自己的 activation arena.
+        结果按 Level_L 的顺序写入 std_estimator / adv_estimator, 与逐 level 调用 calculate_acc_and_mutual_info 的格式相同.
+        """
+        Model.eval()
+        Level_Num = len(Level_L)
+        # 每个 level 一个变换对象, Patch 的随机数发生器使用相同的 Seed, 干净样本和对抗样本的打乱方式一致
+        if Transform_Type == 'Saturation':
+            Transform_L = [Saturation_Transform(saturation_level=level) for level in Level_L]
+        elif Transform_Type == 'Patch':
+            Transform_L = [Patch_Transform(k=level, Seed=self.Args.Transform_Seed) for level in Level_L]
+        else:
+            raise RuntimeError('Unknown Transformation')
+
+        if Keep_Clean:
+            estimator = self.std_estimator
+        else:
+            estimator = self.adv_estimator
+
+        Sample_Num = source_images.size(0)
+        # 只用来接收各个 level 激活值的估计器, 互信息统一由 estimator 计算
+        level_estimators = [mutual_info_estimator(self.Origin_Model.modules_to_hook, By_Layer_Name=False,
+                                                  Capture_Mode=self.Args.Capture_Mode,
+                                                  Capture_Dtype=getattr(torch, self.Args.Capture_Dtype))
+                            for _ in Level_L]
+        for level_estimator in level_estimators:
+            level_estimator.begin_capture(Sample_Num)
+
+        correct_N = [0 for _ in Level_L]
+        loss = [0. for _ in Level_L]
+        Chunk_Size = max(1, self.Args.Sweep_Batch_Size // Level_Num)
+
+        estimator.clear_activations()
+        estimator.do_forward_hook(Model, level_estimators=level_estimators)
+        for start in range(0, Sample_Num, Chunk_Size):
+            images = source_images[start:start + Chunk_Size]
+            chunk_labels = labels[start:start + Chunk_Size]
+            # 第 level_i 段是第 level_i 个 level 变换之后的图片
+            with self.amp_context():
+                outputs = Model(torch.cat([transform(images) for transform in Transform_L], dim=0))
+            for level_i, level_outputs in enumerate(outputs.float().chunk(Level_Num, dim=0)):
+                loss[level_i] += F.cross_entropy(level_outputs, chunk_labels, reduction='sum').item()
+                correct_N[level_i] += (torch.max(level_outputs, dim=1)[1] == chunk_labels).sum().item()
+            for level_estimator in level_estimators:
+                level_estimator.clear_activations()
+        estimator.cancel_hook()
+        estimator.clear_activations()
+
+        # 计算存储互信息, 每算完一个 level 就释放它的 arena
+        # caculate_MI 的 X 目前只在 (已注释掉的) MINE 中使用, 这里传入变换之前的样本
+        X, Y = source_images.cpu(), labels.cpu()
+        acc_L, loss_L = [], []
+        for level_i, level_estimator in enumerate(level_estimators):
+            level_estimator.end_capture()
+            estimator.layer_activations = level_estimator.layer_activations
+            estimator.caculate_MI(X, Y)
+            estimator.store_MI()
+            estimator.clear_activations()
+            level_estimator.activation_arena = None
+            acc_L.append(correct_N[level_i] * 100. / Sample_Num)
+            loss_L.append(loss[level_i] / Sample_Num)
+        return acc_L, loss_L
+
     def forward(self, Model, Transform_Type, Enable_Adv_Training):
         test_clean_acc_L, test_adv_acc_L = [], []
         test_clean_loss_L, test_adv_loss_L = [], []
@@ -376,6 +476,8 @@ class Forward():
 
         Model = Model.to(self.Device)
         Model.eval()
+        # 开启对抗样本缓存时, 所有 level 共享同一次 PGD 的结果
+        self.prepare_adv_set(Model)
 
         if Transform_Type == 'Saturation':
             Level_L = self.Saturation_L
@@ -384,33 +486,50 @@ class Forward():
         else:
             Level_L = None
 
-        for level in Level_L:
-            # TODO: 这里的工作流程需要变动一下, 应该是先产生样本, 再对样本进行切片和饱和度调整,
-            # 设定好特定的装载程序之后前，在验证集上计算干净样本和对抗样本互信息并且计算准确率
-            self.Test_Loader = self.get_test_loader()
-
-            level_i_test_clean_acc, level_i_test_clean_loss = self.calculate_acc_and_mutual_info(Model,
+        if self.Args.Fused_Sweep:
+            # 干净样本和对抗样本都只生成/装载一次, 所有 level 在同一遍 forward 中完成
+            clean_images, labels, adv_images = self.get_sweep_source(Model)
+            test_clean_acc_L, test_clean_loss_L = self.calculate_acc_and_mutual_info_sweep(Model, Transform_Type,
+                                                                                           Level_L, True,
+                                                                                           clean_images, labels)
+            test_adv_acc_L, test_adv_loss_L = self.calculate_acc_and_mutual_info_sweep(Model, Transform_Type,
+                                                                                       Level_L, False,
+                                                                                       adv_images, labels)
+            for level_i, level in enumerate(Level_L):
+                print('%s level_i[%d] '
+                      'test_clean_loss[%.2f], test_adv_loss[%.2f] '
+                      'test_clean_acc[%.2f%%],test_adv_acc[%.2f%%]'
+                      % (Transform_Type, level,
+                         test_clean_loss_L[level_i], test_adv_loss_L[level_i],
+                         test_clean_acc_L[level_i], test_adv_acc_L[level_i]))
+        else:
+            for level in Level_L:
+                # TODO: 这里的工作流程需要变动一下, 应该是先产生样本, 再对样本进行切片和饱和度调整,
+                # 设定好特定的装载程序之后前，在验证集上计算干净样本和对抗样本互信息并且计算准确率
+                self.Test_Loader = self.get_test_loader()
+
+                level_i_test_clean_acc, level_i_test_clean_loss = self.calculate_acc_and_mutual_info(Model,
+                                                                                                     Transform_Type=Transform_Type,
+                                                                                                     Level=level,
+                                                                                                     Keep_Clean=True)
+                level_i_test_adv_acc, level_i_test_adv_loss = self.calculate_acc_and_mutual_info(Model,
                                                                                                  Transform_Type=Transform_Type,
                                                                                                  Level=level,
-                                                                                                 Keep_Clean=True)
-            level_i_test_adv_acc, level_i_test_adv_loss = self.calculate_acc_and_mutual_info(Model,
-                                                                                             Transform_Type=Transform_Type,
-                                                                                             Level=level,
-                                                                                             Keep_Clean=False)
-            # 在验证集上的干净样本准确率，对抗样本准确率,loss
-            test_clean_acc_L.append(level_i_test_clean_acc)
-            test_adv_acc_L.append(level_i_test_adv_acc)
-
-            test_clean_loss_L.append(level_i_test_clean_loss)
-            test_adv_loss_L.append(level_i_test_adv_loss)
-
-            # print some data
-            print('%s level_i[%d] '
-                  'test_clean_loss[%.2f], test_adv_loss[%.2f] '
-                  'test_clean_acc[%.2f%%],test_adv_acc[%.2f%%]'
-                  % (Transform_Type, level,
-                     level_i_test_clean_loss, level_i_test_adv_loss,
-                     level_i_test_clean_acc, level_i_test_adv_acc))
+                                                                                                 Keep_Clean=False)
+                # 在验证集上的干净样本准确率，对抗样本准确率,loss
+                test_clean_acc_L.append(level_i_test_clean_acc)
+                test_adv_acc_L.append(level_i_test_adv_acc)
+
+                test_clean_loss_L.append(level_i_test_clean_loss)
+                test_adv_loss_L.append(level_i_test_adv_loss)
+
+                # print some data
+                print('%s level_i[%d] '
+                      'test_clean_loss[%.2f], test_adv_loss[%.2f] '
+                      'test_clean_acc[%.2f%%],test_adv_acc[%.2f%%]'
+                      % (Transform_Type, level,
+                         level_i_test_clean_loss, level_i_test_adv_loss,
+                         level_i_test_clean_acc, level_i_test_adv_acc))
 
         loss_acc = {
             'test_clean_loss': test_clean_loss_L,
@@ -420,6 +539,10 @@ class Forward():
         }
         # plot_performance(analytic_data, Enable_Adv_Training)
         self.Loss_Acc = loss_acc
+        self.release_adv_set()
+        print('--> %s timing: %s' % (Transform_Type, self.Timer.summary(self.Attacks.get_step_time())))
+        self.Timer.reset()
+        self.Attacks.clear()
         '''
         在保存数据之前，一定要清除layer_activations, layer_activations数据量真的太大了 
         '''
@@ -450,8 +573,7 @@ class Forward():
         import math
         Is_Adv_Training = 'Adv_Train' if Enable_Adv_Training else 'Std_Train'
         Model_Name = self.Model_Name
-        with open('./Checkpoint/%s/%s/mi_loss_acc_%s.pkl' % (Model_Name, Transform_Type, Is_Adv_Training), 'rb') as f:
-            mi_loss_acc = pickle.load(f)
+        mi_loss_acc = self.load_mutual_info_data(Transform_Type, Is_Adv_Training)
 
         Forward_Size, Forward_Repeat = mi_loss_acc['Forward_Size'], mi_loss_acc['Forward_Repeat']
         std, adv = mi_loss_acc['std_estimator'], mi_loss_acc['adv_estimator']
@@ -666,20 +788,16 @@ class Forward():
         Is_Adv_Training = 'Std_Train'
         Model_Name = self.Model_Name
         Transform_Type = 'Saturation'
-        with open('./Checkpoint/%s/%s/mi_loss_acc_%s.pkl' % (Model_Name, Transform_Type, Is_Adv_Training), 'rb') as f:
-            st_saturation_mi_loss_acc = pickle.load(f)
+        st_saturation_mi_loss_acc = self.load_mutual_info_data(Transform_Type, Is_Adv_Training)
         Transform_Type = 'Patch'
-        with open('./Checkpoint/%s/%s/mi_loss_acc_%s.pkl' % (Model_Name, Transform_Type, Is_Adv_Training), 'rb') as f:
-            st_patch_mi_loss_acc = pickle.load(f)
+        st_patch_mi_loss_acc = self.load_mutual_info_data(Transform_Type, Is_Adv_Training)
 
         Is_Adv_Training = 'Adv_Train'
         Model_Name = self.Model_Name
         Transform_Type = 'Saturation'
-        with open('./Checkpoint/%s/%s/mi_loss_acc_%s.pkl' % (Model_Name, Transform_Type, Is_Adv_Training), 'rb') as f:
-            at_saturation_mi_loss_acc = pickle.load(f)
+        at_saturation_mi_loss_acc = self.load_mutual_info_data(Transform_Type, Is_Adv_Training)
         Transform_Type = 'Patch'
-        with open('./Checkpoint/%s/%s/mi_loss_acc_%s.pkl' % (Model_Name, Transform_Type, Is_Adv_Training), 'rb') as f:
-            at_patch_mi_loss_acc = pickle.load(f)
+        at_patch_mi_loss_acc = self.load_mutual_info_data(Transform_Type, Is_Adv_Training)
 
         Forward_Size, Forward_Repeat = st_saturation_mi_loss_acc['Forward_Size'], \
                                        st_saturation_mi_loss_acc['Forward_Repeat']
@@ -978,12 +1096,8 @@ class Forward():
 
         Is_Adv_Training = 'Adv_Train' if Enable_Adv_Training else 'Std_Train'
 
-        with open('./Checkpoint/%s/%s/mi_loss_acc_%s.pkl' % (self.Model_Name, Transform_Type, 'Std_Train'),
-                  'rb') as f:
-            ST_mi_loss_acc = pickle.load(f)
-        with open('./Checkpoint/%s/%s/mi_loss_acc_%s.pkl' % (self.Model_Name, Transform_Type, 'Adv_Train'),
-                  'rb') as f:
-            AT_mi_loss_acc = pickle.load(f)
+        ST_mi_loss_acc = self.load_mutual_info_data(Transform_Type, 'Std_Train')
+        AT_mi_loss_acc = self.load_mutual_info_data(Transform_Type, 'Adv_Train')
 
         Forward_Size, Forward_Repeat = ST_mi_loss_acc['Forward_Size'], ST_mi_loss_acc['Forward_Repeat']
         st_std, st_adv = ST_mi_loss_acc['std_estimator'], ST_mi_loss_acc['adv_estimator']
@@ -1134,78 +1248,64 @@ class Forward():
         Model = Model.to(self.Device)
         Model.eval()
 
-        label_chunk = None
-        label_std_chunk, label_prob_std_chunk = None, None
-        label_adv_chunk, label_prob_adv_chunk = None, None
-
-        Test_loader_Iter = iter(self.Test_Loader)
+        # 逐个 batch 累积 K*K 的个数和概率和, 不再拼接所有样本的标签和概率, 内存和文件大小与 Forward_Repeat 无关
+        std_matrix, adv_matrix = None, None
 
-        for i in range(self.Forward_Repeat):
-            images_clean, labels = next(Test_loader_Iter)
-            # 1. 保存真实标签
-            # 2. 保存模型对 干净样本 的预测标签和概率
-            # 3. 保存模型对 对抗样本 的预测标签和概率
-            images_clean = images_clean.to(self.Device)
-            labels = labels.to(self.Device)
+        # 开启对抗样本缓存时, 使用固定的评估子集以及缓存中的对抗样本, 不再重新跑 PGD
+        self.prepare_adv_set(Model)
+        if self.Adv_Images is None and self.Test_Loader is None:
+            self.Test_Loader = self.get_test_loader()
+        Test_loader_Iter = iter(self.Test_Loader) if self.Adv_Images is None else None
+        # Transfer_Full_Test: 不使用缓存时遍历整个测试集, 否则只取 Forward_Repeat 个 batch
+        Repeat_Num = len(self.Test_Loader) if self.Adv_Images is None and self.Args.Transfer_Full_Test \
+            else self.Forward_Repeat
+
+        for i in range(Repeat_Num):
+            # 1. 真实标签
+            # 2. 模型对 干净样本 的预测标签和概率
+            # 3. 模型对 对抗样本 的预测标签和概率
+            if self.Adv_Images is not None:
+                images_clean, labels = self.get_clean_or_adv_image(Model, Keep_Clean=True, Repeat_i=i)
+                images_adv, _ = self.get_clean_or_adv_image(Model, Keep_Clean=False, Repeat_i=i)
+            else:
+                images_clean, labels = next(Test_loader_Iter)
+                images_clean = images_clean.to(self.Device)
+                labels = labels.to(self.Device)
 
-            atk = self.test_attack(Model, Random_Start=False)
+                atk = self.test_attack(Model, Random_Start=False)
 
-            images_adv = atk(images_clean, labels)
+                images_adv = self.Attacks.perturb('test', atk, images_clean, labels)
 
-            """
-            计算模型的准确率
-            """
-            # loss_i = F.cross_entropy(outputs, labels)
             # predicted_prob, predicted, labels 都可以看成是一个列表或者是一个向量，列表中元素的个数为 batch_size 个
             # 先对神经网络的输出结果做一个 softmax 获取概率值
-            outputs_std = Model(images_clean)
-            label_prob_std, label_std = torch.max(F.softmax(outputs_std, dim=1), dim=1)
+            with torch.no_grad(), self.amp_context():
+                outputs_std = Model(images_clean)
+                label_prob_std, label_std = torch.max(F.softmax(outputs_std.float(), dim=1), dim=1)
 
-            outputs_adv = Model(images_adv)
-            label_prob_adv, label_adv = torch.max(F.softmax(outputs_adv, dim=1), dim=1)
+                outputs_adv = Model(images_adv)
+                label_prob_adv, label_adv = torch.max(F.softmax(outputs_adv.float(), dim=1), dim=1)
 
-            # correct_N += (predicted_std == labels).sum().item()
-            # total_N += labels.size(0)
-            # loss += loss_i.item()
-
-            """
-            发现并修改了一个重大bug, 这里每forward一次,caculate_MI 函数计算出的互信息值都直接挂在列表的后面，那么 Forward_Repeat 会成倍放大列表的长度
-            且会混乱每一个 epoch 中的互信息变化情况，Forward_Repeat 一旦超过 epoch_num ，那么每一个 epoch 的曲线就会
-            """
-            # 给定初始值
-            if i == 0:
-                label_chunk = labels.clone().detach()
-                # std
-                label_std_chunk = label_std.clone().detach()
-                label_prob_std_chunk = label_prob_std.clone().detach()
-                # adv
-                label_adv_chunk = label_adv.clone().detach()
-                label_prob_adv_chunk = label_prob_adv.clone().detach()
-
-                # 计算所有循环的和
-            else:
-                label_chunk = torch.cat((label_chunk, labels.clone().detach()), dim=0)
-                # std
-                label_std_chunk = torch.cat((label_std_chunk, label_std.clone().detach()), dim=0)
-                label_prob_std_chunk = torch.cat((label_prob_std_chunk, label_prob_std.clone().detach()), dim=0)
-                # adv
-                label_adv_chunk = torch.cat((label_adv_chunk, label_adv.clone().detach()), dim=0)
-                label_prob_adv_chunk = torch.cat((label_prob_adv_chunk, label_prob_adv.clone().detach()), dim=0)
+            # 标签个数直接取模型输出的维度
+            if std_matrix is None:
+                std_matrix = transfer_matrix_accumulator(outputs_std.size(1), device=self.Device)
+                adv_matrix = transfer_matrix_accumulator(outputs_std.size(1), device=self.Device)
+            std_matrix.update(labels, label_std, label_prob_std)
+            adv_matrix.update(labels, label_adv, label_prob_adv)
 
         dir = 'Checkpoint/%s' % self.Model_Name
         # 对于每一个模型产生的数据, 使用一个文件夹单独存放
         if not os.path.exists(dir):
             os.makedirs(dir)
 
-        transfer_matrix = {'label_chunk': label_chunk,
-                           'label_std_chunk': label_std_chunk,
-                           'label_prob_std_chunk': label_prob_std_chunk,
-                           'label_adv_chunk': label_adv_chunk,
-                           'label_prob_adv_chunk': label_prob_adv_chunk,
+        # 只保存 K*K 的矩阵: {'label_num', 'std': {'counts', 'prob_sum'}, 'adv': {...}}
+        transfer_matrix = {'label_num': std_matrix.label_num,
+                           'std': std_matrix.state_dict(),
+                           'adv': adv_matrix.state_dict(),
                            }
 
         with open('./Checkpoint/%s/transfer_matrix_%s.pkl' % (self.Model_Name, Is_Adv_Training), 'wb') as f:
             pickle.dump(transfer_matrix, f)
+        self.release_adv_set()
         print('Calculating Transfer Matrix was Done')
 
 
@@ -1266,6 +1366,39 @@ if __name__ == '__main__':
     parser.add_argument('--Alpha', default=2 / 255, type=float, help='the perturbation in each step')
     parser.add_argument('--Step', default=7, type=int, help='the step')
 
+    parser.add_argument('--KDE_Tile_Size', default=None, type=int, help='row tile size of the blocked KDE.')
+    parser.add_argument('--KDE_Memory_Budget', default=None, type=float,
+                        help='memory budget (bytes) used to pick the KDE tile size.')
+    parser.add_argument('--Noise_Variance_L', default=None, type=float, nargs='+',
+                        help='extra KDE noise variances evaluated from the same distance matrix.')
+    parser.add_argument('--Bin_Engine', default='sort', type=str, choices=['sort', 'hash'],
+                        help='unique-row counting engine of the binning estimator.')
+    parser.add_argument('--Bin_Single_Pass', action='store_true',
+                        help='digitize each layer once and get all H(T|Y=y) from one joint count.')
+    parser.add_argument('--Capture_Mode', default='clone', type=str, choices=['clone', 'async'],
+                        help='how the forward hooks capture activations.')
+    parser.add_argument('--MI_Workers', default=0, type=int,
+                        help='number of workers computing per-layer MI in parallel, 0 means serial.')
+    parser.add_argument('--MI_Executor', default='process', type=str, choices=['process', 'thread'],
+                        help='worker pool type used when MI_Workers > 0.')
+    parser.add_argument('--Transfer_Full_Test', action='store_true',
+                        help='calculate_transfer_matrix 在不使用对抗样本缓存时遍历整个测试集, 而不是 Forward_Repeat 个 batch')
+    parser.add_argument('--Results_Format', default='columnar', type=str, choices=['columnar', 'pickle'],
+                        help='save MI results as per-bound .npy arrays with a json header, or pickle the estimators.')
+    parser.add_argument('--Adv_Cache', default='none', type=str, choices=['none', 'float16', 'uint8'],
+                        help='on-disk cache of PGD examples shared by all transform levels.')
+    parser.add_argument('--Eval_Seed', default=0, type=int, help='seed used to draw the fixed test subset.')
+    parser.add_argument('--Transform_Seed', default=0, type=int, help='seed of the patch shuffling permutations.')
+    parser.add_argument('--Fused_Sweep', action='store_true',
+                        help='evaluate all transform levels in one pass over a fixed test subset.')
+    parser.add_argument('--AMP', default='none', type=str, choices=['none', 'fp16', 'bf16'],
+                        help='混合精度评估/PGD, fp16 只能在 cuda 上使用, cpu 上使用 bf16')
+    parser.add_argument('--Capture_Dtype', default='float32', type=str, choices=['float32', 'float16', 'bfloat16'],
+                        help='hook 保存激活值的精度, float16/bfloat16 可以把激活值的内存减半')
+    parser.add_argument('--Sync_Timing', action='store_true', help='耗时统计在计时点同步 cuda, 统计实际的 GPU 耗时')
+    parser.add_argument('--Sweep_Batch_Size', default=500, type=int,
+                        help='images per forward in the fused sweep (levels x chunk).')
+
     args = parser.parse_args()
 
     Model = Model_dict[args.Model_Name]
@@ -8,12 +8,18 @@ from torchvision import datasets, transforms
 import ModelSet
 from pylab import mpl
 import datetime
-from MI_estimator import mutual_info_estimator
+from MI_estimator import mutual_info_estimator, activation_arena
 from utils import *
+from batch_transforms import Random_Crop_Flip_Transform
 from torchattacks import PGD
 import pickle
 import torch.nn.functional as F
 from Tiny_ImageNet_Loader import *
+from adv_cache import adv_example_cache
+from attack_manager import attack_manager, stage_timer, multi_eps_pgd
+from compiled_model import compiled_model
+from transfer_matrix import transfer_matrix_accumulator
+from mi_results import save_mi_results
 
 
 # mpl.rcParams['savefig.dpi'] = 400  # 保存图片分辨率
@@ -27,41 +33,138 @@ from Tiny_ImageNet_Loader import *
 
 
 class Trainer():
-    def __init__(self, Origin_Model, args):
+    def __init__(self, Origin_Model, args, Eval_Only=False):
+        # Eval_Only: 只用于评估 (后台评估进程), 不构造训练集和 Train_Loader, 只保留测试集/评估子集/估计器/攻击
         self.Args = args
+        self.Eval_Only = Eval_Only
         self.Model_Name = args.Model_Name
         self.Origin_Model = Origin_Model
         # self.Enable_Show = True
         self.Std_Epoch_Num = args.Std_Epoch_Num
+        # 需要计算准确率和互信息的 epoch
+        self.Eval_Epochs = get_eval_epochs(self.Std_Epoch_Num, args.Eval_Schedule, args.Eval_Every, args.Eval_Num,
+                                           args.Eval_Epochs)
         self.Forward_Size, self.Forward_Repeat = args.Forward_Size, args.Forward_Repeat
         self.Learning_Rate = args.Learning_Rate
         self.Train_Batch_Size = args.batch_size
         self.Device = torch.device("cuda:%d" % (args.GPU) if torch.cuda.is_available() else "cpu")
-        self.Train_Loader, self.Test_Loader = self.get_train_test_loader()
-        self.std_estimator = mutual_info_estimator(self.Origin_Model.modules_to_hook,
-                                                   By_Layer_Name=False,
-                                                   Label_Num=args.Label_Num,
-                                                   Enable_Detail=True)
-        self.adv_estimator = mutual_info_estimator(self.Origin_Model.modules_to_hook,
-                                                   By_Layer_Name=False,
-                                                   Label_Num=args.Label_Num,
-                                                   Enable_Detail=True)
+        self.Train_Loader, self.Test_Loader = self.get_train_test_loader(Eval_Only)
+        self.std_estimator = self.get_estimator()
+        self.adv_estimator = self.get_estimator()
+        # 评估时图片 (slot 0) 和标签 (slot 1) 的缓冲区, 与激活值一样只分配一次
+        self.data_arena = activation_arena(self.Forward_Size * self.Forward_Repeat)
+        # 固定的评估子集, 第一次评估时创建
+        self.Eval_Set = None
+        # 对抗样本磁盘缓存, 只用于模型权重固定的 only_forward / calculate_transfer_matrix
+        self.Adv_Cache = None
+        self.Adv_Images = None
+        if args.Adv_Cache != 'none':
+            if args.Eval_Cache == 'none':
+                raise RuntimeError('Adv_Cache requires a fixed eval subset (Eval_Cache != none)')
+            self.Adv_Cache = adv_example_cache(Storage=args.Adv_Cache)
+        # 攻击对象按 (模型, 参数) 缓存, 不再每个 batch 重新构造; Timer 记录每个 epoch 各阶段的耗时
+        self.Timer = stage_timer(Synchronize=args.Sync_Timing)
+        self.Attacks = attack_manager(self.Timer, Autocast=self.amp_context)
+
+    def get_estimator(self):
+        args = self.Args
+        return mutual_info_estimator(self.Origin_Model.modules_to_hook,
+                                     By_Layer_Name=False,
+                                     Label_Num=args.Label_Num,
+                                     Enable_Detail=True,
+                                     KDE_Tile_Size=args.KDE_Tile_Size,
+                                     KDE_Memory_Budget=args.KDE_Memory_Budget,
+                                     Noise_Variance_L=args.Noise_Variance_L,
+                                     Bin_Engine=args.Bin_Engine,
+                                     Bin_Single_Pass=args.Bin_Single_Pass,
+                                     Capture_Mode=args.Capture_Mode,
+                                     MI_Workers=args.MI_Workers,
+                                     MI_Executor=args.MI_Executor,
+                                     Capture_Dtype=getattr(torch, args.Capture_Dtype))
 
     def train_attack(self, Model, Random_Start=False):
         # atk = PGD(Model, eps=args.Eps, alpha=args.Eps * 1.2 / 7, steps=7, random_start=Random_Start)
-        atk = PGD(Model, eps=self.Args.Eps, alpha=self.Args.Alpha, steps=self.Args.Step, random_start=Random_Start)
+        atk = self.Attacks.get_attack(Model, PGD, eps=self.Args.Eps, alpha=self.Args.Alpha, steps=self.Args.Step,
+                                      random_start=Random_Start)
         # atk = PGD(Model, eps=30 / 255, alpha=5 / 255, steps=7, random_start=Random_Start)
         return atk
 
+    def get_run_model(self, Model):
+        '''
+        --Compile_Mode 不为 none 时, 训练/PGD/互信息评估都通过 compiled_model 执行, 被记录层的输出作为计算图的额外输出返回,
+        不再使用 forward hook. Run_Model 与 Model 共享参数, optimizer/checkpoint/后台评估仍然使用 Model.
+        '''
+        if self.Args.Compile_Mode == 'none':
+            return Model
+        return compiled_model(Model, self.Origin_Model.modules_to_hook, Compile_Mode=self.Args.Compile_Mode)
+
+    def amp_context(self):
+        # --AMP 不为 none 时 forward 在 autocast 中进行, 包括 PGD 中的每一步
+        return get_autocast(self.Device, self.Args.AMP)
+
+    def fast_attack(self, Model, images, labels, criterion, scaler):
+        # fast AT: 在 [-Eps, Eps] 内随机初始化之后做一步 FGSM, 步长默认为 1.25 * Eps
+        Eps = self.Args.Eps
+        Alpha = self.Args.Fast_Alpha if self.Args.Fast_Alpha is not None else 1.25 * Eps
+        delta = torch.empty_like(images).uniform_(-Eps, Eps)
+        delta = (torch.clamp(images + delta, 0, 1) - images).requires_grad_(True)
+        with self.amp_context():
+            loss = criterion(Model(images + delta), labels)
+        # fp16 时对 loss 做 scaling 防止梯度下溢, 只用梯度的符号, 不需要 unscale
+        grad, = torch.autograd.grad(scaler.scale(loss), delta)
+        delta = torch.clamp(delta.detach() + Alpha * torch.sign(grad), -Eps, Eps)
+        return torch.clamp(images + delta, 0, 1).detach()
+
+    def free_train_step(self, Model, images, labels, optimizer, criterion, scaler, free_state):
+        '''
+        free AT: 同一个 batch 重复 Free_Replay 次, 每次反向传播同时得到参数的梯度和输入的梯度,
+        参数用 optimizer 更新, 扰动用输入梯度的符号更新 (步长 Eps), 扰动在 batch 之间延续.
+        返回最后一次重复的 outputs 和 loss.
+        '''
+        Eps = self.Args.Eps
+        b = images.size(0)
+        if free_state.get('delta') is None or free_state['delta'].shape[1:] != images.shape[1:]:
+            free_state['delta'] = torch.zeros_like(images)
+        if free_state['delta'].size(0) < b:
+            free_state['delta'] = torch.cat([free_state['delta'],
+                                             torch.zeros_like(images[:b - free_state['delta'].size(0)])], dim=0)
+        for _ in range(self.Args.Free_Replay):
+            delta = free_state['delta'][:b].clone().requires_grad_(True)
+            with self.amp_context():
+                outputs = Model(torch.clamp(images + delta, 0, 1))
+                loss = criterion(outputs, labels)
+            optimizer.zero_grad()
+            scaler.scale(loss).backward()
+            # fp16 溢出时 scaler 会跳过这一步的参数更新, 扰动同样不能被 inf/nan 污染
+            grad = torch.nan_to_num(delta.grad, nan=0.0)
+            free_state['delta'][:b] = torch.clamp(delta.detach() + Eps * torch.sign(grad), -Eps, Eps)
+            scaler.step(optimizer)
+            scaler.update()
+        return outputs, loss
+
+    def get_epoch_num(self, Enable_Adv_Training):
+        # free AT 每个 batch 更新 Free_Replay 次, epoch 数相应地除以 Free_Replay (向上取整), 总的参数更新次数与 Std_Epoch_Num 相同
+        if Enable_Adv_Training and self.Args.Adv_Train_Mode == 'free':
+            return max(1, -(-self.Args.Std_Epoch_Num // self.Args.Free_Replay))
+        return self.Args.Std_Epoch_Num
+
+    def eps_sweep_attack(self, Model, Eps_L):
+        # 每个 eps 的步长与 Alpha / Eps 的比例相同
+        Alpha_L = [self.Args.Alpha * eps / self.Args.Eps for eps in Eps_L]
+        return self.Attacks.get_attack(Model, multi_eps_pgd, eps_list=tuple(Eps_L), alpha_list=tuple(Alpha_L),
+                                       steps=self.Args.Step, random_start=False)
+
     def test_attack(self, Model, Random_Start=False):
         # atk = PGD(Model, eps=args.Eps, alpha=args.Eps * 1.2 / 7, steps=7, random_start=Random_Start)
-        atk = PGD(Model, eps=self.Args.Eps, alpha=self.Args.Alpha, steps=self.Args.Step, random_start=Random_Start)
+        atk = self.Attacks.get_attack(Model, PGD, eps=self.Args.Eps, alpha=self.Args.Alpha, steps=self.Args.Step,
+                                      random_start=Random_Start)
         # atk = PGD(Model, eps=12 / 255, alpha=3 / 255, steps=7, random_start=Random_Start)
         # atk = PGD(Model, eps=16 / 255, alpha=4 / 255, steps=7, random_start=Random_Start)
         # atk = PGD(Model, eps=30 / 255, alpha=5 / 255, steps=7, random_start=Random_Start)
         return atk
 
-    def get_train_test_loader(self):
+    def get_train_test_loader(self, Eval_Only=False):
+        # Eval_Only 时训练集不会被读取, 返回的 Train_Loader 为 None
         # 全局取消证书验证
         import ssl
         import random
@@ -89,35 +192,75 @@ class Trainer():
         ])
         Data_Set = self.Args.Data_Set
         if Data_Set == 'CIFAR10':
-            train_dataset = datasets.CIFAR10(root='./DataSet/CIFAR10', train=True, transform=data_tf_3_32_32,
-                                             download=True)
+            train_dataset = None if Eval_Only else datasets.CIFAR10(root='./DataSet/CIFAR10', train=True,
+                                                                    transform=data_tf_3_32_32, download=True)
             test_dataset = datasets.CIFAR10(root='./DataSet/CIFAR10', train=False, transform=tensor_transform,
                                             download=True)
         elif Data_Set == 'STL10':
-            train_dataset = datasets.STL10(root='./DataSet/STL10', split='train', transform=data_tf_3_96_96,
-                                           download=True)
+            train_dataset = None if Eval_Only else datasets.STL10(root='./DataSet/STL10', split='train',
+                                                                  transform=data_tf_3_96_96, download=True)
             test_dataset = datasets.STL10(root='./DataSet/STL10', split='test', transform=tensor_transform,
                                           download=True)
         elif Data_Set == 'SVHN':
-            train_dataset = datasets.SVHN(root='./DataSet/SVHN', split='train', transform=data_tf_3_64_64,
-                                          download=True)
+            train_dataset = None if Eval_Only else datasets.SVHN(root='./DataSet/SVHN', split='train',
+                                                                 transform=data_tf_3_64_64, download=True)
             test_dataset = datasets.SVHN(root='./DataSet/SVHN', split='test', transform=tensor_transform,
                                          download=True)
+        elif Data_Set == 'TinyImageNet' and has_tiny_imagenet_npy():
+            # 已经用 convert_tiny_imagenet_to_npy 转换过: 训练集从 memmap 按 batch 读取, 数据增强在 Device 上按 batch 完成
+            test_dataset = TestNpyTinyImageNetDataset()
+            Test_Loader = DataLoader(dataset=test_dataset, batch_size=self.Forward_Size, shuffle=True)
+            if Eval_Only:
+                return None, Test_Loader
+            train_dataset = TrainNpyTinyImageNetDataset()
+            Train_Loader = Tensor_Batch_Loader(train_dataset.images, train_dataset.labels, self.Train_Batch_Size,
+                                               Shuffle=True, Augment=Random_Crop_Flip_Transform(64, padding=4),
+                                               Device=self.Device, Channels_Last=True)
+            return Train_Loader, Test_Loader
         elif Data_Set == 'TinyImageNet':
-            train_dataset = TrainTinyImageNetDataset(id=get_id_dict(), transform=data_tf_3_64_64)
+            train_dataset = None if Eval_Only else TrainTinyImageNetDataset(id=get_id_dict(), transform=data_tf_3_64_64)
             test_dataset = TestTinyImageNetDataset(id=get_id_dict(), transform=tensor_transform)
         elif Data_Set == 'MNIST':
-            train_dataset = datasets.MNIST(root='./DataSet/MNIST', train=True, transform=tensor_transform,
-                                           download=True)
+            train_dataset = None if Eval_Only else datasets.MNIST(root='./DataSet/MNIST', train=True,
+                                                                  transform=tensor_transform, download=True)
             test_dataset = datasets.MNIST(root='./DataSet/MNIST', train=False, transform=tensor_transform)
         else:
             raise RuntimeError('invaild data set')
 
-        Train_Loader = DataLoader(dataset=train_dataset, batch_size=self.Train_Batch_Size, shuffle=True)
+        if Eval_Only:
+            # 后台评估进程不需要训练集, 尤其是 --Batch_Augment 时不会把整个训练集再放到 Device 上一次
+            Train_Loader = None
+        elif self.Args.Batch_Augment and Data_Set != 'TinyImageNet':
+            Train_Loader = self.get_batch_train_loader(train_dataset, Data_Set)
+        else:
+            Train_Loader = DataLoader(dataset=train_dataset, batch_size=self.Train_Batch_Size, shuffle=True)
         Test_Loader = DataLoader(dataset=test_dataset, batch_size=self.Forward_Size, shuffle=True)
         return Train_Loader, Test_Loader
 
-    def save_mutual_info_data(self, std_estimator, adv_estimator, analytic_data, Enable_Adv_Training):
+    def get_batch_train_loader(self, train_dataset, Data_Set):
+        # Batch_Augment: 训练集整体以 uint8 tensor 的形式放在 Device 上, 每个 batch 用一次索引取出,
+        # pad + 随机裁剪 + 翻转在整个 batch 上完成, 代替逐张图片的 PIL transform
+        if Data_Set == 'CIFAR10':
+            # (N, 32, 32, 3)
+            images = torch.from_numpy(np.ascontiguousarray(train_dataset.data)).permute(0, 3, 1, 2)
+            labels = train_dataset.targets
+        elif Data_Set in ('SVHN', 'STL10'):
+            # (N, 3, H, W)
+            images = torch.from_numpy(np.ascontiguousarray(train_dataset.data))
+            labels = train_dataset.labels
+        elif Data_Set == 'MNIST':
+            # (N, 28, 28), 原来的 MNIST 训练集也没有数据增强
+            images = train_dataset.data.unsqueeze(1)
+            labels = train_dataset.targets
+        else:
+            raise RuntimeError('Batch_Augment does not support data set %s' % Data_Set)
+        # 裁剪的大小与图片相同 (原来 SVHN 使用的是 64 的 RandomCrop)
+        Augment = None if Data_Set == 'MNIST' else Random_Crop_Flip_Transform(images.size(-1), padding=4)
+        return Tensor_Batch_Loader(images.contiguous().to(self.Device), labels, self.Train_Batch_Size, Shuffle=True,
+                                   Augment=Augment, Device=self.Device)
+
+    def save_mutual_info_data(self, std_estimator, adv_estimator, analytic_data, Enable_Adv_Training, basic_info=None):
+        # basic_info 为 None 时保存训练的设置, only_forward 传入它自己的 basic_info
         Is_Adv_Training = 'Adv_Train' if Enable_Adv_Training else 'Std_Train'
         Model_Name = self.Model_Name
         dir = 'Checkpoint/%s' % Model_Name
@@ -125,14 +268,28 @@ class Trainer():
         if not os.path.exists(dir):
             os.makedirs(dir)
 
-        basic_info = {'Model': self.Model_Name,
-                      'Learning_Rate': self.Learning_Rate,
-                      'Enable_Adv_Training': Enable_Adv_Training,
-                      'Forward_Size': self.Forward_Size,
-                      'Forward_Repeat': self.Forward_Repeat,
-                      }
+        if basic_info is None:
+            basic_info = {'Model': self.Model_Name,
+                          'Learning_Rate': self.Learning_Rate,
+                          'Enable_Adv_Training': Enable_Adv_Training,
+                          'Forward_Size': self.Forward_Size,
+                          'Forward_Repeat': self.Forward_Repeat,
+                          'Eval_Schedule': self.Args.Eval_Schedule,
+                          'Adv_Train_Mode': self.Args.Adv_Train_Mode,
+                          'Eval_Epochs': self.Eval_Epochs,
+                          # 实际训练的 epoch 数, 以及每个 batch 的参数更新次数 (只有 free AT 大于 1)
+                          'Std_Epoch_Num': self.Std_Epoch_Num,
+                          'Free_Replay': self.Args.Free_Replay
+                          if Enable_Adv_Training and self.Args.Adv_Train_Mode == 'free' else 1,
+                          }
 
         std, adv = std_estimator, adv_estimator
+        if self.Args.Results_Format == 'columnar':
+            # 每个估计器/每个界保存为一个稠密的 .npy 数组, 小数据放在 header.json 中, 见 mi_results.py
+            save_mi_results('./Checkpoint/%s/mi_results_%s' % (Model_Name, Is_Adv_Training),
+                            {'std': std, 'adv': adv},
+                            {'basic_info': basic_info, 'analytic_data': analytic_data})
+            return
         with open('./Checkpoint/%s/basic_info_%s.pkl' % (Model_Name, Is_Adv_Training), 'wb') as f:
             pickle.dump(basic_info, f)
         with open('./Checkpoint/%s/loss_and_acc_%s.pkl' % (Model_Name, Is_Adv_Training), 'wb') as f:
@@ -142,19 +299,61 @@ class Trainer():
         with open('./Checkpoint/%s/loss_and_mutual_info_%s_adv.pkl' % (Model_Name, Is_Adv_Training), 'wb') as f:
             pickle.dump(adv, f)
 
-    @torch.no_grad()
-    def get_clean_or_adv_image(self, Model, Keep_Clean):
-        atk = self.test_attack(Model, Random_Start=False)
+    def get_eval_set(self):
+        # Eval_Cache 不为 'none' 时, 评估使用的 Forward_Size * Forward_Repeat 个测试样本只抽取/解码一次
+        if self.Eval_Set is None:
+            Cache_Device = self.Device if self.Args.Eval_Cache == 'device' else 'cpu'
+            self.Eval_Set = eval_set_cache(self.Test_Loader.dataset, self.Forward_Size * self.Forward_Repeat,
+                                           Cache_Device, Seed=self.Args.Eval_Seed,
+                                           Pin_Memory=self.Args.Eval_Cache == 'pinned')
+        return self.Eval_Set
+
+    def prepare_eval_set(self, epoch_i):
+        # Eval_Resample: 每一个评估的 epoch 用 Eval_Seed + epoch_i 重新抽取, 干净样本和对抗样本仍然使用同一批样本
+        if self.Args.Eval_Cache != 'none' and self.Args.Eval_Resample:
+            self.get_eval_set().resample(self.Args.Eval_Seed + epoch_i)
+
+    def get_attack_config(self):
+        # 对抗样本缓存的 key 中包含的攻击参数, 以及攻击时使用的精度 (--AMP 得到的对抗样本与 fp32 的不同)
+        return {'attack': 'PGD', 'eps': self.Args.Eps, 'alpha': self.Args.Alpha, 'steps': self.Args.Step,
+                'random_start': False, 'amp': self.Args.AMP, 'amp_dtype': str(get_amp_dtype(self.Args.AMP))}
+
+    def prepare_adv_set(self, Model):
+        # 模型权重固定时使用: 整个评估子集的对抗样本只生成一次, 或者直接从磁盘缓存中读取
+        if self.Adv_Cache is None:
+            return
+        Model.eval()
+        eval_set = self.get_eval_set()
+        self.Adv_Images = self.Adv_Cache.get_adv_images(Model,
+                                                        eval_set.images.to(self.Device),
+                                                        eval_set.labels.to(self.Device),
+                                                        eval_set.indices,
+                                                        self.test_attack(Model, Random_Start=False),
+                                                        self.get_attack_config(),
+                                                        self.Forward_Size,
+                                                        Attacks=self.Attacks)
+
+    def release_adv_set(self):
+        self.Adv_Images = None
 
-        batch_images, batch_labels = next(iter(self.Test_Loader))
-        batch_images = batch_images.to(self.Device)
-        batch_labels = batch_labels.to(self.Device)
+    @torch.no_grad()
+    def get_clean_or_adv_image(self, Model, Keep_Clean, Repeat_i=0):
+        if self.Args.Eval_Cache != 'none':
+            batch_images, batch_labels = self.get_eval_set().get_batch(Repeat_i, self.Forward_Size, self.Device)
+            if not Keep_Clean and self.Adv_Images is not None:
+                start = Repeat_i * self.Forward_Size
+                return self.Adv_Images[start:start + self.Forward_Size], batch_labels
+        else:
+            batch_images, batch_labels = next(iter(self.Test_Loader))
+            batch_images = batch_images.to(self.Device)
+            batch_labels = batch_labels.to(self.Device)
         if Keep_Clean:
             return batch_images, batch_labels
 
         else:
+            atk = self.test_attack(Model, Random_Start=False)
             with torch.enable_grad():
-                adv_images = atk(batch_images, batch_labels)
+                adv_images = self.Attacks.perturb('test', atk, batch_images, batch_labels)
                 return adv_images, batch_labels
 
     # this training function is only for classification task
@@ -169,18 +368,20 @@ class Trainer():
         total_N = 0
         loss = 0.
 
-        image_chunk = None
-        label_chunk = None
-        layer_activation_chunk = None
 
         if Keep_Clean:
             estimator = self.std_estimator
         else:
             estimator = self.adv_estimator
 
+        # 图片/标签 (slot 0/1) 以及每一层的激活值都原地写入预先分配好的缓冲区, 不再在每一次 repeat 中 torch.cat
+        capacity = self.Forward_Size * self.Forward_Repeat
+        self.data_arena.reset(capacity)
+        estimator.begin_capture(capacity)
+
         for i in range(self.Forward_Repeat):
 
-            images, labels = self.get_clean_or_adv_image(Model, Keep_Clean)
+            images, labels = self.get_clean_or_adv_image(Model, Keep_Clean, Repeat_i=i)
 
             # labels = labels.to(Device)
             # # print('std_test_size', images.size(0))
@@ -190,13 +391,13 @@ class Trainer():
             forward之前先clear
             """
             estimator.clear_activations()
-            # register hook
-            estimator.do_forward_hook(Model)
+            # register hook (编译模式下激活值由计算图直接返回)
             """
             计算模型的准确率
             """
-            outputs = Model(images)
-            loss_i = F.cross_entropy(outputs, labels)
+            with self.amp_context():
+                outputs = estimator.forward_and_capture(Model, images)
+            loss_i = F.cross_entropy(outputs.float(), labels)
             # predicted_prob, predicted, labels 都可以看成是一个列表或者是一个向量，列表中元素的个数为 batch_size 个
             # 先对神经网络的输出结果做一个 softmax 获取概率值
             # predicted_prob, predicted = torch.max(F.softmax(outputs, dim=1), dim=1)
@@ -209,24 +410,9 @@ class Trainer():
             发现并修改了一个重大bug, 这里每forward一次,caculate_MI 函数计算出的互信息值都直接挂在列表的后面，那么 Forward_Repeat 会成倍放大列表的长度
             且会混乱每一个 epoch 中的互信息变化情况，Forward_Repeat 一旦超过 epoch_num ，那么每一个 epoch 的曲线就会
             """
-            # 给定初始值
-            if i == 0:
-                # print("---> layer activations size {} <---".format(layer_activations_size))
-                image_chunk = images.clone().detach()
-                label_chunk = labels.clone().detach()
-                '''
-                注意， 这里如果简单赋值就会出现传递引用的现象，需要手动调用copy,复制列表
-                '''
-                layer_activation_chunk = estimator.layer_activations.copy()
-            # 计算所有循环的和
-            else:
-                image_chunk = torch.cat((image_chunk, images.clone().detach()), dim=0)
-                label_chunk = torch.cat((label_chunk, labels.clone().detach()), dim=0)
-                """
-                这里 layer_activations 是一个 list, list 里的每一个元素时 tesnor (gpu:0)
-                """
-                for idx, item in enumerate(estimator.layer_activations):
-                    layer_activation_chunk[idx] = torch.cat((layer_activation_chunk[idx], item.clone().detach()), dim=0)
+            # 激活值已经由 hook 写入 estimator 的 arena, 这里只需要写入图片和标签
+            self.data_arena.append(0, images)
+            self.data_arena.append(1, labels)
             """
             forward 之后例行收尾工作
             """
@@ -234,16 +420,131 @@ class Trainer():
             estimator.clear_activations()
         # 计算存储互信息
         # calculate mutual info
-        estimator.layer_activations = layer_activation_chunk
+        estimator.end_capture()
         # estimator.caculate_MI(image_chunk.cpu(), label_chunk.cpu())
-        estimator.caculate_MI(image_chunk, label_chunk)
+        estimator.caculate_MI(self.data_arena.get(0), self.data_arena.get(1))
         estimator.store_MI()
         # estimator.clear_activations()
 
         acc = correct_N * 100. / total_N
         return acc, loss / self.Forward_Repeat
 
+    @torch.no_grad()
+    def calculate_acc_and_mutual_info_eps_sweep(self, Model, Eps_L, eps_estimators):
+        '''
+        一次 multi_eps_pgd 同时生成 Eps_L 中所有 eps 的对抗样本, 沿 batch 维度堆叠之后只 forward 一次,
+        hook 把每一层的输出按 eps 切开写入各自的估计器 (与 Forward 中的 fused sweep 相同), 每个 eps 一个 mutual_info_estimator.
+        与 fused sweep 一样按 Sweep_Batch_Size 分块, 每一块堆叠之后最多 Sweep_Batch_Size 张图片, 显存不随 len(Eps_L) 增长.
+        返回每个 eps 的 acc 和 loss 列表.
+        '''
+        Model.eval()
+        Eps_Num = len(Eps_L)
+        correct_N = [0 for _ in Eps_L]
+        loss = [0. for _ in Eps_L]
+        total_N = 0
+
+        capacity = self.Forward_Size * self.Forward_Repeat
+        self.data_arena.reset(capacity)
+        for eps_estimator in eps_estimators:
+            eps_estimator.begin_capture(capacity)
+
+        atk = self.eps_sweep_attack(Model, Eps_L)
+        Chunk_Size = max(1, self.Args.Sweep_Batch_Size // Eps_Num)
+        for i in range(self.Forward_Repeat):
+            images, labels = self.get_clean_or_adv_image(Model, Keep_Clean=True, Repeat_i=i)
+            for start in range(0, images.size(0), Chunk_Size):
+                chunk_images = images[start:start + Chunk_Size]
+                chunk_labels = labels[start:start + Chunk_Size]
+                with torch.enable_grad():
+                    adv_images = self.Attacks.perturb('eps_sweep', atk, chunk_images, chunk_labels)
+
+                # adv_estimator 只负责注册 hook, 激活值按块的顺序写入 eps_estimators 的 arena
+                self.adv_estimator.clear_activations()
+                with self.amp_context():
+                    outputs = self.adv_estimator.forward_and_capture(Model, adv_images,
+                                                                     level_estimators=eps_estimators)
+                for eps_i, eps_outputs in enumerate(outputs.float().chunk(Eps_Num, dim=0)):
+                    loss[eps_i] += F.cross_entropy(eps_outputs, chunk_labels, reduction='sum').item()
+                    correct_N[eps_i] += (torch.max(eps_outputs, dim=1)[1] == chunk_labels).sum().item()
+                self.adv_estimator.cancel_hook()
+                self.adv_estimator.clear_activations()
+                # 下一次 forward 重新从第 0 层开始写入
+                for eps_estimator in eps_estimators:
+                    eps_estimator.clear_activations()
+            total_N += labels.size(0)
+            self.data_arena.append(0, images)
+            self.data_arena.append(1, labels)
+
+        # 计算存储互信息, 每算完一个 eps 就释放它的 arena
+        acc_L, loss_L = [], []
+        for eps_i, eps_estimator in enumerate(eps_estimators):
+            eps_estimator.end_capture()
+            eps_estimator.hooked_layer_names = list(self.adv_estimator.hooked_layer_names)
+            eps_estimator.caculate_MI(self.data_arena.get(0), self.data_arena.get(1))
+            eps_estimator.store_MI()
+            eps_estimator.clear_activations()
+            eps_estimator.activation_arena = None
+            acc_L.append(correct_N[eps_i] * 100. / total_N)
+            loss_L.append(loss[eps_i] / total_N)
+        return acc_L, loss_L
+
+    def only_forward_eps_sweep(self, Model, Enable_Adv_Training):
+        # 固定的模型在 Eps_L 中所有 eps 下的准确率和互信息, 一遍 pipeline 完成, 结果保存在 only_forward/eps_sweep_<Is>
+        Eps_L = self.Args.Eps_L
+        Model = Model.to(self.Device)
+        Model.eval()
+        Run_Model = self.get_run_model(Model)
+
+        clean_acc, clean_loss = self.calculate_acc_and_mutual_info(Run_Model, Keep_Clean=True)
+        eps_estimators = [self.get_estimator() for _ in Eps_L]
+        adv_acc_L, adv_loss_L = self.calculate_acc_and_mutual_info_eps_sweep(Run_Model, Eps_L, eps_estimators)
+        print('test_clean_acc[%.2f], test_clean_loss[%.2f]' % (clean_acc, clean_loss))
+        for eps, adv_acc, adv_loss in zip(Eps_L, adv_acc_L, adv_loss_L):
+            print('eps[%.4f] test_adv_acc[%.2f], test_adv_loss[%.2f]' % (eps, adv_acc, adv_loss))
+        print('--> eps sweep timing: %s' % self.Timer.summary(self.Attacks.get_step_time()))
+
+        Is_Adv_Training = 'Adv_Train' if Enable_Adv_Training else 'Std_Train'
+        analytic_data = {'test_clean_loss': [clean_loss],
+                         'test_clean_acc': [clean_acc],
+                         'test_adv_loss': adv_loss_L,
+                         'test_adv_acc': adv_acc_L,
+                         }
+        basic_info = {'Model': self.Model_Name,
+                      'Enable_Adv_Training': Enable_Adv_Training,
+                      'Forward_Size': self.Forward_Size,
+                      'Forward_Repeat': self.Forward_Repeat,
+                      'Eps_L': Eps_L,
+                      'Alpha': self.Args.Alpha,
+                      'Eps': self.Args.Eps,
+                      'Step': self.Args.Step,
+                      }
+        # 前缀 std 是干净样本, eps_<i> 是 Eps_L 中第 i 个 eps 的对抗样本
+        estimators = {'std': self.std_estimator}
+        for eps_i, eps_estimator in enumerate(eps_estimators):
+            estimators['eps_%d' % eps_i] = eps_estimator
+        save_mi_results('./Checkpoint/%s/only_forward/eps_sweep_%s' % (self.Model_Name, Is_Adv_Training),
+                        estimators, {'basic_info': basic_info, 'analytic_data': analytic_data})
+
+        self.std_estimator.clear_all()
+        self.adv_estimator.clear_all()
+        for eps_estimator in eps_estimators:
+            eps_estimator.clear_all()
+        self.Timer.reset()
+        self.Attacks.clear()
+        print('the eps sweep has completed')
+        return analytic_data
+
     def training(self, Enable_Adv_Training):
+        if self.Eval_Only:
+            raise RuntimeError('this Trainer was built with Eval_Only=True and has no Train_Loader')
+        # 实际训练的 epoch 数 (free AT 时已经除以 Free_Replay), Eval_Epochs 按实际的 epoch 数重新计算
+        args = self.Args
+        self.Std_Epoch_Num = self.get_epoch_num(Enable_Adv_Training)
+        self.Eval_Epochs = get_eval_epochs(self.Std_Epoch_Num, args.Eval_Schedule, args.Eval_Every, args.Eval_Num,
+                                           args.Eval_Epochs)
+        if self.Std_Epoch_Num != args.Std_Epoch_Num:
+            print('--> free AT: Std_Epoch_Num %d / Free_Replay %d -> %d epochs'
+                  % (args.Std_Epoch_Num, args.Free_Replay, self.Std_Epoch_Num))
         checkpoint_path_dir = "Checkpoint/%s" % (self.Model_Name)
         if not os.path.exists(checkpoint_path_dir):
             os.makedirs(checkpoint_path_dir)
@@ -255,6 +556,9 @@ class Trainer():
         train_acc = []
         test_clean_acc, test_adv_acc = [], []
         test_clean_loss, test_adv_loss = [], []
+        # 实际得到结果的评估 epoch, 与 test_* 以及 estimator 中的每一项一一对应.
+        # --Resume 之前提交给后台进程但没有返回的评估不会重新计算, 因此不一定等于 Eval_Epochs
+        eval_epochs = []
 
         optimizer = optim.SGD(Model.parameters(),
                               lr=self.Learning_Rate,
@@ -275,6 +579,8 @@ class Trainer():
         scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones=[20, 60], gamma=0.5)
 
         criterion = nn.CrossEntropyLoss()
+        # 只有 cuda 上的 fp16 会真正开启 loss scaling
+        scaler = get_grad_scaler(self.Device, self.Args.AMP)
 
         # Load checkpoint.
         # if Enable_Adv_Training:
@@ -284,63 +590,190 @@ class Trainer():
         #     load_model(Model, './Checkpoint/%s_std.pth' % Model_Name)
         #     print('--> Load checkpoint successfully! ')
 
+        Is_Adv_Training = 'Adv_Train' if Enable_Adv_Training else 'Std_Train'
+        # 每个 epoch 的指标追加写入 epoch_log, 每 Checkpoint_Every 个 epoch 保存一次模型/优化器/scheduler,
+        # --Resume 时从这两个文件恢复, 从最后一个完成的 epoch 之后继续训练
+        epoch_log_path = './Checkpoint/%s/epoch_log_%s.jsonl' % (self.Model_Name, Is_Adv_Training)
+        resume_path = './Checkpoint/%s/resume_%s.pth' % (self.Model_Name, Is_Adv_Training)
+        start_epoch = 0
+
+        def record_eval(epoch_i_done, clean_acc, clean_loss, adv_acc, adv_loss, std_MI, adv_MI):
+            eval_epochs.append(epoch_i_done)
+            test_clean_acc.append(clean_acc)
+            test_adv_acc.append(adv_acc)
+            test_clean_loss.append(clean_loss)
+            test_adv_loss.append(adv_loss)
+            self.std_estimator.set_epoch_i_MI(std_MI)
+            self.std_estimator.store_MI()
+            self.adv_estimator.set_epoch_i_MI(adv_MI)
+            self.adv_estimator.store_MI()
+
+        def log_eval(epoch_i_done, clean_acc, clean_loss, adv_acc, adv_loss, std_MI, adv_MI):
+            append_jsonl(epoch_log_path, {'type': 'eval', 'epoch': epoch_i_done,
+                                          'test_clean_acc': clean_acc, 'test_clean_loss': clean_loss,
+                                          'test_adv_acc': adv_acc, 'test_adv_loss': adv_loss,
+                                          'std_MI': std_MI, 'adv_MI': adv_MI})
+
+        if self.Args.Resume and os.path.exists(resume_path):
+            checkpoint = torch.load(resume_path, map_location='cpu')
+            Model.load_state_dict(checkpoint['model'])
+            # 优化器的状态 (momentum) 会被放到参数所在的 device 上, 所以先移动模型
+            Model.to(self.Device)
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            scheduler.load_state_dict(checkpoint['scheduler'])
+            if 'rng_states' in checkpoint:
+                set_rng_states(checkpoint['rng_states'])
+            else:
+                # 旧的 checkpoint 只保存了 cpu 上 torch 的随机数状态
+                torch.set_rng_state(checkpoint['rng_state'])
+            if 'scaler' in checkpoint:
+                scaler.load_state_dict(checkpoint['scaler'])
+            start_epoch = checkpoint['epoch'] + 1
+            # 只保留 checkpoint 之前的记录, 之后的记录 (崩溃前没来得及保存 checkpoint 的 epoch) 会重新计算
+            records = [record for record in read_jsonl(epoch_log_path) if record['epoch'] < start_epoch]
+            write_jsonl(epoch_log_path, records)
+            for record in records:
+                if record['type'] == 'train':
+                    train_loss.append(record['train_loss'])
+                    train_acc.append(record['train_acc'])
+                else:
+                    record_eval(record['epoch'], record['test_clean_acc'], record['test_clean_loss'],
+                                record['test_adv_acc'], record['test_adv_loss'], record['std_MI'], record['adv_MI'])
+            print('--> resume from epoch_i[%d]' % start_epoch)
+        else:
+            write_jsonl(epoch_log_path, [])
+
+        def record_background_results(results):
+            # 后台进程按 epoch 的顺序返回结果, 依次写入 estimator 和 analytic_data
+            for result in results:
+                epoch_i_done, clean_acc, clean_loss, adv_acc, adv_loss, std_MI, adv_MI = result
+                record_eval(*result)
+                log_eval(*result)
+                print('epoch_i[%d] test_clean_loss[%.2f], test_adv_loss[%.2f] '
+                      'test_clean_acc[%.2f%%],test_adv_acc[%.2f%%]'
+                      % (epoch_i_done + 1, clean_loss, adv_loss, clean_acc, adv_acc))
+
+        # 对抗训练的方式: pgd (每个 batch 跑一次 PGD), fast (随机初始化 + FGSM), free (同一个 batch 重复更新)
+        Adv_Train_Mode = self.Args.Adv_Train_Mode
+        free_state = {}
+
+        Background_Eval = self.Args.Background_Eval
+        eval_epoch_set = set(self.Eval_Epochs)
+        if Background_Eval:
+            evaluator = background_evaluator(self.Origin_Model, self.Args)
+
         Model = Model.to(self.Device)
         Model.train()
+        # 只编译一次, 之后所有 epoch 的训练, 攻击和评估都使用同一个 Run_Model
+        Run_Model = self.get_run_model(Model)
         from tqdm import trange
-        for epoch_i in trange(self.Std_Epoch_Num):
+        for epoch_i in trange(start_epoch, self.Std_Epoch_Num):
 
             train_loss_sum, train_acc_sum, sample_sum = 0.0, 0.0, 0
 
             # 在每次训练之前，在验证集上计算干净样本和对抗样本互信息并且计算准确率
-            # if (epoch_i + 1) % 3 == 0:
-            epoch_test_clean_acc, epoch_test_clean_loss = self.calculate_acc_and_mutual_info(Model, Keep_Clean=True)
-            epoch_test_adv_acc, epoch_test_adv_loss = self.calculate_acc_and_mutual_info(Model, Keep_Clean=False)
-            # 在验证集上的干净样本准确率，对抗样本准确率,loss
-            test_clean_acc.append(epoch_test_clean_acc)
-            test_adv_acc.append(epoch_test_adv_acc)
-
-            test_clean_loss.append(epoch_test_clean_loss)
-            test_adv_loss.append(epoch_test_adv_loss)
-
+            # 只有 Eval_Epochs 中的 epoch 才评估, 测试集的 acc/loss 和互信息都与 Eval_Epochs 一一对应
+            is_eval_epoch = epoch_i in eval_epoch_set
+            if is_eval_epoch and not Background_Eval:
+                self.prepare_eval_set(epoch_i)
+            if is_eval_epoch and Background_Eval:
+                # 只把 epoch 开始时的权重交给后台进程, 训练不等待评估的结果
+                evaluator.submit(epoch_i, Model)
+                # 同步评估时 calculate_acc_and_mutual_info 会把模型留在 eval 模式, 这里保持一致
+                Model.eval()
+            elif is_eval_epoch:
+                # eval 的耗时包含其中 attack_test 的耗时
+                with self.Timer.section('eval'):
+                    epoch_test_clean_acc, epoch_test_clean_loss = self.calculate_acc_and_mutual_info(Run_Model,
+                                                                                                     Keep_Clean=True)
+                    epoch_test_adv_acc, epoch_test_adv_loss = self.calculate_acc_and_mutual_info(Run_Model,
+                                                                                                 Keep_Clean=False)
+                # 在验证集上的干净样本准确率，对抗样本准确率,loss
+                eval_epochs.append(epoch_i)
+                test_clean_acc.append(epoch_test_clean_acc)
+                test_adv_acc.append(epoch_test_adv_acc)
+
+                test_clean_loss.append(epoch_test_clean_loss)
+                test_adv_loss.append(epoch_test_adv_loss)
+                log_eval(epoch_i, epoch_test_clean_acc, epoch_test_clean_loss,
+                         epoch_test_adv_acc, epoch_test_adv_loss,
+                         self.std_estimator.get_epoch_i_MI(), self.adv_estimator.get_epoch_i_MI())
+
+            batch_start = self.Timer.now()
             for batch_images, batch_labels in self.Train_Loader:
 
                 # data moved to GPU
                 batch_labels = batch_labels.to(self.Device)
                 batch_images = batch_images.to(self.Device)
-
-                if Enable_Adv_Training:
-                    atk = self.train_attack(Model, Random_Start=True)
-                    batch_images = atk(batch_images, batch_labels)
-
-                outputs = Model(batch_images)
-
-                if epoch_i == 0 and sample_sum == 0:
+                self.Timer.add('data', self.Timer.now() - batch_start)
+
+                if Enable_Adv_Training and Adv_Train_Mode == 'free':
+                    # free AT 在 free_train_step 中完成 Free_Replay 次参数更新, 攻击和参数更新在同一次反向传播中
+                    with self.Timer.section('free_step'):
+                        outputs, loss = self.free_train_step(Run_Model, batch_images, batch_labels, optimizer,
+                                                             criterion, scaler, free_state)
+                else:
+                    if Enable_Adv_Training and Adv_Train_Mode == 'fast':
+                        with self.Timer.section('attack_train'):
+                            batch_images = self.fast_attack(Run_Model, batch_images, batch_labels, criterion, scaler)
+                    elif Enable_Adv_Training:
+                        atk = self.train_attack(Run_Model, Random_Start=True)
+                        batch_images = self.Attacks.perturb('train', atk, batch_images, batch_labels)
+
+                    step_start = self.Timer.now()
+                    with self.amp_context():
+                        outputs = Run_Model(batch_images)
+
+                        loss = criterion(outputs, batch_labels)
+
+                    # zero the gradient cache
+                    optimizer.zero_grad()
+                    # backpropagation
+                    scaler.scale(loss).backward()
+                    # update weights and bias
+                    scaler.step(optimizer)
+                    scaler.update()
+                    self.Timer.add('train_step', self.Timer.now() - step_start)
+
+                if epoch_i == start_epoch and sample_sum == 0:
                     print(self.Device)
                     print(batch_images.shape, batch_labels.shape, outputs.shape)
                     # print(batch_labels, outputs)
-
-                loss = criterion(outputs, batch_labels)
-
-                # zero the gradient cache
-                optimizer.zero_grad()
-                # backpropagation
-                loss.backward()
-                # update weights and bias
-                optimizer.step()
                 scheduler.step()
 
                 train_loss_sum += loss.item()
                 _, predicted_label = torch.max(outputs.data, dim=1)
                 train_acc_sum += predicted_label.eq(batch_labels.data).cpu().sum().item()
                 sample_sum += batch_images.shape[0]
+                batch_start = self.Timer.now()
 
             # 记录每一轮的训练集准确度，损失，测试集准确度
             train_loss.append(train_loss_sum / len(self.Train_Loader))
             # 训练准确率
             epoch_train_acc = (train_acc_sum / sample_sum) * 100.0
             train_acc.append(epoch_train_acc)
+            # 每个 epoch 的耗时分解, 打印之后清零
+            print('epoch_i[%d] timing: %s' % (epoch_i + 1, self.Timer.summary(self.Attacks.get_step_time())))
+            epoch_timing = self.Timer.reset()
+            self.Attacks.reset_steps()
+            append_jsonl(epoch_log_path, {'type': 'train', 'epoch': epoch_i,
+                                          'train_loss': train_loss[-1], 'train_acc': epoch_train_acc,
+                                          'timing': epoch_timing})
+            if (epoch_i + 1) % self.Args.Checkpoint_Every == 0 or epoch_i + 1 == self.Std_Epoch_Num:
+                atomic_torch_save({'epoch': epoch_i,
+                                   'model': Model.state_dict(),
+                                   'optimizer': optimizer.state_dict(),
+                                   'scheduler': scheduler.state_dict(),
+                                   'rng_states': get_rng_states(),
+                                   'scaler': scaler.state_dict()}, resume_path)
 
             # print some data
+            if Background_Eval or not is_eval_epoch:
+                print('epoch_i[%d] train_loss[%.2f], train_acc[%.2f%%]'
+                      % (epoch_i + 1, train_loss_sum / len(self.Train_Loader), epoch_train_acc))
+                if Background_Eval:
+                    record_background_results(evaluator.poll(block=False))
+                continue
             print('epoch_i[%d] '
                   'train_loss[%.2f], test_clean_loss[%.2f], test_adv_loss[%.2f] '
                   'train_acc[%.2f%%],test_clean_acc[%.2f%%],test_adv_acc[%.2f%%]'
@@ -348,6 +781,10 @@ class Trainer():
                      train_loss_sum / len(self.Train_Loader), epoch_test_clean_loss, epoch_test_adv_loss,
                      epoch_train_acc, epoch_test_clean_acc, epoch_test_adv_acc))
 
+        if Background_Eval:
+            # 等待后台进程完成剩余 epoch 的评估
+            record_background_results(evaluator.close())
+
         # Save checkpoint.
         checkpoint_path = "./Checkpoint/%s/%s_%s.pth" % (
             self.Model_Name,
@@ -361,7 +798,9 @@ class Trainer():
             'test_adv_loss': test_adv_loss,
             'train_acc': train_acc,
             'test_clean_acc': test_clean_acc,
-            'test_adv_acc': test_adv_acc
+            'test_adv_acc': test_adv_acc,
+            # test_* 以及 estimator 中每一项对应的 epoch
+            'eval_epochs': eval_epochs,
         }
         # plot_performance(analytic_data, Enable_Adv_Training)
         '''
@@ -379,16 +818,22 @@ class Trainer():
         """
         self.std_estimator.clear_all()
         self.adv_estimator.clear_all()
+        self.Attacks.clear()
         print('the training has completed')
         return analytic_data
 
     def only_forward(self, Model, Enable_Adv_Training):
+        if self.Args.Eps_L is not None:
+            return self.only_forward_eps_sweep(Model, Enable_Adv_Training)
 
         Model = Model.to(self.Device)
         Model.eval()
 
-        epoch_test_clean_acc, epoch_test_clean_loss = self.calculate_acc_and_mutual_info(Model, Keep_Clean=True)
-        epoch_test_adv_acc, epoch_test_adv_loss = self.calculate_acc_and_mutual_info(Model, Keep_Clean=False)
+        self.prepare_adv_set(Model)
+        Run_Model = self.get_run_model(Model)
+        epoch_test_clean_acc, epoch_test_clean_loss = self.calculate_acc_and_mutual_info(Run_Model, Keep_Clean=True)
+        epoch_test_adv_acc, epoch_test_adv_loss = self.calculate_acc_and_mutual_info(Run_Model, Keep_Clean=False)
+        self.release_adv_set()
         print('test_clean_acc[%.2f], test_clean_loss[%.2f],test_adv_acc[%.2f], test_adv_loss[%.2f]' % (
             epoch_test_clean_acc, epoch_test_clean_loss, epoch_test_adv_acc, epoch_test_adv_loss))
         analytic_data = {
@@ -402,27 +847,16 @@ class Trainer():
 
         # plot_performance(analytic_data, Enable_Adv_Training)
 
-        Is_Adv_Training = 'Adv_Train' if Enable_Adv_Training else 'Std_Train'
-        Model_Name, Forward_Size, Forward_Repeat = self.Model_Name, self.Forward_Size, self.Forward_Repeat
-        dir = 'Checkpoint/%s/only_forward' % Model_Name
-        # 对于每一个模型产生的数据, 使用一个文件夹单独存放
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-
-        basic_info = {'Model': Model_Name,
+        basic_info = {'Model': self.Model_Name,
                       'Enable_Adv_Training': Enable_Adv_Training,
-                      'Forward_Size': Forward_Size,
-                      'Forward_Repeat': Forward_Repeat,
+                      'Forward_Size': self.Forward_Size,
+                      'Forward_Repeat': self.Forward_Repeat,
                       }
-
-        with open('./Checkpoint/%s/basic_info_%s.pkl' % (Model_Name, Is_Adv_Training), 'wb') as f:
-            pickle.dump(basic_info, f)
-        with open('./Checkpoint/%s/loss_and_acc_%s.pkl' % (Model_Name, Is_Adv_Training), 'wb') as f:
-            pickle.dump(analytic_data, f)
-        with open('./Checkpoint/%s/loss_and_mutual_info_%s_std.pkl' % (Model_Name, Is_Adv_Training), 'wb') as f:
-            pickle.dump(self.std_estimator, f)
-        with open('./Checkpoint/%s/loss_and_mutual_info_%s_adv.pkl' % (Model_Name, Is_Adv_Training), 'wb') as f:
-            pickle.dump(self.adv_estimator, f)
+        # 与训练的结果保存在同样的位置, 同样遵循 --Results_Format
+        self.std_estimator.clear_activations()
+        self.adv_estimator.clear_activations()
+        self.save_mutual_info_data(self.std_estimator, self.adv_estimator, analytic_data, Enable_Adv_Training,
+                                   basic_info=basic_info)
 
         """
         在退出之前完成清理工作
@@ -440,81 +874,135 @@ class Trainer():
         Model = Model.to(self.Device)
         Model.eval()
 
-        label_chunk = None
-        label_std_chunk, label_prob_std_chunk = None, None
-        label_adv_chunk, label_prob_adv_chunk = None, None
-
-        Test_loader_Iter = iter(self.Test_Loader)
-
-        for i in range(self.Forward_Repeat):
-            images_clean, labels = next(Test_loader_Iter)
-            # 1. 保存真实标签
-            # 2. 保存模型对 干净样本 的预测标签和概率
-            # 3. 保存模型对 对抗样本 的预测标签和概率
-            images_clean = images_clean.to(self.Device)
-            labels = labels.to(self.Device)
+        # 逐个 batch 累积 K*K 的个数和概率和, 不再拼接所有样本的标签和概率, 内存和文件大小与 Forward_Repeat 无关
+        std_matrix, adv_matrix = None, None
+
+        # 开启对抗样本缓存时, 使用固定的评估子集以及缓存中的对抗样本, 不再重新跑 PGD
+        self.prepare_adv_set(Model)
+        Test_loader_Iter = iter(self.Test_Loader) if self.Adv_Images is None else None
+        # Transfer_Full_Test: 不使用缓存时遍历整个测试集, 否则只取 Forward_Repeat 个 batch
+        Repeat_Num = len(self.Test_Loader) if self.Adv_Images is None and self.Args.Transfer_Full_Test \
+            else self.Forward_Repeat
+
+        for i in range(Repeat_Num):
+            # 1. 真实标签
+            # 2. 模型对 干净样本 的预测标签和概率
+            # 3. 模型对 对抗样本 的预测标签和概率
+            if self.Adv_Images is not None:
+                images_clean, labels = self.get_clean_or_adv_image(Model, Keep_Clean=True, Repeat_i=i)
+                images_adv, _ = self.get_clean_or_adv_image(Model, Keep_Clean=False, Repeat_i=i)
+            else:
+                images_clean, labels = next(Test_loader_Iter)
+                images_clean = images_clean.to(self.Device)
+                labels = labels.to(self.Device)
 
-            atk = self.test_attack(Model, Random_Start=False)
+                atk = self.test_attack(Model, Random_Start=False)
 
-            images_adv = atk(images_clean, labels)
+                images_adv = self.Attacks.perturb('test', atk, images_clean, labels)
 
-            """
-            计算模型的准确率
-            """
-            # loss_i = F.cross_entropy(outputs, labels)
             # predicted_prob, predicted, labels 都可以看成是一个列表或者是一个向量，列表中元素的个数为 batch_size 个
             # 先对神经网络的输出结果做一个 softmax 获取概率值
-            outputs_std = Model(images_clean)
-            label_prob_std, label_std = torch.max(F.softmax(outputs_std, dim=1), dim=1)
+            with torch.no_grad(), self.amp_context():
+                outputs_std = Model(images_clean)
+                label_prob_std, label_std = torch.max(F.softmax(outputs_std.float(), dim=1), dim=1)
 
-            outputs_adv = Model(images_adv)
-            label_prob_adv, label_adv = torch.max(F.softmax(outputs_adv, dim=1), dim=1)
+                outputs_adv = Model(images_adv)
+                label_prob_adv, label_adv = torch.max(F.softmax(outputs_adv.float(), dim=1), dim=1)
 
-            # correct_N += (predicted_std == labels).sum().item()
-            # total_N += labels.size(0)
-            # loss += loss_i.item()
-
-            """
-            发现并修改了一个重大bug, 这里每forward一次,caculate_MI 函数计算出的互信息值都直接挂在列表的后面，那么 Forward_Repeat 会成倍放大列表的长度
-            且会混乱每一个 epoch 中的互信息变化情况，Forward_Repeat 一旦超过 epoch_num ，那么每一个 epoch 的曲线就会
-            """
-            # 给定初始值
-            if i == 0:
-                label_chunk = labels.clone().detach()
-                # std
-                label_std_chunk = label_std.clone().detach()
-                label_prob_std_chunk = label_prob_std.clone().detach()
-                # adv
-                label_adv_chunk = label_adv.clone().detach()
-                label_prob_adv_chunk = label_prob_adv.clone().detach()
-
-                # 计算所有循环的和
-            else:
-                label_chunk = torch.cat((label_chunk, labels.clone().detach()), dim=0)
-                # std
-                label_std_chunk = torch.cat((label_std_chunk, label_std.clone().detach()), dim=0)
-                label_prob_std_chunk = torch.cat((label_prob_std_chunk, label_prob_std.clone().detach()), dim=0)
-                # adv
-                label_adv_chunk = torch.cat((label_adv_chunk, label_adv.clone().detach()), dim=0)
-                label_prob_adv_chunk = torch.cat((label_prob_adv_chunk, label_prob_adv.clone().detach()), dim=0)
+            # 标签个数直接取模型输出的维度
+            if std_matrix is None:
+                std_matrix = transfer_matrix_accumulator(outputs_std.size(1), device=self.Device)
+                adv_matrix = transfer_matrix_accumulator(outputs_std.size(1), device=self.Device)
+            std_matrix.update(labels, label_std, label_prob_std)
+            adv_matrix.update(labels, label_adv, label_prob_adv)
 
         dir = 'Checkpoint/%s' % self.Model_Name
         # 对于每一个模型产生的数据, 使用一个文件夹单独存放
         if not os.path.exists(dir):
             os.makedirs(dir)
 
-        transfer_matrix = {'label_chunk': label_chunk,
-                           'label_std_chunk': label_std_chunk,
-                           'label_prob_std_chunk': label_prob_std_chunk,
-                           'label_adv_chunk': label_adv_chunk,
-                           'label_prob_adv_chunk': label_prob_adv_chunk,
+        # 只保存 K*K 的矩阵: {'label_num', 'std': {'counts', 'prob_sum'}, 'adv': {...}}
+        transfer_matrix = {'label_num': std_matrix.label_num,
+                           'std': std_matrix.state_dict(),
+                           'adv': adv_matrix.state_dict(),
                            }
 
         with open('./Checkpoint/%s/transfer_matrix_%s.pkl' % (self.Model_Name, Is_Adv_Training), 'wb') as f:
             pickle.dump(transfer_matrix, f)
+        self.release_adv_set()
         print('Calculating Transfer Matrix was Done')
 
 
+def background_eval_worker(Origin_Model, args, task_queue, result_queue):
+    """
+    后台评估进程: 每收到一个 (epoch_i, state_dict) 就计算干净样本和对抗样本的准确率/loss/互信息,
+    然后把结果放入 result_queue; 收到 None 时退出.
+    """
+    args.Background_Eval = False
+    trainer = Trainer(Origin_Model, args, Eval_Only=True)
+    Model = Origin_Model.to(trainer.Device)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        epoch_i, state_dict = task
+        Model.load_state_dict(state_dict)
+        trainer.prepare_eval_set(epoch_i)
+        clean_acc, clean_loss = trainer.calculate_acc_and_mutual_info(Model, Keep_Clean=True)
+        adv_acc, adv_loss = trainer.calculate_acc_and_mutual_info(Model, Keep_Clean=False)
+        result_queue.put((epoch_i, clean_acc, clean_loss, adv_acc, adv_loss,
+                          trainer.std_estimator.get_epoch_i_MI(), trainer.adv_estimator.get_epoch_i_MI()))
+    trainer.std_estimator.clear_all()
+    trainer.adv_estimator.clear_all()
+
+
+class background_evaluator(object):
+    """
+    在一个 spawn 出来的进程中评估模型, 训练进程只需要在 epoch 开始时把权重快照放入队列.
+    只有一个 worker, 因此结果按照 submit 的顺序返回.
+    """
+
+    def __init__(self, Origin_Model, args):
+        import copy
+        import torch.multiprocessing as mp
+        ctx = mp.get_context('spawn')
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.pending = 0
+        self.process = ctx.Process(target=background_eval_worker,
+                                   args=(copy.deepcopy(Origin_Model).cpu(), copy.copy(args),
+                                         self.task_queue, self.result_queue))
+        self.process.start()
+
+    def submit(self, epoch_i, Model):
+        # 权重快照放在 cpu 上, 通过共享内存传给 worker, 之后的训练不会修改这份快照
+        state_dict = {k: v.detach().cpu().clone() for k, v in Model.state_dict().items()}
+        self.task_queue.put((epoch_i, state_dict))
+        self.pending += 1
+
+    def poll(self, block=False):
+        import queue
+        results = []
+        while self.pending > 0:
+            try:
+                result = self.result_queue.get(timeout=10) if block else self.result_queue.get_nowait()
+            except queue.Empty:
+                if not block:
+                    break
+                if not self.process.is_alive():
+                    raise RuntimeError('background evaluation process exited with code %s' % self.process.exitcode)
+                continue
+            self.pending -= 1
+            results.append(result)
+        return results
+
+    def close(self):
+        results = self.poll(block=True)
+        self.task_queue.put(None)
+        self.process.join()
+        return results
+
+
 if __name__ == '__main__':
     # Random_Seed = 123
     # torch.manual_seed(Random_Seed)
@@ -560,6 +1048,10 @@ if __name__ == '__main__':
 
     parser.add_argument('--Eps', default=45 / 255, type=float, help='perturbation magnitude')
     parser.add_argument('--Alpha', default=8 / 255, type=float, help='the perturbation in each step')
+    parser.add_argument('--Eps_L', default=None, type=float, nargs='+',
+                        help='only_forward 时一次计算多个 eps 的对抗样本和互信息, 每个 eps 的步长为 Alpha * eps / Eps')
+    parser.add_argument('--Sweep_Batch_Size', default=500, type=int,
+                        help='images per forward in the eps sweep (len(Eps_L) x chunk).')
     parser.add_argument('--Step', default=7, type=int, help='the step')
 
     parser.add_argument('--Std_Epoch_Num', default=200, type=int, help='The epochs.')
@@ -571,6 +1063,61 @@ if __name__ == '__main__':
     parser.add_argument('--Forward_Repeat', default=2, type=int, help='Forward_Repeat')
     parser.add_argument('--GPU', default=0, type=int, help='The GPU id.')
     parser.add_argument('--batch_size', default=128, type=int, help='The Train_Batch_Size.')
+    parser.add_argument('--KDE_Tile_Size', default=None, type=int, help='row tile size of the blocked KDE.')
+    parser.add_argument('--KDE_Memory_Budget', default=None, type=float,
+                        help='memory budget (bytes) used to pick the KDE tile size.')
+    parser.add_argument('--Noise_Variance_L', default=None, type=float, nargs='+',
+                        help='extra KDE noise variances evaluated from the same distance matrix.')
+    parser.add_argument('--Bin_Engine', default='sort', type=str, choices=['sort', 'hash'],
+                        help='unique-row counting engine of the binning estimator.')
+    parser.add_argument('--Bin_Single_Pass', action='store_true',
+                        help='digitize each layer once and get all H(T|Y=y) from one joint count.')
+    parser.add_argument('--Capture_Mode', default='clone', type=str, choices=['clone', 'async'],
+                        help='how the forward hooks capture activations.')
+    parser.add_argument('--MI_Workers', default=0, type=int,
+                        help='number of workers computing per-layer MI in parallel, 0 means serial.')
+    parser.add_argument('--MI_Executor', default='process', type=str, choices=['process', 'thread'],
+                        help='worker pool type used when MI_Workers > 0.')
+    parser.add_argument('--Background_Eval', action='store_true',
+                        help='evaluate acc/loss/MI of each epoch in a background process while training continues.')
+    parser.add_argument('--Eval_Schedule', default='every', type=str, choices=['every', 'log', 'list'],
+                        help='which epochs are evaluated: every Eval_Every epochs, Eval_Num log-spaced epochs, '
+                             'or the epochs in Eval_Epochs.')
+    parser.add_argument('--Eval_Every', default=1, type=int, help='evaluate every k epochs.')
+    parser.add_argument('--Eval_Num', default=None, type=int, help='number of log-spaced eval epochs.')
+    parser.add_argument('--Eval_Epochs', default=None, type=int, nargs='+', help='explicit eval epochs (0-based).')
+    parser.add_argument('--Eval_Cache', default='device', type=str, choices=['device', 'pinned', 'none'],
+                        help='keep a fixed eval subset on the device, in pinned host memory, '
+                             'or draw a new test batch every repeat (none).')
+    parser.add_argument('--Eval_Seed', default=0, type=int, help='seed used to draw the eval subset.')
+    parser.add_argument('--Eval_Resample', action='store_true',
+                        help='redraw the cached eval subset at every evaluated epoch.')
+    parser.add_argument('--Resume', action='store_true',
+                        help='continue from the last checkpoint and epoch log of an interrupted run.')
+    parser.add_argument('--Checkpoint_Every', default=5, type=int,
+                        help='save model/optimizer/scheduler every k epochs for --Resume.')
+    parser.add_argument('--AMP', default='none', type=str, choices=['none', 'fp16', 'bf16'],
+                        help='混合精度训练/评估/PGD, fp16 只能在 cuda 上使用 (带 loss scaling), cpu 上使用 bf16')
+    parser.add_argument('--Capture_Dtype', default='float32', type=str, choices=['float32', 'float16', 'bfloat16'],
+                        help='hook 保存激活值的精度, float16/bfloat16 可以把激活值的内存减半')
+    parser.add_argument('--Compile_Mode', default='none', type=str, choices=['none', 'fx', 'compile'],
+                        help='fx: 被记录层的输出作为计算图的额外输出返回, 不再使用 forward hook; '
+                             'compile: 在此基础上 torch.compile 一次, 用于训练/PGD/互信息评估')
+    parser.add_argument('--Sync_Timing', action='store_true',
+                        help='每个 epoch 的耗时分解在计时点同步 cuda, 统计实际的 GPU 耗时')
+    parser.add_argument('--Adv_Train_Mode', default='pgd', type=str, choices=['pgd', 'fast', 'free'],
+                        help='对抗训练方式: pgd, fast (随机初始化 + FGSM), free (同一个 batch 重复 Free_Replay 次)')
+    parser.add_argument('--Fast_Alpha', default=None, type=float, help='fast 对抗训练的 FGSM 步长, 默认 1.25 * Eps')
+    parser.add_argument('--Free_Replay', default=4, type=int,
+                        help='free 对抗训练中每个 batch 重复的次数, 实际训练的 epoch 数自动取 Std_Epoch_Num / Free_Replay')
+    parser.add_argument('--Batch_Augment', action='store_true',
+                        help='训练集以 uint8 tensor 的形式放在 GPU/CPU 上, 数据增强按 batch 完成, 不再使用逐张图片的 PIL transform')
+    parser.add_argument('--Transfer_Full_Test', action='store_true',
+                        help='calculate_transfer_matrix 在不使用对抗样本缓存时遍历整个测试集, 而不是 Forward_Repeat 个 batch')
+    parser.add_argument('--Results_Format', default='columnar', type=str, choices=['columnar', 'pickle'],
+                        help='save MI results as per-bound .npy arrays with a json header, or pickle the estimators.')
+    parser.add_argument('--Adv_Cache', default='none', type=str, choices=['none', 'float16', 'uint8'],
+                        help='on-disk cache of PGD examples for a fixed model (only_forward, transfer matrix).')
 
     args = parser.parse_args()
 
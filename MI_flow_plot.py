@@ -10,6 +10,8 @@ import math
 import torch
 import torch.nn.functional as F
 from matplotlib.ticker import MultipleLocator, FormatStrFormatter
+from mi_results import has_mi_results, load_mi_results
+from transfer_matrix import calculate_transfer_matrix, transfer_matrix_mean_prob
 
 
 # Forward_Repeat, Forward_Size = 1, 2
@@ -20,6 +22,26 @@ from matplotlib.ticker import MultipleLocator, FormatStrFormatter
 # fig, ax = plt.subplots()
 # lines = ax.plot(data)
 # ax.legend(custom_lines, ['Cold', 'Medium', 'Hot'])
+def load_training_data(Model_Name, Is_Adv_Training):
+    """
+    优先读取列式存储 (Checkpoint/<Model>/mi_results_<Is_Adv_Training>/), std/adv 是按需 mmap 的 mi_results_view;
+    旧的实验数据仍然从 pickle 中读取整个 estimator.
+    """
+    result_dir = './Checkpoint/%s/mi_results_%s' % (Model_Name, Is_Adv_Training)
+    if has_mi_results(result_dir):
+        header, views = load_mi_results(result_dir)
+        return header['basic_info'], header['analytic_data'], views['std'], views['adv']
+    with open('./Checkpoint/%s/basic_info_%s.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
+        basic_info = pickle.load(f)
+    with open('./Checkpoint/%s/loss_and_acc_%s.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
+        analytic_data = pickle.load(f)
+    with open('./Checkpoint/%s/loss_and_mutual_info_%s_std.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
+        std = pickle.load(f)
+    with open('./Checkpoint/%s/loss_and_mutual_info_%s_adv.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
+        adv = pickle.load(f)
+    return basic_info, analytic_data, std, adv
+
+
 def plot_mutual_info_scatter(Model_Name, Enable_Adv_Training):
     # 用label和color列表生成mpatches.Patch对象，它将作为句柄来生成legend patches = [mpatches.Patch(linestyle=line_styles[i],
     # label="{:s}".format(labels[i])) for i in range(len(line_styles))]
@@ -35,24 +57,21 @@ def plot_mutual_info_scatter(Model_Name, Enable_Adv_Training):
         Line2D([0], [0], color='Red', linestyle='None', marker='+', markersize=10)]
 
     Is_Adv_Training = 'Adv_Train' if Enable_Adv_Training else 'Std_Train'
-    with open('./Checkpoint/%s/basic_info_%s.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
-        basic_info = pickle.load(f)
-    with open('./Checkpoint/%s/loss_and_acc_%s.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
-        analytic_data = pickle.load(f)
-    with open('./Checkpoint/%s/loss_and_mutual_info_%s_std.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
-        std = pickle.load(f)
-    with open('./Checkpoint/%s/loss_and_mutual_info_%s_adv.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
-        adv = pickle.load(f)
+    basic_info, analytic_data, std, adv = load_training_data(Model_Name, Is_Adv_Training)
 
     Forward_Size, Forward_Repeat = basic_info['Forward_Size'], basic_info['Forward_Repeat']
     # Model_Name = basic_info['Model']
     Activation_F = 'relu'
     Learning_Rate = 0.08
 
-    Std_Epoch_Num = len(std.epoch_MI_hM_X_upper)
+    # 训练曲线每个 epoch 一个点, 测试集 acc/loss 以及互信息只在 Eval_Epochs 上有值
+    # 旧的数据中没有 eval_epochs, 此时每个 epoch 都做了评估
+    Std_Epoch_Num = len(analytic_data['train_loss'])
     Epochs = [i for i in range(Std_Epoch_Num)]
+    Eval_Epochs = analytic_data.get('eval_epochs', [i for i in range(len(std.epoch_MI_hM_X_upper))])
     Layer_Num = len(std.epoch_MI_hM_X_upper[0])
     Layer_Name = [str(i + 1) for i in range(Layer_Num)]
+    Epoch_Ticks = [0, Std_Epoch_Num // 2, Std_Epoch_Num]
 
     # Green = plt.cm.ScalarMappable(cmap='Blues', norm=plt.Normalize(vmin=0, vmax=Std_Epoch_Num))
 
@@ -66,8 +85,8 @@ def plot_mutual_info_scatter(Model_Name, Enable_Adv_Training):
     # cmap_adv = plt.get_cmap('Reds')  # summer 偏红色
     s_cmap_std = plt.cm.ScalarMappable(cmap=std_color, norm=plt.Normalize(vmin=0, vmax=Std_Epoch_Num))
     s_cmap_adv = plt.cm.ScalarMappable(cmap=adv_color, norm=plt.Normalize(vmin=0, vmax=Std_Epoch_Num))
-    c_std = [cmap_std(i / Std_Epoch_Num * 1.0) for i in range(Std_Epoch_Num)]
-    c_adv = [cmap_adv(i / Std_Epoch_Num * 1.0) for i in range(Std_Epoch_Num)]
+    c_std = [cmap_std(i / Std_Epoch_Num * 1.0) for i in Eval_Epochs]
+    c_adv = [cmap_adv(i / Std_Epoch_Num * 1.0) for i in Eval_Epochs]
     # Red = plt.cm.ScalarMappable(cmap='cmap_adv', norm=plt.Normalize(vmin=0, vmax=Std_Epoch_Num))
     # sm = plt.cm.ScalarMappable(cmap='gnuplot', norm=plt.Normalize(vmin=0, vmax=Std_Epoch_Num))
 
@@ -85,8 +104,8 @@ def plot_mutual_info_scatter(Model_Name, Enable_Adv_Training):
     ax00.set_xlabel('Epochs')
     ax00.set_ylabel('Loss')
     ax00.plot(Epochs, analytic_data['train_loss'], label='Train set')
-    ax00.plot(Epochs, analytic_data['test_clean_loss'], label='Clean test')
-    ax00.plot(Epochs, analytic_data['test_adv_loss'], label='Adv test')
+    ax00.plot(Eval_Epochs, analytic_data['test_clean_loss'], label='Clean test')
+    ax00.plot(Eval_Epochs, analytic_data['test_adv_loss'], label='Adv test')
     # ax00.legend(prop={'size': 13})
     ax00.legend(prop={'size': 10})
     # -------------------
@@ -94,8 +113,8 @@ def plot_mutual_info_scatter(Model_Name, Enable_Adv_Training):
     ax01.set_xlabel('Epochs')
     ax01.set_ylabel('Accuracy (%)')
     ax01.plot(Epochs, analytic_data['train_acc'], label='Train set')
-    ax01.plot(Epochs, analytic_data['test_clean_acc'], label='Clean test')
-    ax01.plot(Epochs, analytic_data['test_adv_acc'], label='Adv test')
+    ax01.plot(Eval_Epochs, analytic_data['test_clean_acc'], label='Clean test')
+    ax01.plot(Eval_Epochs, analytic_data['test_adv_acc'], label='Adv test')
     # ax01.legend(prop={'size': 13})
     ax01.legend(prop={'size': 10})
 
@@ -112,15 +131,15 @@ def plot_mutual_info_scatter(Model_Name, Enable_Adv_Training):
     ax03.set_ylabel(r'$I(T;Y)$' + ' (bits)')
     ax03.set_title('The I(T;Y) lower bound')
 
-    for i in Epochs:
+    for i, epoch in enumerate(Eval_Epochs):
         # std.epoch_MI_hM_X_lower, std.epoch_MI_hM_Y_lower,
         # adv.epoch_MI_hM_X_lower, adv.epoch_MI_hM_Y_lower,
 
-        ax02.plot(Layer_Name, std.epoch_MI_hM_X_lower[i], color=cmap_std(i / Std_Epoch_Num), marker='o')
-        ax02.plot(Layer_Name, adv.epoch_MI_hM_X_lower[i], color=s_cmap_adv.to_rgba(i + 1), marker='+')
+        ax02.plot(Layer_Name, std.epoch_MI_hM_X_lower[i], color=cmap_std(epoch / Std_Epoch_Num), marker='o')
+        ax02.plot(Layer_Name, adv.epoch_MI_hM_X_lower[i], color=s_cmap_adv.to_rgba(epoch + 1), marker='+')
 
-        ax03.plot(Layer_Name, std.epoch_MI_hM_Y_lower[i], color=s_cmap_std.to_rgba(i + 1), marker='o')
-        ax03.plot(Layer_Name, adv.epoch_MI_hM_Y_lower[i], color=s_cmap_adv.to_rgba(i + 1), marker='+')
+        ax03.plot(Layer_Name, std.epoch_MI_hM_Y_lower[i], color=s_cmap_std.to_rgba(epoch + 1), marker='o')
+        ax03.plot(Layer_Name, adv.epoch_MI_hM_Y_lower[i], color=s_cmap_adv.to_rgba(epoch + 1), marker='+')
 
     # -------------------------------------------mutual information spilt by Layer---------------------
     def axs_plot(fig, std_I_TX, std_I_TY, adv_I_TX, adv_I_TY, Std_Epoch_Num, MI_Type, Row_i):
@@ -183,9 +202,9 @@ def plot_mutual_info_scatter(Model_Name, Enable_Adv_Training):
 
             # 设置 color_bar
             if layer_i == (Layer_Num - 1) and Row_i == 1:
-                fig.colorbar(s_cmap_std, ax=ax, ticks=[0, 100, 200], label='ST epoch')
+                fig.colorbar(s_cmap_std, ax=ax, ticks=Epoch_Ticks, label='ST epoch')
             if layer_i == (Layer_Num - 1) and Row_i == 3:
-                fig.colorbar(s_cmap_adv, ax=ax, ticks=[0, 100, 200], label='AT epoch')
+                fig.colorbar(s_cmap_adv, ax=ax, ticks=Epoch_Ticks, label='AT epoch')
 
     # std/adv Upper
     axs_plot(fig,
@@ -236,23 +255,23 @@ def plot_mutual_info_scatter(Model_Name, Enable_Adv_Training):
 
         axs[0][layer_i].set_title('Layer %d' % (layer_i + 1))
         # epoch_i, layer_i, label_i
-        axs[0][layer_i].plot(Epochs, std_lower_detail[..., layer_i, -1],
+        axs[0][layer_i].plot(Eval_Epochs, std_lower_detail[..., layer_i, -1],
                              color=COLOR[0],
                              label=r'$H_{Lower}(T_i)$')
 
         axs[1][layer_i].set_xlabel('Epochs')
-        axs[1][layer_i].plot(Epochs, adv_lower_detail[..., layer_i, -1],
+        axs[1][layer_i].plot(Eval_Epochs, adv_lower_detail[..., layer_i, -1],
                              color=COLOR[0],
                              label=r'$H_{Lower}(T_i)$')
 
         for label_i in [i for i in range(10)]:
             # epoch_i, layer_i, label_i
             std_temp_data = std_lower_detail[..., layer_i, label_i]
-            axs[0][layer_i].plot(Epochs, std_temp_data,
+            axs[0][layer_i].plot(Eval_Epochs, std_temp_data,
                                  color=COLOR[label_i + 1],
                                  label=r'$H(T_i|y_%d)$' % (label_i))
             adv_temp_data = std_lower_detail[..., layer_i, label_i]
-            axs[1][layer_i].plot(Epochs, adv_temp_data,
+            axs[1][layer_i].plot(Eval_Epochs, adv_temp_data,
                                  color=COLOR[label_i + 1],
                                  label=r'$H(T_i|y_%d)$' % (label_i))
     # 只有第一个子图显示 legend 信息
@@ -284,31 +303,27 @@ def plot_mutual_info(Model_Name, Enable_Adv_Training):
     line_legends = [Line2D([0], [0], color='purple', linewidth=1, linestyle='-', marker='o'),
                     Line2D([0], [0], color='purple', linewidth=1, linestyle='--', marker='^')]
     Is_Adv_Training = 'Adv_Train' if Enable_Adv_Training else 'Std_Train'
-    with open('./Checkpoint/%s/basic_info_%s.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
-        basic_info = pickle.load(f)
-    with open('./Checkpoint/%s/loss_and_acc_%s.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
-        analytic_data = pickle.load(f)
-    with open('./Checkpoint/%s/loss_and_mutual_info_%s_std.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
-        std = pickle.load(f)
-    with open('./Checkpoint/%s/loss_and_mutual_info_%s_adv.pkl' % (Model_Name, Is_Adv_Training), 'rb') as f:
-        adv = pickle.load(f)
+    basic_info, analytic_data, std, adv = load_training_data(Model_Name, Is_Adv_Training)
     '''
-    过渡方案， 读取之后消除layer_activations再保存回去
+    过渡方案， 读取之后消除layer_activations再保存回去 (只针对 pickle 保存的旧数据)
     '''
-    with open('./Checkpoint/%s/loss_and_mutual_info_%s_std.pkl' % (Model_Name, Is_Adv_Training), 'wb') as f:
-        std.clear_activations()
-        pickle.dump(std, f)
-    with open('./Checkpoint/%s/loss_and_mutual_info_%s_adv.pkl' % (Model_Name, Is_Adv_Training), 'wb') as f:
-        adv.clear_activations()
-        pickle.dump(adv, f)
+    if hasattr(std, 'clear_activations'):
+        with open('./Checkpoint/%s/loss_and_mutual_info_%s_std.pkl' % (Model_Name, Is_Adv_Training), 'wb') as f:
+            std.clear_activations()
+            pickle.dump(std, f)
+        with open('./Checkpoint/%s/loss_and_mutual_info_%s_adv.pkl' % (Model_Name, Is_Adv_Training), 'wb') as f:
+            adv.clear_activations()
+            pickle.dump(adv, f)
 
     Forward_Size, Forward_Repeat = basic_info['Forward_Size'], basic_info['Forward_Repeat']
     # Model_Name = basic_info['Model']
     Activation_F = 'relu'
     Learning_Rate = 0.08
 
-    Std_Epoch_Num = len(std.epoch_MI_hM_X_upper)
+    # 与 plot_mutual_info_scatter 相同: 训练曲线每个 epoch 一个点, 测试集 acc/loss 以及互信息只在 Eval_Epochs 上有值
+    Std_Epoch_Num = len(analytic_data['train_loss'])
     Epochs = [i for i in range(Std_Epoch_Num)]
+    Eval_Epochs = analytic_data.get('eval_epochs', [i for i in range(len(std.epoch_MI_hM_X_upper))])
     Layer_Num = len(std.epoch_MI_hM_X_upper[0])
     Layer_Name = [str(i + 1) for i in range(Layer_Num)]
 
@@ -319,7 +334,7 @@ def plot_mutual_info(Model_Name, Enable_Adv_Training):
         Model_Name, Activation_F, Learning_Rate, Forward_Repeat * Forward_Size, Is_Adv_Training
     )
 
-    def axs_plot(axs, std_I_TX, std_I_TY, adv_I_TX, adv_I_TY, Std_Epoch_Num, MI_Type):
+    def axs_plot(axs, std_I_TX, std_I_TY, adv_I_TX, adv_I_TY, Eval_Epochs, MI_Type):
         std_I_TX = np.array(std_I_TX)
         std_I_TY = np.array(std_I_TY)
         adv_I_TX = np.array(adv_I_TX)
@@ -332,11 +347,12 @@ def plot_mutual_info(Model_Name, Enable_Adv_Training):
         i_ty_min = math.floor(min(np.min(std_I_TY), np.min(adv_I_TY))) - 0.5
         i_ty_max = math.ceil(max(np.max(std_I_TY), np.max(adv_I_TY))) + 0.5
 
-        for epoch_i in range(Std_Epoch_Num):
+        # 第 eval_i 次评估对应第 Eval_Epochs[eval_i] 个 epoch, 颜色按 epoch 取
+        for eval_i, epoch_i in enumerate(Eval_Epochs):
             c = sm.to_rgba(epoch_i + 1)
             # layers = [i for i in range(1,len(I_TX)+1)]
-            std_I_TX_epoch_i, std_I_TY_epoch_i = std_I_TX[epoch_i], std_I_TY[epoch_i]
-            adv_I_TX_epoch_i, adv_I_TY_epoch_i = adv_I_TX[epoch_i], adv_I_TY[epoch_i]
+            std_I_TX_epoch_i, std_I_TY_epoch_i = std_I_TX[eval_i], std_I_TY[eval_i]
+            adv_I_TX_epoch_i, adv_I_TY_epoch_i = adv_I_TX[eval_i], adv_I_TY[eval_i]
 
             axs[0].set_title(MI_Type)
 
@@ -391,19 +407,19 @@ def plot_mutual_info(Model_Name, Enable_Adv_Training):
     axs_plot(axs[0],
              std.epoch_MI_hM_X_upper, std.epoch_MI_hM_Y_upper,
              adv.epoch_MI_hM_X_upper, adv.epoch_MI_hM_Y_upper,
-             Std_Epoch_Num, MI_Type='upper'
+             Eval_Epochs, MI_Type='upper'
              )
     # std/adv Lower
     axs_plot(axs[1],
              std.epoch_MI_hM_X_lower, std.epoch_MI_hM_Y_lower,
              adv.epoch_MI_hM_X_lower, adv.epoch_MI_hM_Y_lower,
-             Std_Epoch_Num, MI_Type='lower'
+             Eval_Epochs, MI_Type='lower'
              )
     # std/adv Binning
     axs_plot(axs[2],
              std.epoch_MI_hM_X_bin, std.epoch_MI_hM_Y_bin,
              adv.epoch_MI_hM_X_bin, adv.epoch_MI_hM_Y_bin,
-             Std_Epoch_Num, MI_Type='Binning'
+             Eval_Epochs, MI_Type='Binning'
              )
 
     # plt.scatter(I_TX, I_TY,
@@ -417,15 +433,15 @@ def plot_mutual_info(Model_Name, Enable_Adv_Training):
     axs[nrows - 1][0].set_xlabel('epochs')
     axs[nrows - 1][0].set_title('loss')
     axs[nrows - 1][0].plot(Epochs, analytic_data['train_loss'], label='train_loss')
-    axs[nrows - 1][0].plot(Epochs, analytic_data['test_clean_loss'], label='test_clean_loss')
-    axs[nrows - 1][0].plot(Epochs, analytic_data['test_adv_loss'], label='test_adv_loss')
+    axs[nrows - 1][0].plot(Eval_Epochs, analytic_data['test_clean_loss'], label='test_clean_loss')
+    axs[nrows - 1][0].plot(Eval_Epochs, analytic_data['test_adv_loss'], label='test_adv_loss')
     axs[nrows - 1][0].legend()
     # -------------------
     axs[nrows - 1][1].set_xlabel('epochs')
     axs[nrows - 1][1].set_title('acc')
     axs[nrows - 1][1].plot(Epochs, analytic_data['train_acc'], label='train_acc')
-    axs[nrows - 1][1].plot(Epochs, analytic_data['test_clean_acc'], label='test_clean_acc')
-    axs[nrows - 1][1].plot(Epochs, analytic_data['test_adv_acc'], label='test_adv_acc')
+    axs[nrows - 1][1].plot(Eval_Epochs, analytic_data['test_clean_acc'], label='test_clean_acc')
+    axs[nrows - 1][1].plot(Eval_Epochs, analytic_data['test_adv_acc'], label='test_adv_acc')
     axs[nrows - 1][1].legend()
 
     # plt.scatter(epoch_MI_hM_X_upper[0], epoch_MI_hM_Y_upper[0])
@@ -638,39 +654,28 @@ def plot_transfer_matrix(Model_Name, Enable_Adv_Training):
         ax.figure.colorbar(im, ax=ax)
 
     # print(transfer_matrix)
-    label_num = 10
-    label_chunk = transfer_matrix['label_chunk']
-    label_std_chunk = transfer_matrix['label_std_chunk']
-    label_prob_std_chunk = transfer_matrix['label_prob_std_chunk']
-    label_adv_chunk = transfer_matrix['label_adv_chunk']
-    label_prob_adv_chunk = transfer_matrix['label_prob_adv_chunk']
-
-    def calculate_transfer_matrix(labels_origin, predict, probs, label_num):
-        label_i2j = np.zeros(shape=(label_num, label_num), dtype=int)
-        label_i2j_prob = np.zeros(shape=(label_num, label_num), dtype=float)
-        for i in range(label_num):
-            # 获取 源标签数组 中关于第i号标签的索引
-            index_about_i = torch.flatten(labels_origin == i)
-            # 根据索引在 预测标签数组/预测概率数组 获取相应的内容
-            predict_about_i = predict[index_about_i]
-            probs_about_i = probs[index_about_i]
-            for j in range(label_num):
-                # 获取 对标签i预测之后的数组中 对 第j号标签 的索引 (神经网络如果没做到100%正确， 那会把真实标签i预测为其他的标签j
-                index_about_i2j = torch.flatten(predict_about_i == j)
-                i2j_num = torch.sum(index_about_i2j).item()
-                label_i2j[i][j] = i2j_num
-                # 根据索引在 预测概率数组 获取相应的内容
-                # 由于bool 索引中的数值相当于只要0、1值， 可以使用求和函数直接算出把第i类分别为j类的个数
-                probs_about_i2j = probs_about_i[index_about_i2j]
-                if i2j_num == 0:
-                    label_i2j_prob[i][j] = 0.0
-                else:
-                    label_i2j_prob[i][j] = torch.sum(probs_about_i2j).item() / i2j_num
-        return label_i2j, label_i2j_prob
-
-    i2j_std, i2j_prob_std = calculate_transfer_matrix(label_chunk, label_std_chunk, label_prob_std_chunk, 10)
-    i2j_adv, i2j_prob_adv = calculate_transfer_matrix(label_chunk, label_adv_chunk, label_prob_adv_chunk, 10)
-    label_name = [str(i) for i in range(10)]
+    if 'label_chunk' in transfer_matrix:
+        # 旧格式: 保存的是所有样本的标签和概率
+        label_chunk = transfer_matrix['label_chunk']
+        label_std_chunk = transfer_matrix['label_std_chunk']
+        label_prob_std_chunk = transfer_matrix['label_prob_std_chunk']
+        label_adv_chunk = transfer_matrix['label_adv_chunk']
+        label_prob_adv_chunk = transfer_matrix['label_prob_adv_chunk']
+        # 标签个数由数据本身决定, 不再写死为 10
+        label_num = int(max(label_chunk.max(), label_std_chunk.max(), label_adv_chunk.max()).item()) + 1
+
+        i2j_std, i2j_prob_std = calculate_transfer_matrix(label_chunk, label_std_chunk, label_prob_std_chunk,
+                                                          label_num)
+        i2j_adv, i2j_prob_adv = calculate_transfer_matrix(label_chunk, label_adv_chunk, label_prob_adv_chunk,
+                                                          label_num)
+    else:
+        # 新格式: 只保存了 K*K 的个数和概率和
+        label_num = transfer_matrix['label_num']
+        i2j_std = transfer_matrix['std']['counts']
+        i2j_prob_std = transfer_matrix_mean_prob(i2j_std, transfer_matrix['std']['prob_sum'])
+        i2j_adv = transfer_matrix['adv']['counts']
+        i2j_prob_adv = transfer_matrix_mean_prob(i2j_adv, transfer_matrix['adv']['prob_sum'])
+    label_name = [str(i) for i in range(label_num)]
 
     fig, axs = plt.subplots(nrows=2, ncols=2, figsize=(12, 12))
 
@@ -82,7 +82,98 @@ class TestTinyImageNetDataset(Dataset):
         return image, label
 
 
+"""
+预解码的 Tiny ImageNet: 只在第一次运行 convert_tiny_imagenet_to_npy 时解码所有 JPEG,
+train/val 各写成一个 uint8 的 (N, 64, 64, 3) .npy 以及一个 int64 的标签数组, 之后以 memmap 的方式读取, 没有解码开销.
+"""
+Npy_Dir = './DataSet/tiny-imagenet-200-npy'
+
+
+def get_npy_path(split, npy_dir=Npy_Dir):
+    return os.path.join(npy_dir, '%s_images.npy' % split), os.path.join(npy_dir, '%s_labels.npy' % split)
+
+
+def has_tiny_imagenet_npy(npy_dir=Npy_Dir):
+    return all(os.path.exists(path) for split in ('train', 'val') for path in get_npy_path(split, npy_dir))
+
+
+def write_images_to_npy(filenames, labels, split, npy_dir):
+    import numpy as np
+    images_path, labels_path = get_npy_path(split, npy_dir)
+    tmp_path = images_path + '.tmp.npy'
+    data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(filenames), 64, 64, 3))
+    for i, img_path in enumerate(filenames):
+        data[i] = np.asarray(Image.open(img_path).convert('RGB'), dtype=np.uint8)
+    data.flush()
+    del data
+    np.save(labels_path, np.asarray(labels, dtype=np.int64))
+    # 图片最后 rename, 存在 images.npy 就说明标签也已经写完
+    os.replace(tmp_path, images_path)
+
+
+def convert_tiny_imagenet_to_npy(root='./DataSet/tiny-imagenet-200', npy_dir=Npy_Dir):
+    if not os.path.exists(npy_dir):
+        os.makedirs(npy_dir)
+    id_dict = get_id_dict()
+    # train: root/train/<wnid>/images/*.JPEG, 排序保证每次转换的结果顺序一致
+    train_files = sorted(glob.glob(os.path.join(root, 'train', '*', 'images', '*.JPEG')))
+    train_labels = [id_dict[os.path.relpath(path, os.path.join(root, 'train')).replace('\\', '/').split('/')[0]]
+                    for path in train_files]
+    write_images_to_npy(train_files, train_labels, 'train', npy_dir)
+    # val: 标签在 val_annotations.txt 中
+    cls_dic = {}
+    for line in open(os.path.join(root, 'val', 'val_annotations.txt'), 'r'):
+        a = line.split('\t')
+        cls_dic[a[0]] = id_dict[a[1]]
+    val_files = sorted(glob.glob(os.path.join(root, 'val', 'images', '*.JPEG')))
+    val_labels = [cls_dic[os.path.basename(path)] for path in val_files]
+    write_images_to_npy(val_files, val_labels, 'val', npy_dir)
+    print('Tiny ImageNet npy: train %d, val %d -> %s' % (len(train_files), len(val_files), npy_dir))
+
+
+class NpyTinyImageNetDataset(Dataset):
+    """
+    从 convert_tiny_imagenet_to_npy 写出的 memmap 中读取, 与 TrainTinyImageNetDataset/TestTinyImageNetDataset 返回相同的 (image, label).
+    transform 为 None 时直接返回 [0, 1] 的 float (3, 64, 64) tensor; 否则以 PIL 图片的形式交给 transform, 兼容原来的 transforms.Compose.
+    整个 batch 的读取和数据增强见 utils.Tensor_Batch_Loader 和 batch_transforms.Random_Crop_Flip_Transform.
+    """
+
+    def __init__(self, split, transform=None, npy_dir=Npy_Dir):
+        import numpy as np
+        images_path, labels_path = get_npy_path(split, npy_dir)
+        self.images = np.load(images_path, mmap_mode='r')
+        self.labels = np.load(labels_path)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        import numpy as np
+        image = np.asarray(self.images[idx])
+        label = int(self.labels[idx])
+        if self.transform:
+            return self.transform(Image.fromarray(image)), label
+        return torch.from_numpy(image).permute(2, 0, 1).float().div_(255), label
+
+
+class TrainNpyTinyImageNetDataset(NpyTinyImageNetDataset):
+    def __init__(self, transform=None, npy_dir=Npy_Dir):
+        super(TrainNpyTinyImageNetDataset, self).__init__('train', transform, npy_dir)
+
+
+class TestNpyTinyImageNetDataset(NpyTinyImageNetDataset):
+    def __init__(self, transform=None, npy_dir=Npy_Dir):
+        super(TestNpyTinyImageNetDataset, self).__init__('val', transform, npy_dir)
+
+
 if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'convert':
+        # python Tiny_ImageNet_Loader.py convert
+        convert_tiny_imagenet_to_npy()
+        sys.exit(0)
     # transform = transforms.Normalize((122.4786, 114.2755, 101.3963), (70.4924, 68.5679, 71.8127))
     data_tf_tiny_imagenet = transforms.Compose([
         transforms.RandomCrop(64, padding=4, fill=0, padding_mode='constant'),
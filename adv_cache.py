@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+"""
+对抗样本的磁盘缓存.
+模型权重固定时 (例如 Forward 中装载好的 checkpoint), 同一批测试样本在同样的攻击参数下只需要跑一次 PGD,
+之后的 Saturation/Patch 各个 level, calculate_transfer_matrix, only_forward 都直接读取缓存.
+缓存的 key 是 (模型 state_dict, 数据集下标, 攻击参数) 的 sha1, 对抗样本以 .npy 的形式保存, 读取时使用 memmap.
+"""
+
+
+def hash_state_dict(state_dict, hasher=None):
+    hasher = hashlib.sha1() if hasher is None else hasher
+    for name in sorted(state_dict.keys()):
+        value = state_dict[name]
+        hasher.update(name.encode('utf-8'))
+        if torch.is_tensor(value):
+            value = value.detach().cpu().contiguous()
+            hasher.update(str(value.dtype).encode('utf-8'))
+            hasher.update(str(tuple(value.shape)).encode('utf-8'))
+            hasher.update(value.numpy().tobytes())
+        else:
+            hasher.update(repr(value).encode('utf-8'))
+    return hasher
+
+
+def make_adv_cache_key(Model, indices, Attack_Config):
+    hasher = hash_state_dict(Model.state_dict())
+    hasher.update(np.ascontiguousarray(np.asarray(indices, dtype=np.int64)).tobytes())
+    hasher.update(json.dumps(Attack_Config, sort_keys=True).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class adv_example_cache(object):
+    """
+    Storage = 'float16': 以 float16 保存, 误差约 1e-3, 远小于常用的 eps;
+    Storage = 'uint8':   以 round(x * 255) 保存, 只在 eps/alpha 都是 1/255 的整数倍时无损 (PGD 在 [0, 1] 上 clamp).
+    """
+
+    def __init__(self, Cache_Dir='./Checkpoint/adv_cache', Storage='float16'):
+        if Storage not in ('float16', 'uint8'):
+            raise RuntimeError('Unknown adv cache storage: %s' % Storage)
+        self.Cache_Dir = Cache_Dir
+        self.Storage = Storage
+        if not os.path.exists(Cache_Dir):
+            os.makedirs(Cache_Dir)
+
+    def get_path(self, key):
+        return os.path.join(self.Cache_Dir, '%s_%s.npy' % (key, self.Storage))
+
+    def load(self, key):
+        # 返回只读的 memmap, 不存在时返回 None
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def save(self, key, adv_images, Attack_Config=None):
+        # 先写入临时文件再 rename, 中途中断不会留下不完整的缓存
+        path = self.get_path(key)
+        tmp_path = path + '.tmp.npy'
+        dtype = np.float16 if self.Storage == 'float16' else np.uint8
+        data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=tuple(adv_images.shape))
+        batch_size = 1024
+        for start in range(0, adv_images.size(0), batch_size):
+            batch = adv_images[start:start + batch_size].detach().float().cpu()
+            if self.Storage == 'uint8':
+                batch = torch.round(batch * 255).clamp(0, 255)
+            data[start:start + batch.size(0)] = batch.numpy().astype(dtype)
+        data.flush()
+        del data
+        os.replace(tmp_path, path)
+        if Attack_Config is not None:
+            with open(os.path.join(self.Cache_Dir, '%s.json' % key), 'w') as f:
+                json.dump(Attack_Config, f, sort_keys=True)
+
+    def to_tensor(self, data, Device):
+        images = torch.from_numpy(np.ascontiguousarray(data)).to(Device)
+        if self.Storage == 'uint8':
+            return images.float() / 255
+        return images.float()
+
+    def get_adv_images(self, Model, images, labels, indices, atk, Attack_Config, Batch_Size, Attacks=None):
+        """
+        返回 images (N, C, H, W) 对应的对抗样本, 与 images 在同一个 device 上.
+        缓存命中时直接读取, 否则按 Batch_Size 分批跑一次 atk 并写入缓存.
+        Attacks (attack_manager) 不为 None 时通过它运行 atk, 与不使用缓存时一样开启 --AMP 并记录 'attack_test' 的耗时.
+        """
+        key = make_adv_cache_key(Model, indices, Attack_Config)
+        data = self.load(key)
+        if data is not None and data.shape == tuple(images.shape):
+            print('--> adv cache hit [%s]' % key)
+            return self.to_tensor(data, images.device)
+
+        print('--> adv cache miss [%s], generating adversarial examples..' % key)
+        adv_images = torch.empty_like(images)
+        for start in range(0, images.size(0), Batch_Size):
+            end = start + Batch_Size
+            with torch.enable_grad():
+                if Attacks is None:
+                    adv_images[start:end] = atk(images[start:end], labels[start:end])
+                else:
+                    adv_images[start:end] = Attacks.perturb('test', atk, images[start:end], labels[start:end])
+        self.save(key, adv_images, Attack_Config)
+        # 返回与之后缓存命中时完全相同的 (经过量化的) 数据, 保证第一次和之后的结果一致
+        return self.to_tensor(self.load(key), images.device)
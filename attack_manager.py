@@ -0,0 +1,153 @@
+import time
+import torch
+
+"""
+攻击对象的管理: 同一个模型, 同样的攻击类型和参数只构造一次 torchattacks 的攻击对象, 之后每个 batch 都复用.
+攻击对象保存的是模型的引用, 训练中权重原地更新, 复用的攻击总是使用当前的权重.
+perturb 记录每一类攻击的耗时和 PGD 的总步数, 用于每个 epoch 的耗时分解.
+"""
+
+
+class attack_manager(object):
+    def __init__(self, Timer=None, Autocast=None):
+        # key -> (Model, atk), 保留 Model 的引用, 避免 id 被新的模型复用
+        self.attacks = {}
+        self.Timer = Timer
+        # Autocast: 返回混合精度上下文的函数 (例如 Trainer.amp_context), 攻击的每一步 forward/backward 都在其中进行
+        self.Autocast = Autocast
+        self.steps = {}
+
+    def get_attack(self, Model, Attack_Class, **Attack_Kwargs):
+        # 模型所在的 device 也是 key 的一部分, torchattacks 在构造时记录模型的 device
+        device = next(Model.parameters()).device
+        key = (id(Model), str(device), Attack_Class.__name__, tuple(sorted(Attack_Kwargs.items())))
+        if key not in self.attacks:
+            self.attacks[key] = (Model, Attack_Class(Model, **Attack_Kwargs))
+        return self.attacks[key][1]
+
+    def run(self, atk, images, labels):
+        if self.Autocast is None:
+            return atk(images, labels)
+        with self.Autocast():
+            # 对抗样本本身保持输入的精度
+            return atk(images, labels).to(images.dtype)
+
+    def perturb(self, Name, atk, images, labels):
+        # 返回对抗样本, 耗时记录在 Timer 的 'attack_<Name>' 中
+        if self.Timer is None:
+            return self.run(atk, images, labels)
+        start = self.Timer.now()
+        adv_images = self.run(atk, images, labels)
+        self.Timer.add('attack_%s' % Name, self.Timer.now() - start)
+        self.steps['attack_%s' % Name] = self.steps.get('attack_%s' % Name, 0) + getattr(atk, 'steps', 1)
+        return adv_images
+
+    def get_step_time(self):
+        # 每一类攻击平均每一步 (一次前向 + 反向) 的耗时, 单位为秒
+        if self.Timer is None:
+            return {}
+        return {name: self.Timer.times.get(name, 0.) / steps for name, steps in self.steps.items() if steps > 0}
+
+    def reset_steps(self):
+        self.steps = {}
+
+    def clear(self):
+        self.attacks = {}
+        self.steps = {}
+
+
+class stage_timer(object):
+    """
+    按阶段累加耗时 (秒), 每个 epoch 结束时用 summary 打印并用 reset 清零.
+    Synchronize=True 时在计时点同步 cuda, 统计的是实际的 GPU 耗时, 但会打断 CPU 和 GPU 的流水.
+    """
+
+    def __init__(self, Synchronize=False):
+        self.Synchronize = Synchronize and torch.cuda.is_available()
+        self.times = {}
+
+    def now(self):
+        if self.Synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.) + seconds
+
+    def section(self, name):
+        return timer_section(self, name)
+
+    def reset(self):
+        times = self.times
+        self.times = {}
+        return times
+
+    def summary(self, step_time=None):
+        step_time = {} if step_time is None else step_time
+        items = []
+        for name, seconds in self.times.items():
+            if name in step_time:
+                items.append('%s[%.2fs, %.2fms/step]' % (name, seconds, step_time[name] * 1000))
+            else:
+                items.append('%s[%.2fs]' % (name, seconds))
+        return ' '.join(items)
+
+
+class timer_section(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.timer.now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.add(self.name, self.timer.now() - self.start)
+        return False
+
+
+class multi_eps_pgd(object):
+    """
+    一次 PGD 同时计算 eps_list 中所有 eps 的对抗样本: 同一批图片按 eps 重复 len(eps_list) 次沿 batch 维度堆叠,
+    每个样本使用自己的 eps/alpha 做投影, 所有 eps 共享每一步的 forward/backward.
+    与 torchattacks.PGD 一样使用 cross entropy, 攻击时模型处于 eval 模式.
+    返回 (len(eps_list) * b, ...) 的对抗样本, 第 eps_i 段对应第 eps_i 个 eps.
+    """
+
+    def __init__(self, model, eps_list=(8 / 255,), alpha_list=(2 / 255,), steps=10, random_start=False):
+        if len(eps_list) != len(alpha_list):
+            raise RuntimeError('eps_list and alpha_list must have the same length')
+        self.model = model
+        self.eps_list = list(eps_list)
+        self.alpha_list = list(alpha_list)
+        self.steps = steps
+        self.random_start = random_start
+
+    def get_per_sample(self, values, b, images):
+        # (E,) -> (E * b, 1, 1, 1), 与堆叠之后的图片按样本对齐
+        shape = (len(values) * b,) + (1,) * (images.dim() - 1)
+        return torch.tensor(values, dtype=images.dtype, device=images.device).repeat_interleave(b).view(shape)
+
+    def __call__(self, images, labels):
+        E, b = len(self.eps_list), images.size(0)
+        given_training = self.model.training
+        self.model.eval()
+        images = images.detach().repeat((E,) + (1,) * (images.dim() - 1))
+        labels = labels.detach().repeat(E)
+        eps = self.get_per_sample(self.eps_list, b, images)
+        alpha = self.get_per_sample(self.alpha_list, b, images)
+
+        adv_images = images.clone()
+        if self.random_start:
+            adv_images = torch.clamp(adv_images + (torch.rand_like(adv_images) * 2 - 1) * eps, 0, 1)
+        for _ in range(self.steps):
+            adv_images.requires_grad_(True)
+            loss = torch.nn.functional.cross_entropy(self.model(adv_images), labels)
+            grad, = torch.autograd.grad(loss, adv_images)
+            adv_images = adv_images.detach() + alpha * grad.sign()
+            delta = torch.max(torch.min(adv_images - images, eps), -eps)
+            adv_images = torch.clamp(images + delta, 0, 1).detach()
+        if given_training:
+            self.model.train()
+        return adv_images
@@ -0,0 +1,94 @@
+import torch
+
+"""
+作用在整个 batch (b, c, h, w) 上的图片变换, 全部是张量操作, 没有逐张图片的 python 循环.
+"""
+
+
+class Saturation_Transform(object):
+    '''
+    for each pixel v: v' = sign(2v - 1) * |2v - 1|^{2/p}  * 0.5 + 0.5
+    then clip -> (0, 1)
+    '''
+
+    def __init__(self, saturation_level=2.0):
+        self.p = saturation_level * 1.0
+
+    def __call__(self, batch_images):
+        ret_img = torch.sign(2 * batch_images - 1) * torch.pow(torch.abs(2 * batch_images - 1), 2.0 / self.p)
+        ret_img = ret_img * 0.5 + 0.5
+        return torch.clamp(ret_img, 0, 1)
+
+
+class Patch_Transform(object):
+    '''
+    把每一张图片切成 k*k 个大小相同的块, 每张图片独立地随机打乱块的位置.
+    k == 0 时不做变换; h, w 不能被 k 整除时, 只打乱左上角 (h // k * k, w // k * k) 的区域, 剩余的边缘保持不变.
+    Seed 不为 None 时使用独立的随机数发生器, 同样的 Seed 和同样的调用顺序得到同样的排列.
+    '''
+
+    def __init__(self, k=2, Seed=None):
+        self.k = k
+        self.generator = None if Seed is None else torch.Generator().manual_seed(Seed)
+
+    def get_permutation(self, b, device):
+        # 每张图片一个 k*k 的随机排列, 在 cpu 上生成保证不同 device 上的结果一致
+        perm = torch.argsort(torch.rand(b, self.k * self.k, generator=self.generator), dim=1)
+        return perm.to(device)
+
+    def __call__(self, batch_images):
+        k = self.k
+        if k == 0:
+            return batch_images
+        b, c, h, w = batch_images.size()
+        dh, dw = h // k, w // k
+        region = batch_images[:, :, :dh * k, :dw * k]
+        # (b, c, k*dh, k*dw) -> (b, c, k, dh, k, dw) -> (b, k, k, c, dh, dw) -> (b, k*k, c, dh, dw), 块按行优先排列
+        patches = region.reshape(b, c, k, dh, k, dw).permute(0, 2, 4, 1, 3, 5).reshape(b, k * k, c, dh, dw)
+        perm = self.get_permutation(b, batch_images.device)
+        patches = patches[torch.arange(b, device=batch_images.device).unsqueeze(1), perm]
+        # 逆变换回 (b, c, k*dh, k*dw)
+        shuffled = patches.reshape(b, k, k, c, dh, dw).permute(0, 3, 1, 4, 2, 5).reshape(b, c, dh * k, dw * k)
+        if dh * k == h and dw * k == w:
+            return shuffled
+        ret_img = batch_images.clone()
+        ret_img[:, :, :dh * k, :dw * k] = shuffled
+        return ret_img
+
+
+class Random_Crop_Flip_Transform(object):
+    '''
+    与 transforms.RandomCrop(size, padding, fill=0) + transforms.RandomHorizontalFlip() 等价的 batch 版本:
+    先对整个 batch 补 padding 个 0, 每张图片独立地取随机的裁剪起点, 用一次 gather (高级索引) 完成裁剪,
+    水平翻转通过 torch.where 选择正序或逆序的列下标实现, 不产生额外的翻转拷贝.
+    输入可以是 uint8 或 float 的 (b, c, h, w), 输出与输入的 dtype 和 device 相同.
+    '''
+
+    def __init__(self, size, padding=4, flip=True, Seed=None):
+        self.size = size
+        self.padding = padding
+        self.flip = flip
+        self.generator = None if Seed is None else torch.Generator().manual_seed(Seed)
+
+    def get_params(self, b, h, w, device):
+        # 随机数在 cpu 上生成, 与 Patch_Transform 一样保证不同 device 上的结果一致
+        offset_y = torch.randint(0, h + 2 * self.padding - self.size + 1, (b,), generator=self.generator)
+        offset_x = torch.randint(0, w + 2 * self.padding - self.size + 1, (b,), generator=self.generator)
+        flip_mask = torch.rand(b, generator=self.generator) < 0.5 if self.flip else torch.zeros(b, dtype=torch.bool)
+        return offset_y.to(device), offset_x.to(device), flip_mask.to(device)
+
+    def __call__(self, batch_images):
+        b, c, h, w = batch_images.size()
+        device = batch_images.device
+        p, s = self.padding, self.size
+        padded = torch.nn.functional.pad(batch_images, (p, p, p, p), mode='constant', value=0) if p > 0 \
+            else batch_images
+        offset_y, offset_x, flip_mask = self.get_params(b, h, w, device)
+        ar = torch.arange(s, device=device)
+        # (b, s) 每张图片裁剪的行/列下标, 翻转的图片使用逆序的列下标
+        rows = offset_y.unsqueeze(1) + ar
+        cols = offset_x.unsqueeze(1) + torch.where(flip_mask.unsqueeze(1), ar.flip(0), ar)
+        return padded[torch.arange(b, device=device).view(b, 1, 1, 1),
+                      torch.arange(c, device=device).view(1, c, 1, 1),
+                      rows.view(b, 1, s, 1),
+                      cols.view(b, 1, 1, s)]
@@ -0,0 +1,67 @@
+import torch
+from compiled_model import compiled_model
+from MI_estimator import mutual_info_estimator
+from Models.CIFAR10 import LeNet_3_32_32, net_cifar10, VGG_s, WideResNet
+
+"""
+检查 compiled_model 返回的激活值与 forward hook 得到的激活值是否一致:
+同一个模型, 同一个输入, 分别用 do_forward_hook 和 forward_and_capture (编译版本) 获取每一层的激活值, 比较层名, 输出和激活值.
+包含按层类型 (LeNet_3_32_32, net_cifar10), inplace ReLU (VGG_s) 以及按层名 (WideResNet) 选择被记录层的模型.
+python compile_parity_test.py [fx|compile]
+"""
+
+
+def hook_activations(model, images):
+    estimator = mutual_info_estimator(model.modules_to_hook, By_Layer_Name=isinstance(model.modules_to_hook[0], str))
+    estimator.do_forward_hook(model)
+    outputs = model(images)
+    estimator.cancel_hook()
+    estimator.synchronize()
+    return outputs, list(estimator.hooked_layer_names), list(estimator.layer_activations)
+
+
+def compiled_activations(model, images, Compile_Mode):
+    run_model = compiled_model(model, model.modules_to_hook, Compile_Mode=Compile_Mode)
+    estimator = mutual_info_estimator(model.modules_to_hook, By_Layer_Name=isinstance(model.modules_to_hook[0], str))
+    outputs = estimator.forward_and_capture(run_model, images)
+    estimator.synchronize()
+    return outputs, list(estimator.hooked_layer_names), list(estimator.layer_activations)
+
+
+def check_parity(model, images, Compile_Mode):
+    model.eval()
+    with torch.no_grad():
+        hook_outputs, hook_names, hook_acts = hook_activations(model, images)
+        run_outputs, run_names, run_acts = compiled_activations(model, images, Compile_Mode)
+    assert hook_names == run_names, (hook_names, run_names)
+    assert len(hook_acts) == len(run_acts), (len(hook_acts), len(run_acts))
+    max_diff = (hook_outputs - run_outputs).abs().max().item()
+    for hook_act, run_act in zip(hook_acts, run_acts):
+        assert hook_act.shape == run_act.shape, (hook_act.shape, run_act.shape)
+        max_diff = max(max_diff, (hook_act.float() - run_act.float()).abs().max().item())
+    # torch.compile 会融合算子, 只能保证在浮点误差范围内一致
+    atol = 0. if Compile_Mode == 'fx' else 1e-4
+    assert max_diff <= atol, max_diff
+    return len(run_names), max_diff
+
+
+if __name__ == '__main__':
+    import sys
+
+    Compile_Mode = sys.argv[1] if len(sys.argv) > 1 else 'fx'
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+    images = torch.rand(8, 3, 32, 32, device=device)
+    models = [('LeNet_3_32_32', LeNet_3_32_32()),
+              ('net_cifar10', net_cifar10()),
+              ('VGG_s', VGG_s()),
+              ('WideResNet', WideResNet(depth=16, num_classes=10))]
+    for model_name, model in models:
+        model = model.to(device)
+        try:
+            layer_num, max_diff = check_parity(model, images, Compile_Mode)
+        except RuntimeError as e:
+            # 不能被 torch.fx trace 的模型只能使用 --Compile_Mode none
+            print('%-16s not traceable: %s' % (model_name, e))
+            continue
+        print('%-16s %s layers[%d] max_abs_diff[%.3e]' % (model_name, Compile_Mode, layer_num, max_diff))
@@ -0,0 +1,102 @@
+import inspect
+import torch
+import torch.nn as nn
+import torch.fx
+
+"""
+编译执行模式: 用 torch.fx 把模型展开成计算图, 需要记录的层 (modules_to_hook) 的输出作为计算图额外的输出返回,
+不再通过 python 的 forward hook 获取, 因此整张图可以交给 torch.compile.
+额外输出的顺序就是这些层在 forward 中被调用的顺序, 与 hook 被触发的顺序相同 (同一个层被调用多次时也是每次调用一项).
+hook 在层被调用的时刻复制激活值, 而计算图的额外输出在整个 forward 结束之后才返回, 如果图中存在 inplace 操作
+(例如 nn.ReLU(inplace=True)), 返回的可能是被修改之后的值, 因此这时每一个额外输出都先 clone 一份.
+compile_parity_test.py 检查两种方式得到的激活值是否一致.
+"""
+
+
+def get_hooked_modules(model, modules_to_hook):
+    # 与 mutual_info_estimator.do_forward_hook 的选择规则相同: 字符串按层名, 否则按层的类型
+    if isinstance(modules_to_hook[0], str):
+        return [(name, layer) for name, layer in model.named_modules() if name in modules_to_hook]
+    return [(name, layer) for name, layer in model.named_modules() if isinstance(layer, modules_to_hook)]
+
+
+def is_inplace_node(graph_module, node):
+    # inplace 的层 (inplace=True), inplace 的函数 (F.relu(x, inplace=True)) 以及 x.add_() 这样的方法
+    if node.op == 'call_module':
+        return getattr(graph_module.get_submodule(node.target), 'inplace', False) is True
+    if node.op == 'call_function':
+        return node.kwargs.get('inplace', False) is True
+    if node.op == 'call_method':
+        return node.target.endswith('_') and not node.target.endswith('__')
+    return False
+
+
+class activation_tracer(torch.fx.Tracer):
+    # 被记录的层一定作为叶子节点 (call_module) 出现在图中, 不会被展开
+    def __init__(self, hooked_ids):
+        super(activation_tracer, self).__init__()
+        self.hooked_ids = hooked_ids
+
+    def is_leaf_module(self, m, module_qualified_name):
+        return id(m) in self.hooked_ids or super(activation_tracer, self).is_leaf_module(m, module_qualified_name)
+
+
+def trace_with_activations(model, modules_to_hook):
+    """
+    返回 (GraphModule, layer_names), GraphModule 的 forward 返回 (原来的输出, (第 1 个被记录层的输出, ...)).
+    GraphModule 与 model 共享同一组子模块和参数, 训练 GraphModule 就是在训练 model.
+    """
+    hooked_ids = set(id(layer) for _, layer in get_hooked_modules(model, modules_to_hook))
+    if len(hooked_ids) == 0:
+        raise RuntimeError('no module matches modules_to_hook')
+    tracer = activation_tracer(hooked_ids)
+    # forward 中除了输入图片之外带默认值的参数 (例如 WideResNet 的 _eval) 固定为默认值, 否则 python 的 if 无法被 trace
+    params = list(inspect.signature(model.forward).parameters.values())[1:]
+    concrete_args = {p.name: p.default for p in params if p.default is not inspect.Parameter.empty}
+    try:
+        graph = tracer.trace(model, concrete_args=concrete_args or None)
+    except Exception as e:
+        raise RuntimeError('torch.fx can not trace %s: %s' % (type(model).__name__, e))
+    graph_module = torch.fx.GraphModule(tracer.root, graph)
+
+    activation_nodes = [node for node in graph.nodes
+                        if node.op == 'call_module' and id(graph_module.get_submodule(node.target)) in hooked_ids]
+    output_node = [node for node in graph.nodes if node.op == 'output'][0]
+    if any(is_inplace_node(graph_module, node) for node in graph.nodes):
+        cloned_nodes = []
+        for node in activation_nodes:
+            with graph.inserting_after(node):
+                cloned_nodes.append(graph.call_method('clone', (node,)))
+        output_node.args = ((output_node.args[0], tuple(cloned_nodes)),)
+    else:
+        output_node.args = ((output_node.args[0], tuple(activation_nodes)),)
+    graph.lint()
+    graph_module.recompile()
+    return graph_module, [node.target for node in activation_nodes]
+
+
+class compiled_model(nn.Module):
+    """
+    Compile_Mode = 'fx':      只做 fx 的图变换, 仍然以 eager 的方式执行, 用于检查和调试;
+    Compile_Mode = 'compile': 再用 torch.compile 编译一次, 之后的训练, PGD 和互信息评估都使用同一个编译结果.
+    forward 只返回模型的输出, 可以直接交给 optimizer / torchattacks; forward_with_activations 同时返回被记录层的输出.
+    """
+
+    def __init__(self, model, modules_to_hook, Compile_Mode='compile', Compile_Kwargs=None):
+        super(compiled_model, self).__init__()
+        if Compile_Mode not in ('fx', 'compile'):
+            raise RuntimeError('Unknown Compile_Mode: %s' % Compile_Mode)
+        self.graph_module, self.layer_names = trace_with_activations(model, modules_to_hook)
+        self.Compile_Mode = Compile_Mode
+        runner = self.graph_module
+        if Compile_Mode == 'compile':
+            runner = torch.compile(self.graph_module, **(Compile_Kwargs or {}))
+        # 不注册为子模块, 避免同一组参数在 named_parameters/state_dict 中出现两次
+        self.__dict__['runner'] = runner
+
+    def forward(self, x):
+        return self.runner(x)[0]
+
+    def forward_with_activations(self, x):
+        outputs, activations = self.runner(x)
+        return outputs, list(activations)
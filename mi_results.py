@@ -0,0 +1,85 @@
+import os
+import json
+import numpy as np
+
+"""
+列式的互信息结果存储, 代替直接 pickle 整个 mutual_info_estimator.
+一个结果目录包含:
+    header.json                      basic_info, loss/acc 等小数据, 以及每个数组的 shape
+    <estimator>_<name>.npy           例如 std_epoch_MI_hM_X_upper.npy, 每个估计器/每个界一个稠密数组
+数组的 shape:
+    epoch_MI_hM_{X,Y}_{upper,lower,bin}       (epoch, layer)
+    epoch_MI_hM_Y_lower_detail                (epoch, layer, label + 1), 最后一项是 H(T)
+    epoch_MI_hM_{X,Y}_{upper,lower}_sweep     (epoch, layer, len(Noise_Variance_L))
+这里的 epoch 在 Forward 中对应 level. 读取时每个数组单独以 mmap_mode='r' 打开, 画图只会读到它用到的数组.
+"""
+
+MI_RESULT_NAMES = ['epoch_MI_hM_X_lower', 'epoch_MI_hM_Y_lower', 'epoch_MI_hM_Y_lower_detail',
+                   'epoch_MI_hM_X_upper', 'epoch_MI_hM_Y_upper',
+                   'epoch_MI_hM_X_bin', 'epoch_MI_hM_Y_bin',
+                   'epoch_MI_hM_X_upper_sweep', 'epoch_MI_hM_Y_upper_sweep',
+                   'epoch_MI_hM_X_lower_sweep', 'epoch_MI_hM_Y_lower_sweep']
+
+HEADER_FILE = 'header.json'
+
+
+def save_mi_results(result_dir, estimators, header):
+    """
+    estimators: {'std': std_estimator, 'adv': adv_estimator}, header: 可以 json 序列化的字典
+    空的列表 (例如没有开启 Noise_Variance_L) 不写入文件.
+    """
+    if not os.path.exists(result_dir):
+        os.makedirs(result_dir)
+    arrays = {}
+    for prefix, estimator in estimators.items():
+        for name in MI_RESULT_NAMES:
+            value = getattr(estimator, name, [])
+            if len(value) == 0:
+                continue
+            data = np.asarray(value, dtype=np.float64)
+            file_name = '%s_%s.npy' % (prefix, name)
+            np.save(os.path.join(result_dir, file_name), data)
+            arrays['%s_%s' % (prefix, name)] = list(data.shape)
+        header.setdefault('layer_names', {})[prefix] = list(getattr(estimator, 'hooked_layer_names', []))
+    header['arrays'] = arrays
+    # header 最后写入, 目录中存在 header.json 就说明所有数组都已经写完
+    tmp_path = os.path.join(result_dir, HEADER_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(header, f, indent=2)
+    os.replace(tmp_path, os.path.join(result_dir, HEADER_FILE))
+
+
+def has_mi_results(result_dir):
+    return os.path.exists(os.path.join(result_dir, HEADER_FILE))
+
+
+class mi_results_view(object):
+    """
+    与 mutual_info_estimator 有相同的 epoch_MI_* 属性, 第一次访问时才用 mmap 打开对应的 .npy 文件.
+    没有保存的数组 (例如 sweep) 返回空列表, 与 estimator 中的默认值一致.
+    """
+
+    def __init__(self, result_dir, prefix, header):
+        self.result_dir = result_dir
+        self.prefix = prefix
+        self.header = header
+        self.layer_names = header.get('layer_names', {}).get(prefix, [])
+        self.arrays = {}
+
+    def __getattr__(self, name):
+        if name not in MI_RESULT_NAMES:
+            raise AttributeError(name)
+        if name not in self.arrays:
+            key = '%s_%s' % (self.prefix, name)
+            if key in self.header['arrays']:
+                self.arrays[name] = np.load(os.path.join(self.result_dir, key + '.npy'), mmap_mode='r')
+            else:
+                self.arrays[name] = []
+        return self.arrays[name]
+
+
+def load_mi_results(result_dir, prefixes=('std', 'adv')):
+    # 返回 (header, {'std': view, 'adv': view})
+    with open(os.path.join(result_dir, HEADER_FILE), 'r') as f:
+        header = json.load(f)
+    return header, {prefix: mi_results_view(result_dir, prefix, header) for prefix in prefixes}
@@ -1,7 +1,15 @@
+import math
 import torch
 import numpy as np
 
 
+def to_compute_dtype(x):
+    # fp16/bf16 保存的激活值在计算距离时转成 float32, |x|^2 + |y|^2 - 2xy 在半精度下会严重抵消
+    if x.dtype in (torch.float16, torch.bfloat16):
+        return x.float()
+    return x
+
+
 def calculate_dists_matrix(x):
     """Keras code to compute the pairwise distance matrix for a set of
     vectors specifie by the matrix X.
@@ -15,6 +23,7 @@ def calculate_dists_matrix(x):
 
     # calculate_dists_matrix 是在一次性计算n个向量的相互之间的2范数的平方, |X_i-X_j|_2^2
 
+    x = to_compute_dtype(x)
     x_square = torch.unsqueeze(torch.sum(x.pow(2), dim=1), dim=1)
     # x2.shape = batch_size * 1, // x2.t().shape = 1 * batch_size
     # x2 + x2.t() 会根据广播机制自动扩展shape= batch_size * batch_size 大小的矩阵
@@ -22,7 +31,87 @@ def calculate_dists_matrix(x):
     return dists
 
 
-def entropy_estimator_kl_simple(x, var):
+def entropy_estimator_kl_from_dists(dists, dims, var):
+    # 与 entropy_estimator_kl_simple 相同, 只是直接使用已经计算好的距离矩阵 |X_i-X_j|_2^2
+    N = dists.size(0) * 1.0
+    if N == 0:
+        return 0.0
+    dists2 = dists / (2 * var)
+    const = (dims / 2.0) * np.log(2 * np.pi * var)
+    log_sum_exp = torch.logsumexp(-dists2, dim=1)
+    h = torch.mean(log_sum_exp)
+    result = dims / 2 + const + np.log(N) - h.item()
+    return result
+
+
+def entropy_estimator_kl_sweep_from_dists(dists, dims, var_L):
+    # 一次性计算多个噪声方差下的 KL 上界, 在距离矩阵前面增加一个方差维度, logsumexp 在方差维度上广播
+    # 返回 shape = (len(var_L),) 的 numpy 数组
+    var_np = np.asarray(var_L, dtype=np.float64)
+    N = dists.size(0) * 1.0
+    if N == 0:
+        return np.zeros(len(var_np))
+    var = torch.as_tensor(var_np, dtype=dists.dtype, device=dists.device).view(-1, 1, 1)
+    dists2 = dists.unsqueeze(0) / (2 * var)
+    log_sum_exp = torch.logsumexp(-dists2, dim=2)
+    h = torch.mean(log_sum_exp, dim=1).cpu().numpy().astype(np.float64)
+    const = (dims / 2.0) * np.log(2 * np.pi * var_np)
+    return dims / 2 + const + np.log(N) - h
+
+
+def choose_tile_size(N, memory_budget, element_size=4, D=0):
+    # 每一个分块需要 tile*tile 的距离矩阵, 以及 exp 之后同样大小的临时矩阵, 这里按 3 份来估计;
+    # 另外还有 x_row / x_col 两块 tile*D 的 (float32) 数据, 对于很宽的层 (例如展平的 conv, D ~ 16k) 这一项占主要部分.
+    # 解 3 * tile^2 + 2 * D * tile <= memory_budget / element_size
+    budget = memory_budget / float(element_size)
+    tile_size = int((math.sqrt(D * D + 3.0 * budget) - D) / 3.0)
+    return max(1, min(N, tile_size))
+
+
+def logsumexp_dists_tiled(x, var, tile_size):
+    """
+    分块计算 mean_i logsumexp_j(-|X_i-X_j|_2^2 / (2 * var)), 不会构造完整的 N*N 距离矩阵.
+    行按 tile_size 分块, 每一行块再按列分块, 用 running max / running sum 在线地累积 logsumexp,
+    因此除了 x 本身以外只需要 O(tile_size * tile_size + N) 的内存.
+    x 是 fp16/bf16 时保持原来的精度, 只有每一个分块在计算时转成 float32.
+    """
+    N = x.size(0)
+    dtype = to_compute_dtype(x[:1]).dtype
+    x_square = torch.cat([torch.sum(to_compute_dtype(x[i:i + tile_size]).pow(2), dim=1)
+                          for i in range(0, N, tile_size)])
+    total = 0.
+    for row_start in range(0, N, tile_size):
+        row_end = min(row_start + tile_size, N)
+        x_row = to_compute_dtype(x[row_start:row_end])
+        running_max = torch.full((row_end - row_start,), -float('inf'), dtype=dtype, device=x.device)
+        running_sum = torch.zeros(row_end - row_start, dtype=dtype, device=x.device)
+        for col_start in range(0, N, tile_size):
+            col_end = min(col_start + tile_size, N)
+            dists = x_square[row_start:row_end].unsqueeze(1) + x_square[col_start:col_end].unsqueeze(0) \
+                    - 2 * torch.matmul(x_row, to_compute_dtype(x[col_start:col_end]).t())
+            block = -dists / (2 * var)
+            new_max = torch.maximum(running_max, torch.max(block, dim=1)[0])
+            running_sum = running_sum * torch.exp(running_max - new_max) + \
+                          torch.sum(torch.exp(block - new_max.unsqueeze(1)), dim=1)
+            running_max = new_max
+        total += torch.sum(running_max + torch.log(running_sum)).item()
+    return total / N
+
+
+def entropy_estimator_kl_tiled(x, var, tile_size=None, memory_budget=None):
+    # entropy_estimator_kl_simple 的分块版本, tile_size 没有给出时由 memory_budget (字节) 推算
+    N, dims = x.size(0) * 1.0, x.size(1) * 1.0
+    if N == 0:
+        return 0.0
+    if tile_size is None:
+        # 分块在 float32 下计算, 至少按 4 字节估计
+        tile_size = choose_tile_size(x.size(0), memory_budget, max(x.element_size(), 4), D=x[0].numel())
+    const = (dims / 2.0) * np.log(2 * np.pi * var)
+    h = logsumexp_dists_tiled(x, var, tile_size)
+    return dims / 2 + const + np.log(N) - h
+
+
+def entropy_estimator_kl_simple(x, var, tile_size=None, memory_budget=None):
     # 这个值的计算结果和上式得出的结果一致, 可以说是上式entropy_estimator_kl的简化版本
     # KL-based upper bound on entropy of mixture of Gaussians with covariance matrix var * I
     #  see Kolchinsky and Tracey, Estimating Mixture Entropy with Pairwise Distances, Entropy, 2017. Section 4.
@@ -31,26 +120,98 @@ def entropy_estimator_kl_simple(x, var):
     N, dims = x.size(0) * 1.0, x.size(1) * 1.0
     if N == 0:
         return 0.0
+    if tile_size is not None or memory_budget is not None:
+        return entropy_estimator_kl_tiled(x, var, tile_size, memory_budget)
     dists = calculate_dists_matrix(x)
-    dists2 = dists / (2 * var)
-    const = (dims / 2.0) * np.log(2 * np.pi * var)
-    log_sum_exp = torch.logsumexp(-dists2, dim=1)
-    h = torch.mean(log_sum_exp)
-    result = dims / 2 + const + np.log(N) - h.item()
-    return result
+    return entropy_estimator_kl_from_dists(dists, dims, var)
 
 
-def entropy_estimator_bd(x, var):
+def entropy_estimator_bd(x, var, tile_size=None, memory_budget=None):
     # Bhattacharyya-based lower bound on entropy of mixture of Gaussians with covariance matrix var * I 
     # see Kolchinsky and Tracey, Estimating Mixture Entropy with Pairwise Distances, Entropy, 2017. Section 4.
 
     N, dims = x.size(0) * 1.0, x.size(1) * 1.0
     if N == 0:
         return 0.0
-    val = entropy_estimator_kl_simple(x, 4 * var)
+    val = entropy_estimator_kl_simple(x, 4 * var, tile_size, memory_budget)
     return val + np.log(0.25) * dims / 2
 
 
+class kde_distance_plan(object):
+    """
+    一层激活值的"距离计划": 整个 N*N 距离矩阵只计算一次,
+    各个类别的条件熵 H(T|Y=y) 通过对距离矩阵做下标切片得到, 不同的噪声方差只需要对距离矩阵做缩放,
+    上界 (KL) 和下界 (Bhattacharyya, 4*var) 共享同一个距离矩阵.
+    """
+
+    def __init__(self, x):
+        self.N, self.dims = x.size(0), x.size(1)
+        self.dists = calculate_dists_matrix(x)
+
+    def get_dists(self, idx=None):
+        # idx 可以是布尔索引, 也可以是下标索引; 类别 y 的子矩阵就是 dists[idx][:, idx]
+        if idx is None:
+            return self.dists
+        idx = idx.to(self.dists.device)
+        return self.dists[idx][:, idx]
+
+    def entropy_kl(self, var, idx=None):
+        return entropy_estimator_kl_from_dists(self.get_dists(idx), self.dims * 1.0, var)
+
+    def entropy_bd(self, var, idx=None):
+        dists = self.get_dists(idx)
+        if dists.size(0) == 0:
+            return 0.0
+        val = entropy_estimator_kl_from_dists(dists, self.dims * 1.0, 4 * var)
+        return val + np.log(0.25) * self.dims / 2
+
+    def entropy_sweep(self, var_L, idx=None):
+        # 上界使用 var, 下界使用 4 * var, 两者拼接在同一个方差维度上只做一次广播的 logsumexp
+        var_np = np.asarray(var_L, dtype=np.float64)
+        dists = self.get_dists(idx)
+        if dists.size(0) == 0:
+            return np.zeros(len(var_np)), np.zeros(len(var_np))
+        h = entropy_estimator_kl_sweep_from_dists(dists, self.dims * 1.0, np.concatenate((var_np, 4 * var_np)))
+        upper, lower = h[:len(var_np)], h[len(var_np):] + np.log(0.25) * self.dims / 2
+        return upper, lower
+
+
+class kde_tiled_plan(object):
+    """
+    与 kde_distance_plan 接口相同, 但不保存 N*N 距离矩阵, 每次估计都用分块的 logsumexp 重新计算,
+    用于样本数 N 或者激活值维度很大, 完整的距离矩阵放不进内存的情况.
+    """
+
+    def __init__(self, x, tile_size=None, memory_budget=None):
+        self.x = x
+        self.N, self.dims = x.size(0), x.size(1)
+        self.tile_size = tile_size
+        self.memory_budget = memory_budget
+
+    def get_x(self, idx=None):
+        if idx is None:
+            return self.x
+        return self.x[idx.to(self.x.device)]
+
+    def entropy_kl(self, var, idx=None):
+        return entropy_estimator_kl_simple(self.get_x(idx), var, self.tile_size, self.memory_budget)
+
+    def entropy_bd(self, var, idx=None):
+        return entropy_estimator_bd(self.get_x(idx), var, self.tile_size, self.memory_budget)
+
+    def entropy_sweep(self, var_L, idx=None):
+        # 分块模式下不保存距离矩阵, 只能逐个方差计算
+        x = self.get_x(idx)
+        upper = np.array([entropy_estimator_kl_simple(x, var, self.tile_size, self.memory_budget) for var in var_L])
+        lower = np.array([entropy_estimator_bd(x, var, self.tile_size, self.memory_budget) for var in var_L])
+        return upper, lower
+
+
+def entropy_estimator_sweep(x, var_L):
+    # 返回 var_L 中每一个噪声方差下混合高斯熵的上界 (KL) 和下界 (Bhattacharyya)
+    return kde_distance_plan(x).entropy_sweep(var_L)
+
+
 def kde_multivariate_gauss_entropy(output, var):
     # Return entropy of a multivariate Gaussian, in nats
     dims = output.size(1)
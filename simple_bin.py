@@ -22,26 +22,114 @@ def get_unique_probs(x):
     return np.asarray(unique_counts / float(sum(unique_counts))), unique_inverse
 
 
-def bin_calc_information(inputdata, layerdata, num_of_bins):
-    p_xs, unique_inverse_x = get_unique_probs(inputdata)
+# 行哈希使用的随机投影向量, 固定种子保证每次运行得到同样的哈希
+_HASH_SEED = 12345
+
+
+def _as_integer_words(x):
+    # 按字节解释每一行 (与 get_unique_probs 的 np.void 比较一致): 字节相同的行得到相同的整数, 反之亦然
+    N = x.shape[0]
+    x = x.reshape(N, -1)
+    if x.dtype.kind in 'iu':
+        return x
+    # 其他类型 (float 等) 按不超过 4 字节的整数解释, 每个整数都能被 float64 精确表示
+    for itemsize in (4, 2, 1):
+        if x.dtype.itemsize % itemsize == 0:
+            return x.view(np.dtype('int%d' % (itemsize * 8)))
+
+
+def hash_rows(x, chunk_cols=1024):
+    """
+    把 x 的每一行 (按字节) 哈希成一个 float64: 每一行看成整数向量, 与一个固定的随机向量做内积.
+    内积由 BLAS 完成, 每个元素只读一次; 按列分块转换成 float64, 额外内存为 O(N * chunk_cols).
+    字节相同的行一定得到相同的哈希值, 不同的行得到相同哈希值的情况由 get_unique_probs_hash 精确检查.
+    """
+    x = np.ascontiguousarray(x)
+    N = x.shape[0]
+    if N == 0:
+        return np.zeros(0, dtype=np.float64)
+    words = _as_integer_words(x)
+    W = words.shape[1]
+    keys = np.random.default_rng(_HASH_SEED).standard_normal(W)
+    hashes = np.zeros(N, dtype=np.float64)
+    for start in range(0, W, chunk_cols):
+        end = min(start + chunk_cols, W)
+        hashes += words[:, start:end].astype(np.float64) @ keys[start:end]
+    return hashes
+
+
+def _rows_equal_to_first(words, first_index, unique_inverse, unique_counts, chunk_rows=64):
+    # 只检查落在同一个哈希桶 (个数 > 1) 中的行是否与桶内第一行完全相同, 只出现一次的哈希值不需要检查
+    rows = np.nonzero((unique_counts[unique_inverse] > 1) &
+                      (first_index[unique_inverse] != np.arange(len(unique_inverse))))[0]
+    # 按桶排序, 同一块中的行大多属于同一个桶, 这时只需要读取一次桶内第一行
+    rows = rows[np.argsort(unique_inverse[rows], kind='stable')]
+    for start in range(0, len(rows), chunk_rows):
+        block = rows[start:start + chunk_rows]
+        buckets = unique_inverse[block]
+        if buckets[0] == buckets[-1]:
+            equal = (words[block] == words[first_index[buckets[0]]]).all()
+        else:
+            equal = np.array_equal(words[block], words[first_index[buckets]])
+        if not equal:
+            return False
+    return True
+
+
+def get_unique_probs_hash(x):
+    """
+    get_unique_probs 的哈希版本: 先把每一行哈希成一个数, 只对 N 个哈希值做 np.unique,
+    避免对很宽的行做 O(N log N) 次 memcmp. 之后只对哈希值重复的行与桶内的第一行做精确比较,
+    一旦发现哈希冲突就退回到 get_unique_probs, 因此结果 (概率的集合) 与 get_unique_probs 完全一致,
+    只是 unique 元素的排列顺序不同.
+    """
+    x = np.ascontiguousarray(x)
+    if x.shape[0] == 0:
+        # 空输入 (例如评估子集中某个标签没有样本) 直接交给 get_unique_probs, 返回值与 sort 完全相同
+        return get_unique_probs(x)
+    _, first_index, unique_inverse, unique_counts = np.unique(hash_rows(x), return_index=True,
+                                                              return_inverse=True, return_counts=True)
+    unique_inverse = np.ravel(unique_inverse)
+    if not _rows_equal_to_first(_as_integer_words(x), first_index, unique_inverse, unique_counts):
+        return get_unique_probs(x)
+    return np.asarray(unique_counts / float(sum(unique_counts))), unique_inverse
+
+
+def get_unique_probs_fn(engine='sort'):
+    # 'sort': np.void + np.unique (按行排序); 'hash': 随机投影的行哈希 + 只对重复的哈希值做精确检查
+    if engine == 'sort':
+        return get_unique_probs
+    elif engine == 'hash':
+        return get_unique_probs_hash
+    else:
+        raise RuntimeError('Unknown unique engine: %s' % engine)
+
+
+def bin_calc_information(inputdata, layerdata, num_of_bins, engine='sort'):
+    unique_probs_fn = get_unique_probs_fn(engine)
+    p_xs, unique_inverse_x = unique_probs_fn(inputdata)
 
     bins = np.linspace(-1, 1, num_of_bins, dtype='float32')
     digitized = bins[np.digitize(np.squeeze(layerdata.reshape(1, -1)), bins) - 1].reshape(len(layerdata), -1)
-    p_ts, _ = get_unique_probs(digitized)
+    p_ts, _ = unique_probs_fn(digitized)
 
     H_LAYER = -np.sum(p_ts * np.log(p_ts))
     H_LAYER_GIVEN_INPUT = 0.
     for xval in unique_inverse_x:
-        p_t_given_x, _ = get_unique_probs(digitized[unique_inverse_x == xval, :])
+        p_t_given_x, _ = unique_probs_fn(digitized[unique_inverse_x == xval, :])
         H_LAYER_GIVEN_INPUT += - p_xs[xval] * np.sum(p_t_given_x * np.log(p_t_given_x))
     return H_LAYER - H_LAYER_GIVEN_INPUT
 
 
-def bin_calc_information2(labelixs, layerdata, binsize):
+def bin_calc_information2(labelixs, layerdata, binsize, engine='sort', single_pass=False):
     # This is even further simplified, where we use np.floor instead of digitize
+    if single_pass:
+        return bin_calc_information2_single_pass(labelixs, layerdata, binsize, engine)
+    unique_probs_fn = get_unique_probs_fn(engine)
+
     def get_h(d):
         digitized = np.floor(d / binsize).astype('int')
-        p_ts, _ = get_unique_probs(digitized)
+        p_ts, _ = unique_probs_fn(digitized)
         return -np.sum(p_ts * np.log(p_ts))
 
     H_LAYER = get_h(layerdata)
@@ -63,3 +151,34 @@ def bin_calc_information2(labelixs, layerdata, binsize):
     #     H_LAYER_GIVEN_INPUT += - p_xs[xval] * np.sum(p_t_given_x * np.log(p_t_given_x))
     # print('here', H_LAYER_GIVEN_INPUT)
     # return H_LAYER - H_LAYER_GIVEN_INPUT
+
+
+def bin_calc_information2_single_pass(labelixs, layerdata, binsize, engine='sort'):
+    """
+    与 bin_calc_information2 结果逐位相同, 但整层只离散化一次、只统计一次不同的行:
+    每个样本先得到行编号 row_id, 再用 (标签位置, row_id) 组成的联合键做一次 np.unique,
+    联合键按标签位置分段后, 每一段的计数就是 H(T|Y=y) 所需的计数, 并且顺序与单独对子集做 unique 时相同.
+    额外内存为 O(N).
+    """
+    unique_probs_fn = get_unique_probs_fn(engine)
+    digitized = np.floor(layerdata / binsize).astype('int')
+    p_ts, unique_inverse = unique_probs_fn(digitized)
+    unique_inverse = np.ravel(unique_inverse)
+    H_LAYER = -np.sum(p_ts * np.log(p_ts))
+
+    # 每一个样本所属标签在 labelixs 中的位置
+    label_ixs = list(labelixs.values())
+    label_pos = np.full(len(unique_inverse), len(label_ixs), dtype=np.int64)
+    for pos, ixs in enumerate(label_ixs):
+        label_pos[ixs] = pos
+
+    unique_num = len(p_ts)
+    joint_keys, joint_counts = np.unique(label_pos * unique_num + unique_inverse, return_counts=True)
+    bounds = np.searchsorted(joint_keys // unique_num, np.arange(len(label_ixs) + 1))
+
+    H_LAYER_GIVEN_OUTPUT = 0.
+    for pos, ixs in enumerate(label_ixs):
+        counts = joint_counts[bounds[pos]:bounds[pos + 1]]
+        p_ts_given_y = np.asarray(counts / float(sum(counts)))
+        H_LAYER_GIVEN_OUTPUT += ixs.mean() * -np.sum(p_ts_given_y * np.log(p_ts_given_y))
+    return H_LAYER, H_LAYER - H_LAYER_GIVEN_OUTPUT
@@ -19,6 +19,8 @@ Train_Batch_Size = 128
 Forward_Size = 800
 Forward_Repeat = 5
 Std_Epoch_Num = 10
+# 混合精度: 'none' / 'fp16' (cuda) / 'bf16'
+AMP = 'none'
 
 
 def ATK(Random_Start=False):
@@ -248,7 +250,7 @@ def evaluate_acc(Keep_Clean):
         images = batch_images.to(Device)
         if not Keep_Clean:
             # print('Attacking')
-            with torch.enable_grad():
+            with torch.enable_grad(), get_autocast(Device, AMP):
                 images = atk(batch_images, batch_labels)
         # forward
         outputs = model(images)
@@ -273,9 +275,9 @@ def get_clean_or_adv_image(Keep_Clean):
         return batch_images, batch_labels
 
     else:
-        with torch.enable_grad():
+        with torch.enable_grad(), get_autocast(Device, AMP):
             adv_images = atk(batch_images, batch_labels)
-            return adv_images, batch_labels
+            return adv_images.float(), batch_labels
 
 
 # 4.1 Standard Accuracy
@@ -365,6 +367,7 @@ def training(Enable_Adv_Training):
 
     model = model.to(Device)
     model.train()
+    scaler = get_grad_scaler(Device, AMP)
 
     for epoch_i in range(Std_Epoch_Num):
         train_loss_sum, train_acc_sum, sample_sum = 0.0, 0.0, 0
@@ -382,23 +385,26 @@ def training(Enable_Adv_Training):
 
             if Enable_Adv_Training:
                 atk = ATK(Random_Start=True)
-                batch_images = atk(batch_images, batch_labels)
+                with get_autocast(Device, AMP):
+                    batch_images = atk(batch_images, batch_labels).float()
 
-            outputs = model(batch_images)
+            with get_autocast(Device, AMP):
+                outputs = model(batch_images)
 
             if epoch_i == 0 and sample_sum == 0:
                 print(Device)
                 print(batch_images.shape, batch_labels.shape, outputs.shape)
                 # print(batch_labels, outputs)
 
-            loss = criterion(outputs, batch_labels)
+            loss = criterion(outputs.float(), batch_labels)
 
             # zero the gradient cache
             optimizer.zero_grad()
             # backpropagation
-            loss.backward()
+            scaler.scale(loss).backward()
             # update weights and bias
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
             scheduler.step()
 
             train_loss_sum += loss.item()
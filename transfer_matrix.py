@@ -0,0 +1,57 @@
+import numpy as np
+import torch
+
+"""
+转移矩阵 (混淆矩阵): 第 i 行第 j 列是真实标签为 i 的样本被预测为 j 的个数, 以及这些样本预测概率的平均值.
+用 bincount(label * K + predict) 一次统计所有 K*K 个格子, 概率的和用带权重的 bincount 统计.
+"""
+
+
+def transfer_matrix_counts(labels_origin, predict, probs, label_num):
+    # 返回 (K*K 的个数, K*K 的概率和), 都是 labels_origin 所在 device 上的 tensor
+    index = torch.flatten(labels_origin).long() * label_num + torch.flatten(predict).long()
+    counts = torch.bincount(index, minlength=label_num * label_num)
+    prob_sum = torch.bincount(index, weights=torch.flatten(probs).double(), minlength=label_num * label_num)
+    return counts.view(label_num, label_num), prob_sum.view(label_num, label_num)
+
+
+def transfer_matrix_mean_prob(counts, prob_sum):
+    # 没有样本的格子平均概率为 0
+    counts = np.asarray(counts)
+    prob_sum = np.asarray(prob_sum, dtype=float)
+    return np.where(counts > 0, prob_sum / np.maximum(counts, 1), 0.0)
+
+
+def calculate_transfer_matrix(labels_origin, predict, probs, label_num):
+    """
+    labels_origin: 真实标签, predict: 预测标签, probs: 预测标签的概率 (置信度), 三者长度相同
+    返回 label_i2j (int, K*K), label_i2j_prob (float, K*K)
+    """
+    counts, prob_sum = transfer_matrix_counts(labels_origin, predict, probs, label_num)
+    counts, prob_sum = counts.cpu().numpy(), prob_sum.cpu().numpy()
+    return counts, transfer_matrix_mean_prob(counts, prob_sum)
+
+
+class transfer_matrix_accumulator(object):
+    """
+    逐个 batch 累积转移矩阵, 只保存 K*K 的个数和概率和, 内存与样本数无关.
+    """
+
+    def __init__(self, label_num, device=None):
+        self.label_num = label_num
+        self.counts = torch.zeros((label_num, label_num), dtype=torch.int64, device=device)
+        self.prob_sum = torch.zeros((label_num, label_num), dtype=torch.float64, device=device)
+
+    def update(self, labels_origin, predict, probs):
+        counts, prob_sum = transfer_matrix_counts(labels_origin, predict, probs, self.label_num)
+        self.counts += counts.to(self.counts.device)
+        self.prob_sum += prob_sum.to(self.prob_sum.device)
+
+    def get_matrix(self):
+        counts, prob_sum = self.counts.cpu().numpy(), self.prob_sum.cpu().numpy()
+        return counts, transfer_matrix_mean_prob(counts, prob_sum)
+
+    def state_dict(self):
+        return {'label_num': self.label_num,
+                'counts': self.counts.cpu().numpy(),
+                'prob_sum': self.prob_sum.cpu().numpy()}
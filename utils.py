@@ -36,3 +36,210 @@ def load_array_dict(file_name, Type='Array'):
     else:
         k = np.load('./Checkpoint/%s.npy' % str(file_name)).item()
     return k
+
+
+def get_eval_epochs(Epoch_Num, Eval_Schedule='every', Eval_Every=1, Eval_Num=None, Eval_Epochs=None):
+    """
+    返回需要计算准确率/互信息的 epoch 下标 (从 0 开始, 表示在该 epoch 训练之前评估), 升序且不重复.
+    'every': 每 Eval_Every 个 epoch 评估一次;
+    'log':   在 [0, Epoch_Num) 上按对数间隔取 Eval_Num 个 epoch, 前期密集, 后期稀疏;
+    'list':  直接使用 Eval_Epochs 中给出的 epoch.
+    """
+    if Eval_Schedule == 'every':
+        epochs = range(0, Epoch_Num, max(1, Eval_Every))
+    elif Eval_Schedule == 'log':
+        if Eval_Num is None:
+            raise RuntimeError('Eval_Num is required by the log eval schedule')
+        epochs = np.round(np.geomspace(1, Epoch_Num, num=Eval_Num)).astype(np.int64) - 1
+    elif Eval_Schedule == 'list':
+        if Eval_Epochs is None:
+            raise RuntimeError('Eval_Epochs is required by the list eval schedule')
+        epochs = [epoch for epoch in Eval_Epochs if 0 <= epoch < Epoch_Num]
+    else:
+        raise RuntimeError('invaild eval schedule: %s' % Eval_Schedule)
+    return sorted(set(int(epoch) for epoch in epochs))
+
+
+class eval_set_cache(object):
+    """
+    固定的评估子集: 用 Seed 从 dataset 中抽取 Sample_Num 个样本, 只解码/变换一次, 作为一块连续的 tensor
+    保存在 Device 上 (Device 为 'cpu' 且 Pin_Memory=True 时保存在 pinned 的 host 内存中), 之后每个 epoch 都复用.
+    resample(Seed) 重新抽取一批样本, 用于需要每个 epoch 换一批样本的情况.
+    """
+
+    def __init__(self, dataset, Sample_Num, Device, Seed=0, Pin_Memory=False, Load_Batch_Size=500):
+        self.dataset = dataset
+        self.Sample_Num = min(Sample_Num, len(dataset))
+        self.Device = torch.device(Device)
+        self.Pin_Memory = Pin_Memory and self.Device.type == 'cpu' and torch.cuda.is_available()
+        self.Load_Batch_Size = Load_Batch_Size
+        self.images, self.labels = None, None
+        self.resample(Seed)
+
+    def resample(self, Seed):
+        from torch.utils.data import DataLoader, Subset
+        generator = torch.Generator().manual_seed(Seed)
+        indices = torch.randperm(len(self.dataset), generator=generator)[:self.Sample_Num]
+        # 样本在 dataset 中的下标, 对抗样本缓存用它来区分不同的子集
+        self.indices = indices.numpy()
+        loader = DataLoader(Subset(self.dataset, indices.tolist()), batch_size=self.Load_Batch_Size, shuffle=False)
+        start = 0
+        for batch_images, batch_labels in loader:
+            if self.images is None:
+                # 第一次抽样时分配缓冲区, 之后的 resample 原地覆盖
+                self.images = torch.empty((self.Sample_Num,) + tuple(batch_images.shape[1:]),
+                                          dtype=batch_images.dtype, device=self.Device, pin_memory=self.Pin_Memory)
+                self.labels = torch.empty((self.Sample_Num,), dtype=torch.int64, device=self.Device,
+                                          pin_memory=self.Pin_Memory)
+            end = start + batch_images.size(0)
+            self.images[start:end].copy_(batch_images)
+            self.labels[start:end].copy_(torch.as_tensor(batch_labels))
+            start = end
+
+    def get_batch(self, Batch_i, Batch_Size, Device):
+        # 第 Batch_i 个 Batch_Size 大小的连续切片, 在 device 上时不发生拷贝
+        start = Batch_i * Batch_Size
+        images = self.images[start:start + Batch_Size].to(Device, non_blocking=True)
+        labels = self.labels[start:start + Batch_Size].to(Device, non_blocking=True)
+        return images, labels
+
+
+def atomic_torch_save(obj, file_name):
+    # 先写入临时文件再 rename, 保存过程中崩溃不会损坏上一次的 checkpoint
+    tmp_name = file_name + '.tmp'
+    torch.save(obj, tmp_name)
+    os.replace(tmp_name, file_name)
+
+
+def get_rng_states():
+    # --Resume 需要恢复的全部随机数状态: torch (cpu/cuda), numpy, python random
+    # numpy 的状态转换成 list, 保证 checkpoint 中只有 tensor 和 python 的基本类型
+    import random
+    np_state = np.random.get_state()
+    return {'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            'numpy': (np_state[0], np_state[1].tolist()) + tuple(np_state[2:]),
+            'python': random.getstate()}
+
+
+def set_rng_states(states):
+    import random
+    torch.set_rng_state(states['torch'])
+    # 恢复时的 GPU 数目与保存时不同, 只恢复共同的部分
+    if torch.cuda.is_available() and len(states['cuda']) > 0:
+        cuda_states = states['cuda'][:torch.cuda.device_count()]
+        torch.cuda.set_rng_state_all(cuda_states)
+    np_state = states['numpy']
+    np.random.set_state((np_state[0], np.asarray(np_state[1], dtype=np.uint32)) + tuple(np_state[2:]))
+    random.setstate(states['python'])
+
+
+def append_jsonl(file_name, record):
+    # 追加一行 json 并立即落盘, 之前写入的记录不会因为之后的崩溃而丢失
+    import json
+    with open(file_name, 'a') as f:
+        f.write(json.dumps(record, default=float) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_jsonl(file_name):
+    # 崩溃时最后一行可能只写了一半, 解析失败的行直接丢弃
+    import json
+    records = []
+    if not os.path.exists(file_name):
+        return records
+    with open(file_name, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+    return records
+
+
+def write_jsonl(file_name, records):
+    import json
+    tmp_name = file_name + '.tmp'
+    with open(tmp_name, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record, default=float) + '\n')
+    os.replace(tmp_name, file_name)
+
+
+class Tensor_Batch_Loader(object):
+    """
+    代替 DataLoader + 逐张图片的 PIL transform: 数据集整体以 uint8 数组的形式保存 (内存中的 tensor/ndarray 或 .npy memmap),
+    每个 batch 用一次高级索引取出, 搬到 Device 后再做 batch 版本的数据增强 (见 batch_transforms.py), 最后转成 [0, 1] 的 float.
+    images: (N, C, H, W) 或 Channels_Last=True 时的 (N, H, W, C), labels: (N,)
+    Seed 为 None 时使用全局的 torch 随机数, 与 DataLoader(shuffle=True) 一样受 torch.manual_seed / rng_state 控制.
+    """
+
+    def __init__(self, images, labels, Batch_Size, Shuffle=False, Augment=None, Device='cpu', Channels_Last=False,
+                 Seed=None):
+        self.images = images
+        self.labels = torch.as_tensor(np.asarray(labels), dtype=torch.int64)
+        self.Batch_Size = Batch_Size
+        self.Shuffle = Shuffle
+        self.Augment = Augment
+        self.Device = torch.device(Device)
+        self.Channels_Last = Channels_Last
+        self.generator = None if Seed is None else torch.Generator().manual_seed(Seed)
+
+    def __len__(self):
+        return (len(self.labels) + self.Batch_Size - 1) // self.Batch_Size
+
+    def get_batch(self, indices):
+        if torch.is_tensor(self.images):
+            batch_images = self.images[torch.as_tensor(indices)]
+        else:
+            # memmap 上按升序读取, 顺序访问磁盘; 之后再按原顺序排列
+            order = np.argsort(indices)
+            batch_images = np.empty((len(indices),) + tuple(self.images.shape[1:]), dtype=self.images.dtype)
+            batch_images[order] = self.images[np.asarray(indices)[order]]
+            batch_images = torch.from_numpy(batch_images)
+        if self.Channels_Last:
+            batch_images = batch_images.permute(0, 3, 1, 2)
+        # 以 uint8 的形式搬到 Device 上, 传输量是 float 的 1/4
+        batch_images = batch_images.contiguous().to(self.Device, non_blocking=True)
+        if self.Augment is not None:
+            batch_images = self.Augment(batch_images)
+        if batch_images.dtype == torch.uint8:
+            batch_images = batch_images.float().div_(255)
+        return batch_images, self.labels[torch.as_tensor(indices)].to(self.Device, non_blocking=True)
+
+    def __iter__(self):
+        N = len(self.labels)
+        order = torch.randperm(N, generator=self.generator) if self.Shuffle else torch.arange(N)
+        order = order.numpy()
+        for start in range(0, N, self.Batch_Size):
+            yield self.get_batch(order[start:start + self.Batch_Size])
+
+
+def get_amp_dtype(AMP):
+    # --AMP: 'none' / 'fp16' / 'bf16'
+    return {'none': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[AMP]
+
+
+def get_autocast(Device, AMP):
+    """
+    混合精度的 forward (以及 PGD 中的 forward/backward) 使用的上下文, AMP 为 'none' 时什么都不做.
+    cpu 上只支持 bf16 的 autocast.
+    """
+    import contextlib
+    dtype = get_amp_dtype(AMP)
+    Device = torch.device(Device)
+    if dtype is None:
+        return contextlib.nullcontext()
+    if Device.type == 'cpu' and dtype == torch.float16:
+        raise RuntimeError('fp16 autocast requires cuda, use --AMP bf16 on cpu')
+    return torch.autocast(device_type=Device.type, dtype=dtype)
+
+
+def get_grad_scaler(Device, AMP):
+    # 只有 cuda 上的 fp16 需要 loss scaling, 其他情况下 GradScaler 是关闭的, scale/step/update 退化为普通的 backward/step
+    enabled = AMP == 'fp16' and torch.device(Device).type == 'cuda'
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    # torch < 2.3 只有 torch.cuda.amp.GradScaler (新版本中已经弃用)
+    return torch.cuda.amp.GradScaler(enabled=enabled)